@@ -0,0 +1,212 @@
+"""A content-addressed cache of PySB models assembled from INDRA Statements.
+
+Assembling a PySB model is a fixed cost that the MRA and the TRA would
+otherwise pay again for every request about an unchanged set of Statements.
+Models are keyed by a canonical fingerprint of the Statements (which does
+not depend on their order, UUIDs, evidence or belief), the function used to
+assemble them and its parameters. The cache has an in-memory LRU tier and an
+optional on-disk tier in which models are pickled, so that agents running in
+separate processes can share assembled models.
+
+Models returned by the cache are shared and have to be treated as
+immutable. Code that modifies a model (e.g., by adding observables or
+initial conditions) should first call `get_writable`, which copies a model
+only if it is one that is shared through the cache.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import logging
+import weakref
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+import pysb
+import indra
+from bioagents.settings import MODEL_CACHE_DIR
+
+
+logger = logging.getLogger('model_cache')
+
+
+# The models that are shared through a cache and must not be modified
+_frozen_models = weakref.WeakSet()
+
+
+class ModelCache(object):
+    """Cache assembled models by the content of the Statements they are from.
+
+    Parameters
+    ----------
+    max_size : Optional[int]
+        The maximum number of models kept in memory. When exceeded, the
+        least recently used model is evicted from memory (but is kept on
+        disk if a cache directory is given). Default: 32
+    cache_dir : Optional[str]
+        A directory in which models are stored as pickles. If None, only the
+        in-memory tier is used. Default: None
+    """
+    def __init__(self, max_size=32, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._mem)
+
+    def get_model(self, stmts, assemble_func, **kwargs):
+        """Return a model assembled from a list of Statements.
+
+        Parameters
+        ----------
+        stmts : list[indra.statements.Statement]
+            The Statements to assemble.
+        assemble_func : function
+            A function that takes the Statements followed by kwargs and
+            returns a PySB model. It is only called if no model assembled by
+            the same function with the same arguments is in the cache.
+        **kwargs
+            Further keyword arguments passed to assemble_func. They need
+            to be JSON-serializable to be part of the cache key.
+
+        Returns
+        -------
+        model : pysb.Model
+            The assembled model. It is shared with the cache and must not be
+            modified, see `get_writable`.
+        """
+        key = make_model_key(stmts, assemble_func, **kwargs)
+        model = self.get(key)
+        if model is None:
+            model = assemble_func(stmts, **kwargs)
+            model = self.put(key, model)
+        return model
+
+    def get(self, key):
+        """Return the model stored under a given key or None if missing."""
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                logger.info('Model cache hit (memory) for %s' % key)
+                return self._mem[key]
+        if self.cache_dir is None:
+            return None
+        fname = self._path(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            with open(fname, 'rb') as fh:
+                model = pickle.load(fh)
+        except Exception as e:
+            logger.warning('Could not load cached model from %s' % fname)
+            logger.exception(e)
+            return None
+        logger.info('Model cache hit (disk) for %s' % key)
+        return self._put_mem(key, model)
+
+    def put(self, key, model):
+        """Store a model under a given key and return the shared instance."""
+        model = self._put_mem(key, model)
+        if self.cache_dir is not None:
+            fname = self._path(key)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partially written pickle.
+            tmp_fname = fname + '.tmp'
+            try:
+                with open(tmp_fname, 'wb') as fh:
+                    pickle.dump(model, fh)
+                os.replace(tmp_fname, fname)
+            except Exception as e:
+                logger.warning('Could not write model to %s' % fname)
+                logger.exception(e)
+        return model
+
+    def clear(self):
+        """Remove all models from the in-memory tier."""
+        with self._lock:
+            self._mem.clear()
+
+    def _put_mem(self, key, model):
+        with self._lock:
+            # If the same model was assembled concurrently, keep the first
+            # one so that all callers share the same instance.
+            if key in self._mem:
+                return self._mem[key]
+            _frozen_models.add(model)
+            self._mem[key] = model
+            while len(self._mem) > self.max_size:
+                self._mem.popitem(last=False)
+        return model
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.pkl' % key)
+
+
+def is_frozen(model):
+    """Return True if the model is shared through a cache."""
+    return model in _frozen_models
+
+
+def get_writable(model):
+    """Return a model that can be modified in place.
+
+    Models shared through a cache are copied, any other model is returned
+    as is, so that a copy is only made if it is actually needed.
+    """
+    if is_frozen(model):
+        return deepcopy(model)
+    return model
+
+
+def get_stmts_fingerprint(stmts):
+    """Return a canonical hash of the content of a list of Statements.
+
+    The fingerprint does not depend on the order of the Statements, and
+    ignores their UUIDs, evidence, belief and support relations, which
+    don't affect the assembled model.
+    """
+    return _hash_json(sorted(json.dumps(_get_stmt_content(stmt),
+                                        sort_keys=True)
+                             for stmt in stmts))
+
+
+def make_model_key(stmts, assemble_func, **kwargs):
+    """Return the cache key of a model assembled from Statements.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The Statements to assemble.
+    assemble_func : function
+        The function used to assemble the model.
+    **kwargs
+        Any further settings that influence the assembled model.
+    """
+    func_name = '%s.%s' % (assemble_func.__module__,
+                           assemble_func.__qualname__)
+    parts = [get_stmts_fingerprint(stmts), func_name, sorted(kwargs.items()),
+             indra.__version__, pysb.__version__]
+    return _hash_json(parts)
+
+
+def _get_stmt_content(stmt):
+    stmt_json = stmt.to_json(use_sbo=False)
+    for key in ('id', 'evidence', 'belief', 'supports', 'supported_by',
+                'matches_hash'):
+        stmt_json.pop(key, None)
+    return stmt_json
+
+
+def _hash_json(obj):
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+# A cache shared by the agents running in this process. If MODEL_CACHE_DIR is
+# set, models are also shared with agents running in other processes.
+model_cache = ModelCache(cache_dir=MODEL_CACHE_DIR)
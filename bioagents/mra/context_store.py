@@ -0,0 +1,169 @@
+"""A store of the protein expression and mutations of genes in cell lines.
+
+The expression levels and mutations used to color SBGN diagrams are read
+from the JSON caches in the resources folder once per process, the first
+time they are needed, and kept in a compact form: expression levels as a
+NumPy matrix of cell lines by genes with interned gene names indexing the
+columns, and mutations only for the genes that have any. Data for cell
+lines that aren't in the caches are fetched with context_client, in one
+request for all the genes that are missing, and kept for later use.
+"""
+
+import os
+import sys
+import json
+import logging
+import threading
+import numpy
+from indra.databases import context_client
+
+
+logger = logging.getLogger('context_store')
+
+
+_resource_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'resources')
+EXPRESSION_CACHE = os.path.join(_resource_dir, 'expression_cache.json')
+MUTATION_CACHE = os.path.join(_resource_dir, 'mutation_cache.json')
+
+
+class CellLineContextStore(object):
+    """Look up the expression and mutations of genes in cell lines.
+
+    Parameters
+    ----------
+    expression_file : Optional[str]
+        A JSON file with the protein expression level of each gene by
+        cell line. Default: EXPRESSION_CACHE
+    mutation_file : Optional[str]
+        A JSON file with the list of mutations of each gene by cell line.
+        Default: MUTATION_CACHE
+    """
+    def __init__(self, expression_file=EXPRESSION_CACHE,
+                 mutation_file=MUTATION_CACHE):
+        self.expression_file = expression_file
+        self.mutation_file = mutation_file
+        self._loaded = False
+        self._lock = threading.Lock()
+        # The column of each gene and the row of each cell line in the
+        # expression matrix, with NaN for unknown levels
+        self._gene_idx = {}
+        self._cell_line_idx = {}
+        self._expr = None
+        # The mutations of each cell line by gene, only for mutated genes
+        self._mut = {}
+        # Data fetched with context_client for cell lines that aren't in
+        # the caches, by cell line and gene
+        self._fetched_expr = {}
+        self._fetched_mut = {}
+
+    def get_expression(self, genes, cell_line):
+        """Return the protein expression levels of genes in a cell line.
+
+        Parameters
+        ----------
+        genes : list[str]
+            The names of the genes.
+        cell_line : str
+            The name of the cell line, following CCLE conventions.
+
+        Returns
+        -------
+        expression : dict[str, dict[str, float]]
+            The expression level of each gene (None if unknown) keyed by
+            the cell line, in the format of context_client.
+        """
+        self._load()
+        row = self._cell_line_idx.get(cell_line)
+        if row is None:
+            levels = self._fetch(genes, cell_line, self._fetched_expr,
+                                 context_client.get_protein_expression)
+            return {cell_line: levels}
+        levels = {}
+        for gene in genes:
+            col = self._gene_idx.get(gene)
+            level = self._expr[row, col] if col is not None else numpy.nan
+            levels[gene] = None if numpy.isnan(level) else float(level)
+        return {cell_line: levels}
+
+    def get_mutations(self, genes, cell_line):
+        """Return the mutations of genes in a cell line.
+
+        Parameters
+        ----------
+        genes : list[str]
+            The names of the genes.
+        cell_line : str
+            The name of the cell line, following CCLE conventions.
+
+        Returns
+        -------
+        mutations : dict[str, dict[str, list[str]]]
+            The list of amino acid substitutions of each gene keyed by the
+            cell line, in the format of context_client.
+        """
+        self._load()
+        if cell_line not in self._cell_line_idx:
+            mutations = self._fetch(genes, cell_line, self._fetched_mut,
+                                    context_client.get_mutations)
+            return {cell_line: {gene: mutations[gene] or []
+                                for gene in genes}}
+        cell_line_mut = self._mut.get(cell_line, {})
+        return {cell_line: {gene: list(cell_line_mut.get(gene, ()))
+                            for gene in genes}}
+
+    def _fetch(self, genes, cell_line, fetched, fetch_func):
+        cell_line_data = fetched.setdefault(cell_line, {})
+        missing = sorted({gene for gene in genes
+                          if gene not in cell_line_data})
+        if missing:
+            logger.info('Fetching context of %d genes in %s' %
+                        (len(missing), cell_line))
+            try:
+                res = fetch_func(missing, [cell_line]) or {}
+            except Exception as e:
+                logger.error('Could not fetch context for %s' % cell_line)
+                logger.exception(e)
+                # Not cached so that the next request tries again
+                return {gene: cell_line_data.get(gene) for gene in genes}
+            res = res.get(cell_line) or {}
+            for gene in missing:
+                cell_line_data[gene] = res.get(gene)
+        return {gene: cell_line_data[gene] for gene in genes}
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with open(self.expression_file, 'r') as fh:
+                expr = json.load(fh)
+            with open(self.mutation_file, 'r') as fh:
+                mut = json.load(fh)
+            genes = sorted({gene for levels in expr.values()
+                            for gene in levels})
+            self._gene_idx = {sys.intern(gene): idx
+                              for idx, gene in enumerate(genes)}
+            self._cell_line_idx = {cell_line: idx for idx, cell_line
+                                   in enumerate(sorted(set(expr) |
+                                                       set(mut)))}
+            matrix = numpy.full((len(self._cell_line_idx), len(genes)),
+                                numpy.nan)
+            for cell_line, levels in expr.items():
+                row = self._cell_line_idx[cell_line]
+                for gene, level in levels.items():
+                    if level is not None:
+                        matrix[row, self._gene_idx[gene]] = level
+            self._expr = matrix
+            self._mut = {cell_line: {sys.intern(gene): tuple(gene_mut)
+                                     for gene, gene_mut in muts.items()
+                                     if gene_mut}
+                         for cell_line, muts in mut.items()}
+            self._loaded = True
+            logger.info('Loaded the context of %d genes in %d cell lines' %
+                        (len(genes), len(self._cell_line_idx)))
+
+
+# A store shared by all colorizers in this process
+context_store = CellLineContextStore()
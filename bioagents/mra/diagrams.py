@@ -0,0 +1,237 @@
+"""Render the diagrams of MRA models in parallel on a pool of workers.
+
+Drawing the diagrams of a model (its SBGN, reaction network, contact map
+and influence map) mostly consists of waiting for BioNetGen, KaSa and
+Graphviz subprocesses, so the diagrams are rendered in parallel on worker
+threads. The diagrams of a model are returned as a `Diagrams` mapping whose
+values are only waited for when they are accessed. In lazy mode, a diagram
+isn't even started until it is accessed, so diagrams that are never
+displayed are never rendered.
+
+The diagrams of a model only depend on its content, so they are cached by
+a key derived from the content of the model (see `DiagramCache`), and a
+model identical to a previous one, e.g., after an undo, reuses the
+existing diagrams.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from bioagents.settings import IMAGE_DIR
+
+
+logger = logging.getLogger('diagrams')
+
+
+class DiagramRenderer(object):
+    """A pool of workers on which diagrams are rendered.
+
+    Parameters
+    ----------
+    max_workers : Optional[int]
+        The number of diagrams rendered at the same time. Default: 4
+    """
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, name, func):
+        """Submit a function rendering a diagram and return its Future."""
+        return self.executor.submit(_render, name, func)
+
+
+class Diagrams(Mapping):
+    """The diagrams of a model by type, rendered in the background.
+
+    Accessing a diagram blocks until it has been rendered. A diagram that
+    could not be rendered is None.
+
+    Parameters
+    ----------
+    jobs : list[tuple(str, function)]
+        The type of each diagram and a function without arguments that
+        renders it.
+    renderer : DiagramRenderer
+        The pool of workers rendering the diagrams.
+    lazy : Optional[bool]
+        If True, each diagram is only rendered once it is first needed,
+        otherwise all diagrams are started right away. Default: False
+    """
+    def __init__(self, jobs, renderer, lazy=False):
+        self._jobs = OrderedDict(jobs)
+        self._renderer = renderer
+        self._futures = {}
+        self._lock = threading.Lock()
+        if not lazy:
+            self.render()
+
+    def __getitem__(self, diagram_type):
+        return self.get_future(diagram_type).result()
+
+    def __iter__(self):
+        return iter(self._jobs)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __repr__(self):
+        return 'Diagrams(%s)' % ', '.join(self._jobs)
+
+    def get_future(self, diagram_type):
+        """Return the Future of a diagram, starting to render it if needed."""
+        with self._lock:
+            future = self._futures.get(diagram_type)
+            if future is None:
+                func = self._jobs[diagram_type]
+                future = self._renderer.submit(diagram_type, func)
+                self._futures[diagram_type] = future
+        return future
+
+    def render(self, diagram_types=None):
+        """Start rendering diagrams that haven't been started yet.
+
+        Parameters
+        ----------
+        diagram_types : Optional[list[str]]
+            The types of diagrams to render. If None, all diagrams are
+            rendered.
+
+        Returns
+        -------
+        futures : dict[str, concurrent.futures.Future]
+            The Future of each diagram by type.
+        """
+        if diagram_types is None:
+            diagram_types = list(self._jobs)
+        return {diagram_type: self.get_future(diagram_type)
+                for diagram_type in diagram_types}
+
+    def is_started(self, diagram_type):
+        """Return True if rendering the given diagram has been started."""
+        with self._lock:
+            return diagram_type in self._futures
+
+    def get_rendered(self):
+        """Return the diagrams that have been rendered so far by type."""
+        with self._lock:
+            futures = list(self._futures.items())
+        return {diagram_type: future.result() for diagram_type, future
+                in futures if future.done()}
+
+
+class DiagramCache(object):
+    """Cache the diagrams of models by a key derived from their content.
+
+    When the cache is full, the least recently used diagrams are evicted
+    and their image files are deleted.
+
+    Parameters
+    ----------
+    max_size : Optional[int]
+        The maximum number of models whose diagrams are kept. Default: 64
+    image_dir : Optional[str]
+        The directory of the image files that are deleted on eviction.
+        Files elsewhere are never deleted. Default: IMAGE_DIR
+    """
+    def __init__(self, max_size=64, image_dir=IMAGE_DIR):
+        self.max_size = max_size
+        self.image_dir = os.path.abspath(image_dir)
+        self._diagrams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._diagrams)
+
+    def __contains__(self, key):
+        return key in self._diagrams
+
+    def get_diagrams(self, key, make_func):
+        """Return the diagrams stored under a key, making them if needed.
+
+        Parameters
+        ----------
+        key : str
+            A key derived from the content of the model.
+        make_func : function
+            A function without arguments that returns the Diagrams of the
+            model. It is only called if there are no usable diagrams
+            stored under the key.
+
+        Returns
+        -------
+        diagrams : Diagrams
+            The diagrams of the model, shared with the cache.
+        """
+        with self._lock:
+            diagrams = self._diagrams.get(key)
+            if diagrams is not None and _files_exist(diagrams):
+                self._diagrams.move_to_end(key)
+                logger.info('Diagram cache hit for %s' % key)
+                return diagrams
+            diagrams = make_func()
+            self._diagrams[key] = diagrams
+            self._diagrams.move_to_end(key)
+            evicted = []
+            while len(self._diagrams) > self.max_size:
+                evicted.append(self._diagrams.popitem(last=False)[1])
+        for old_diagrams in evicted:
+            self._delete_files(old_diagrams)
+        return diagrams
+
+    def clear(self):
+        """Remove all diagrams from the cache and delete their files."""
+        with self._lock:
+            evicted = list(self._diagrams.values())
+            self._diagrams.clear()
+        for diagrams in evicted:
+            self._delete_files(diagrams)
+
+    def _delete_files(self, diagrams):
+        # Diagrams that are still being rendered are deleted once done
+        for diagram_type in diagrams:
+            if not diagrams.is_started(diagram_type):
+                continue
+            future = diagrams.get_future(diagram_type)
+            future.add_done_callback(
+                lambda f: self._delete_file(f.result()))
+
+    def _delete_file(self, resource):
+        if not _is_file_path(resource):
+            return
+        path = os.path.abspath(resource)
+        if os.path.dirname(path) != self.image_dir:
+            return
+        # The reaction network is also saved as a dot file
+        for fname in (path, os.path.splitext(path)[0] + '.dot'):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        logger.debug('Deleted diagram %s' % path)
+
+
+def _is_file_path(resource):
+    return isinstance(resource, str) and resource.endswith('.png')
+
+
+def _files_exist(diagrams):
+    """Return True unless the file of a rendered diagram was deleted."""
+    return all(os.path.exists(resource) for resource
+               in diagrams.get_rendered().values()
+               if _is_file_path(resource))
+
+
+def _render(name, func):
+    try:
+        return func()
+    except Exception as e:
+        logger.error('Could not render %s diagram.' % name)
+        logger.exception(e)
+        return None
+
+
+# A pool and a cache shared by all MRA instances in this process
+diagram_renderer = DiagramRenderer()
+diagram_cache = DiagramCache()
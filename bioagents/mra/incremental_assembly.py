@@ -0,0 +1,322 @@
+"""Assemble the PySB model of a model version from that of its base version.
+
+A model version typically differs from the version it was derived from by
+a few statements that were appended to it or removed from it, yet
+assembling it from scratch with `PysbAssembler.make_model` generates the
+rules of all statements again and sets the default initial condition of
+each monomer with checks that grow quadratically with the number of
+monomers. Instead, the model of the new version can be derived from the
+model of the base version. The monomers are made again from the agents of
+the new statements, which is cheap. The rules of a remaining statement
+(along with its parameters) are carried over from the base model unless
+they involve a monomer whose sites changed, or their names or parameters
+may have depended on a removed statement, in which case the statement is
+assembled again. Only the rules of the appended statements are assembled
+from scratch, and the initial conditions of monomers whose sites did not
+change are carried over.
+
+The model derived this way is the same as the one assembled from scratch,
+with its components in the same order. Whenever that can't be guaranteed,
+`assemble_pysb_incremental` returns None and the model has to be assembled
+in full. This is the case for policies other than a single policy applied
+to all statements, for models with active forms, which change the rules of
+all statements involving active agents, and for base models whose
+components can't all be attributed to statements, e.g., because rules
+with clashing names were skipped.
+"""
+
+import re
+import logging
+from collections import OrderedDict
+from pysb import Model, Monomer, Parameter, Rule, Initial
+from pysb.core import RuleExpression, ReactionPattern, ComplexPattern, \
+    MonomerPattern
+from pysb.annotation import Annotation
+from indra.statements import ActiveForm
+from indra.assemblers.pysb import PysbAssembler
+from indra.assemblers.pysb.assembler import PysbPreassembler, Policy, \
+    set_base_initial_condition, get_annotation, _is_whitelisted, _n
+from indra.assemblers.pysb.base_agents import BaseAgentSet
+
+
+logger = logging.getLogger('incremental_assembly')
+
+
+def assemble_pysb_incremental(base_model, base_stmts, stmts, policies,
+                              initial_amount):
+    """Return the PySB model of statements, derived from a base model.
+
+    Parameters
+    ----------
+    base_model : pysb.Model
+        The model assembled from base_stmts by `PysbAssembler` with the
+        same policies and initial amount. It is not modified.
+    base_stmts : list[indra.statements.Statement]
+        The statements of the base version.
+    stmts : list[indra.statements.Statement]
+        The statements of the new version: those of the base version, some
+        of which may have been removed, followed by any new statements.
+    policies : str
+        The assembly policy applied to all statements.
+    initial_amount : float
+        The default initial amount of monomers.
+
+    Returns
+    -------
+    model : pysb.Model or None
+        The model assembled from stmts, the same as the one assembled by
+        `PysbAssembler`, or None if it can't be derived from the base model
+        and has to be assembled in full.
+    """
+    # Policies given by statement type or UUID, or carrying parameters,
+    # are only handled by full assembly
+    if not isinstance(policies, str):
+        return None
+    if any(isinstance(stmt, ActiveForm) for stmt in base_stmts + stmts):
+        return None
+    # The new statements have to consist of the remaining base statements
+    # followed by added statements
+    stmt_ids = {id(stmt) for stmt in stmts}
+    kept = [stmt for stmt in base_stmts if id(stmt) in stmt_ids]
+    removed = [stmt for stmt in base_stmts if id(stmt) not in stmt_ids]
+    if len(kept) > len(stmts) or \
+            any(a is not b for a, b in zip(kept, stmts)):
+        return None
+    added = stmts[len(kept):]
+    if {stmt.uuid for stmt in added} & {stmt.uuid for stmt in base_stmts}:
+        return None
+    blocks = _get_stmt_blocks(base_model, base_stmts)
+    if blocks is None:
+        return None
+    affected = _get_affected_by_removal(blocks, kept, removed)
+
+    # Without active forms, replacing activities only depends on each
+    # statement itself, and it keeps the UUIDs of statements.
+    ppa = PysbPreassembler(list(stmts))
+    ppa.replace_activities()
+    pa = PysbAssembler()
+    pa.statements = ppa.statements
+    pa.processed_policies = {stmt.uuid: Policy(policies)
+                             for stmt in pa.statements}
+    pa.agent_set = BaseAgentSet()
+    pa._monomers()
+    model = Model(name=base_model.name, _export=False)
+    pa.model = model
+    _add_monomers(model, pa.agent_set)
+    base_monomers = {m.name: m for m in base_model.monomers}
+    unchanged = {m.name for m in model.monomers
+                 if m.name in base_monomers and
+                 _same_sites(m, base_monomers[m.name])}
+
+    # Statements are assembled in order, as in full assembly. The rules of
+    # statements that only involve unchanged monomers and aren't affected
+    # by removed statements are carried over with their parameters, which
+    # are shared with the base model. This is safe since models shared
+    # through the model cache are never modified.
+    base_rule_anns = {}
+    for ann in base_model.annotations:
+        if isinstance(ann.subject, str):
+            base_rule_anns.setdefault(ann.subject, []).append(ann)
+    # Without active forms, each statement is processed into a single one
+    # with the same UUID, but statements may be listed more than once.
+    processed = OrderedDict()
+    for stmt in pa.statements:
+        if _is_whitelisted(stmt):
+            processed.setdefault(stmt.uuid, []).append(stmt)
+    num_reused = 0
+    for uuid, uuid_stmts in processed.items():
+        block = blocks.get(uuid)
+        if block is not None and uuid not in affected and \
+                all(_get_monomer_names(component) <= unchanged
+                    for component in block if isinstance(component, Rule)):
+            for component in block:
+                if isinstance(component, Rule):
+                    # This would mean that a rule was skipped in full
+                    # assembly because of a clashing name
+                    if model.rules.get(component.name) is not None:
+                        return None
+                    model.add_component(_copy_rule(component, model))
+                    model.annotations += base_rule_anns.get(component.name,
+                                                            [])
+                else:
+                    # This would mean that parameters were numbered
+                    # differently in full assembly
+                    if model.parameters.get(component.name) is not None:
+                        return None
+                    model.add_component(component)
+            num_reused += 1
+            continue
+        for stmt in uuid_stmts:
+            pol = pa.processed_policies[stmt.uuid]
+            pa._dispatch(stmt, 'assemble', model, pa.agent_set,
+                         pol.parameters)
+
+    # The initial conditions of unchanged monomers are carried over, the
+    # others are set as in full assembly.
+    base_initials = {ic.pattern.monomer_patterns[0].monomer.name: ic
+                     for ic in base_model.initials}
+    for monomer in model.monomers:
+        initial = base_initials.get(monomer.name)
+        if monomer.name in unchanged and initial is not None:
+            model.add_component(initial.value)
+            model.initials.append(
+                Initial(_copy_complex_pattern(initial.pattern, model),
+                        initial.value, initial.fixed, _export=False))
+        else:
+            set_base_initial_condition(model, monomer, initial_amount)
+    logger.info('Assembled model incrementally, reusing the rules of %d '
+                'statements, with %d statements added and %d removed' %
+                (num_reused, len(added), len(removed)))
+    return model
+
+
+def _get_stmt_blocks(model, stmts):
+    """Return the parameters and rules of a model by statement UUID.
+
+    Returns None if the components of the model can't be attributed to
+    the statements.
+    """
+    # Only models made of monomers, parameters and rules are handled
+    if len(model.components) != len(model.monomers) + \
+            len(model.parameters) + len(model.rules):
+        return None
+    uuids = {stmt.uuid for stmt in stmts}
+    rule_uuids = {}
+    for ann in model.annotations:
+        if ann.predicate == 'from_indra_statement':
+            if ann.object not in uuids:
+                return None
+            rule_uuids[ann.subject] = ann.object
+    # Rules that were skipped because another rule has the same name still
+    # created their parameters, which can't be attributed to a statement
+    used_params = _get_rule_params(model.rules) | \
+        {ic.value.name for ic in model.initials}
+    if any(param.name not in used_params for param in model.parameters):
+        return None
+    # Statements are assembled one after the other, each one creating its
+    # parameters and its rules, so the parameters of a statement are those
+    # first used by its rules.
+    blocks = OrderedDict()
+    seen = set()
+    for rule in model.rules:
+        uuid = rule_uuids.get(rule.name)
+        if uuid is None:
+            return None
+        block = blocks.setdefault(uuid, [])
+        for param in (rule.rate_forward, rule.rate_reverse):
+            if param is not None and param.name not in seen:
+                seen.add(param.name)
+                block.append(param)
+        block.append(rule)
+    # The parameters of statements have to be in the order in which they
+    # were created
+    block_params = [c.name for block in blocks.values() for c in block
+                    if isinstance(c, Parameter)]
+    if block_params != [param.name for param in model.parameters
+                        if param.name in seen]:
+        return None
+    return blocks
+
+
+def _get_affected_by_removal(blocks, kept, removed):
+    """Return the UUIDs of remaining statements whose rules or parameters
+    may be different once the removed statements are gone."""
+    removed_keys = {_get_rule_key(stmt) for stmt in removed}
+    removed_uuids = {stmt.uuid for stmt in removed}
+    removed_params = {c.name for uuid in removed_uuids
+                      for c in blocks.get(uuid, ())
+                      if isinstance(c, Parameter)}
+    # Unique parameters are numbered in the order in which they are
+    # created, so the numbers of later ones may shift
+    removed_prefixes = {_get_param_prefix(name) for name in removed_params}
+    affected = set()
+    for stmt in kept:
+        block = blocks.get(stmt.uuid, ())
+        # A rule of the statement may have been skipped because a removed
+        # statement had a rule by the same name, and rule names only depend
+        # on the type and the agents of statements.
+        if _get_rule_key(stmt) in removed_keys or \
+                _get_rule_params(c for c in block if isinstance(c, Rule)) & \
+                removed_params or \
+                any(_get_param_prefix(c.name) in removed_prefixes
+                    for c in block if isinstance(c, Parameter)):
+            affected.add(stmt.uuid)
+    return affected
+
+
+def _get_param_prefix(name):
+    match = re.match(r'^(.*)_\d+$', name)
+    return match.group(1) if match else name
+
+
+def _get_rule_params(rules):
+    return {param.name for rule in rules
+            for param in (rule.rate_forward, rule.rate_reverse)
+            if param is not None}
+
+
+def _get_rule_key(stmt):
+    return type(stmt), tuple(agent.name if agent is not None else None
+                             for agent in stmt.agent_list())
+
+
+def _get_monomer_names(rule):
+    return {mp.monomer.name
+            for rp in (rule.reactant_pattern, rule.product_pattern)
+            for cp in rp.complex_patterns if cp is not None
+            for mp in cp.monomer_patterns}
+
+
+def _add_monomers(model, agent_set):
+    # The same as in PysbAssembler.make_model
+    for agent_name, agent in agent_set.items():
+        m = Monomer(_n(agent_name), agent.sites, agent.site_states,
+                    _export=False)
+        m.site_annotations = agent.site_annotations
+        model.add_component(m)
+        for db_name, db_ref in agent.db_refs.items():
+            a = get_annotation(m, db_name, db_ref)
+            if a is not None:
+                model.add_annotation(a)
+        for af in agent.active_forms:
+            model.add_annotation(Annotation(m, af, 'has_active_pattern'))
+        for iaf in agent.inactive_forms:
+            model.add_annotation(Annotation(m, iaf, 'has_inactive_pattern'))
+        for at in agent.activity_types:
+            model.add_annotation(Annotation(m, {at: 'active'},
+                                            'has_active_pattern'))
+            model.add_annotation(Annotation(m, {at: 'inactive'},
+                                            'has_inactive_pattern'))
+
+
+def _same_sites(monomer, other):
+    return monomer.sites == other.sites and \
+        monomer.site_states == other.site_states
+
+
+def _copy_rule(rule, model):
+    """Return a copy of a rule referring to the components of a model."""
+    expr = RuleExpression(
+        _copy_reaction_pattern(rule.reactant_pattern, model),
+        _copy_reaction_pattern(rule.product_pattern, model),
+        rule.is_reversible)
+    rate_reverse = model.parameters[rule.rate_reverse.name] \
+        if rule.rate_reverse is not None else None
+    return Rule(rule.name, expr, model.parameters[rule.rate_forward.name],
+                rate_reverse, rule.delete_molecules, rule.move_connected,
+                rule.energy, rule.total_rate, _export=False)
+
+
+def _copy_reaction_pattern(pattern, model):
+    # Complex patterns are None on the side of synthesis or degradation
+    return ReactionPattern([_copy_complex_pattern(cp, model)
+                            if cp is not None else None
+                            for cp in pattern.complex_patterns])
+
+
+def _copy_complex_pattern(pattern, model):
+    return ComplexPattern([MonomerPattern(model.monomers[mp.monomer.name],
+                                          dict(mp.site_conditions),
+                                          mp.compartment)
+                           for mp in pattern.monomer_patterns],
+                          pattern.compartment, pattern.match_once)
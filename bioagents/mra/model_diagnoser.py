@@ -2,7 +2,6 @@ import logging
 import itertools
 from copy import deepcopy
 import networkx as nx
-from indra.mechlinker import MechLinker
 from indra.statements import *
 from indra.sources.indra_db_rest import get_statements
 from indra.explanation.model_checker import PysbModelChecker
@@ -14,34 +13,18 @@ logger = logging.getLogger('model_diagnoser')
 
 
 class ModelDiagnoser(object):
-    def __init__(self, statements, model=None, explain=None):
+    def __init__(self, statements, model=None, explain=None,
+                 activity_index=None):
         self.statements = statements
         self.model = model
         self.explain = explain
+        # An index that can be shared by diagnosers of successive versions
+        # of a model
+        self.activity_index = activity_index if activity_index is not None \
+            else ActivityIndex()
 
     def get_missing_activities(self):
-        ml = MechLinker(self.statements)
-        ml.gather_explicit_activities()
-        suggestions = []
-        for stmt in self.statements:
-            if isinstance(stmt, (Modification, RegulateActivity,
-                                 RegulateAmount)):
-                # The subj here is in an "active" position
-                subj, obj = stmt.agent_list()
-                if subj is None:
-                    continue
-                subj_base = ml._get_base(subj)
-                # If it has any activities but isn't in an active state
-                # here
-                if subj_base.activity_types and not subj.activity:
-                    # We suggest making the subj active in this case
-                    suggestion = deepcopy(stmt)
-                    act_type = subj_base.activity_types[0]
-                    new_subj = deepcopy(subj)
-                    new_subj.activity = ActivityCondition(act_type, True)
-                    suggestion.set_agent_list([new_subj, obj])
-                    suggestions.append(suggestion)
-        return suggestions
+        return self.activity_index.get_missing_activities(self.statements)
 
     def check_explanation(self):
         if self.model is None:
@@ -87,20 +70,9 @@ class ModelDiagnoser(object):
                 im.add_edges_from(new_edges)
                 # Now, we know that there is no path between SOURCE and TARGET.
                 # Instead, we consider connections among all possible pairs
-                # of nodes in the graph and count the number of nodes in
-                # the path between source and target:
-                best_edge = (None, 0)
-                for u, v in itertools.permutations(im.nodes(), 2):
-                    # Add the edge to the graph
-                    im.add_edge(u, v)
-                    # Find longest path between source and target
-                    simple_paths = list(nx.all_simple_paths(im, 'SOURCE',
-                                                            'TARGET'))
-                    simple_paths.sort(key=lambda p: len(p), reverse=True)
-                    if simple_paths and len(simple_paths[0]) > best_edge[1]:
-                        best_edge = ((u, v), len(simple_paths[0]))
-                    # Now remove the edge we added before going on to the next
-                    im.remove_edge(u, v)
+                # of nodes in the graph and find the one resulting in the
+                # longest path between source and target:
+                best_edge = get_best_connecting_edge(im, 'SOURCE', 'TARGET')
                 if best_edge[0]:
                     result['connect_rules'] = best_edge[0]
                     u_stmt = stmt_from_rule(best_edge[0][0], self.model,
@@ -137,3 +109,184 @@ class ModelDiagnoser(object):
         stmts.sort(key=lambda s: len(s.evidence), reverse=True)
         end_ix = len(stmts) if len(stmts) < num_statements else num_statements
         return stmts[0:end_ix], subj_agent, obj_agent
+
+
+class ActivityIndex(object):
+    """Find agents used without the activities they have elsewhere.
+
+    The explicit activities of agents are gathered as MechLinker does, but
+    the activities stated by each statement, and the suggestions made for
+    it, are cached by statement. Since the versions of a model share most
+    of their statement objects, diagnosing a new version only processes the
+    statements that changed.
+    """
+    def __init__(self):
+        # The activities (agent name, activity type) stated by statements,
+        # and the suggestions made for statements by activity type, keyed by
+        # the ids of the statements
+        self._activities = {}
+        self._suggestions = {}
+
+    def get_activity_types(self, stmts):
+        """Return the activity types of agents by name, in order of first
+        appearance in the statements."""
+        activity_types = {}
+        for stmt in stmts:
+            for name, activity_type in self._get_stmt_activities(stmt):
+                types = activity_types.setdefault(name, [])
+                if activity_type not in types:
+                    types.append(activity_type)
+        return activity_types
+
+    def get_missing_activities(self, stmts):
+        """Return statements with their subjects in an active state, for
+        statements whose subjects have activities but aren't active."""
+        self._prune(stmts)
+        activity_types = self.get_activity_types(stmts)
+        suggestions = []
+        for stmt in stmts:
+            if isinstance(stmt, (Modification, RegulateActivity,
+                                 RegulateAmount)):
+                # The subj here is in an "active" position
+                subj, obj = stmt.agent_list()
+                if subj is None:
+                    continue
+                subj_types = activity_types.get(subj.name)
+                # If it has any activities but isn't in an active state
+                # here, we suggest making the subj active
+                if subj_types and not subj.activity:
+                    suggestions.append(self._get_suggestion(stmt,
+                                                            subj_types[0]))
+        return suggestions
+
+    def _get_stmt_activities(self, stmt):
+        cached = self._activities.get(id(stmt))
+        if cached is not None and cached[0] is stmt:
+            return cached[1]
+        activities = []
+        # Activity types given as ActivityConditions
+        for agent in stmt.agent_list():
+            if agent is not None and agent.activity is not None:
+                activities.append((agent.name,
+                                   agent.activity.activity_type))
+        # Object activities given in RegulateActivity statements
+        if isinstance(stmt, RegulateActivity):
+            if stmt.obj is not None:
+                activities.append((stmt.obj.name, stmt.obj_activity))
+        # Activity types given in ActiveForms
+        elif isinstance(stmt, ActiveForm):
+            activities.append((stmt.agent.name, stmt.activity))
+        self._activities[id(stmt)] = (stmt, activities)
+        return activities
+
+    def _get_suggestion(self, stmt, act_type):
+        cached = self._suggestions.get((id(stmt), act_type))
+        if cached is not None and cached[0] is stmt:
+            return cached[1]
+        subj, obj = stmt.agent_list()
+        suggestion = deepcopy(stmt)
+        new_subj = deepcopy(subj)
+        new_subj.activity = ActivityCondition(act_type, True)
+        suggestion.set_agent_list([new_subj, obj])
+        self._suggestions[(id(stmt), act_type)] = (stmt, suggestion)
+        return suggestion
+
+    def _prune(self, stmts):
+        # Forget statements that are no longer in the model once the cache
+        # has grown much larger than the model
+        if len(self._activities) <= 2 * len(stmts) + 100:
+            return
+        stmt_ids = {id(stmt) for stmt in stmts}
+        self._activities = {key: value for key, value
+                            in self._activities.items() if key in stmt_ids}
+        self._suggestions = {key: value for key, value
+                             in self._suggestions.items()
+                             if key[0] in stmt_ids}
+
+
+def get_best_connecting_edge(graph, source, target):
+    """Return the new edge resulting in the longest path from source to target.
+
+    Without a path from source to target, any path after adding an edge
+    (u, v) consists of a path from source to u, the edge, and a path from v
+    to target, and the two paths can't share a node. If the graph also has
+    no cycles, the length of the longest such path is therefore the sum of
+    the longest path from source to u and the longest path from v to
+    target, which are found by dynamic programming in topological order,
+    in linear time. With cycles, or with a path from source to target
+    already, the combined paths may visit a node twice, so every edge is
+    instead added in turn and the simple paths from source to target are
+    enumerated.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        The graph, which must contain source and target.
+    source : str
+        The source node.
+    target : str
+        The target node.
+
+    Returns
+    -------
+    best_edge : tuple(tuple(str, str), int)
+        The new edge (u, v) and the number of nodes in the longest path from
+        source to target after adding it, or (None, 0) if no edge results
+        in a path. Ties are broken in favor of the edge that comes first in
+        the order of the nodes of the graph.
+    """
+    nodes = list(graph.nodes())
+    if len(nodes) < 2:
+        return None, 0
+    if not nx.is_directed_acyclic_graph(graph) or \
+            nx.has_path(graph, source, target):
+        return _get_best_connecting_edge_exhaustive(graph, source, target)
+    order = list(nx.topological_sort(graph))
+    # The number of nodes in the longest path from source to each node, and
+    # from each node to target
+    from_source = {source: 1}
+    for u in order:
+        if u not in from_source:
+            continue
+        for succ in graph.successors(u):
+            if from_source[u] + 1 > from_source.get(succ, 0):
+                from_source[succ] = from_source[u] + 1
+    to_target = {target: 1}
+    for v in reversed(order):
+        if v not in to_target:
+            continue
+        for pred in graph.predecessors(v):
+            if to_target[v] + 1 > to_target.get(pred, 0):
+                to_target[pred] = to_target[v] + 1
+    heads = [(from_source.get(u, 0), idx) for idx, u in enumerate(nodes)]
+    tails = [(to_target.get(v, 0), idx) for idx, v in enumerate(nodes)]
+    max_head = max(length for length, _ in heads)
+    max_tail = max(length for length, _ in tails)
+    # The first pair of distinct nodes that both have maximal lengths
+    best_heads = [idx for length, idx in heads if length == max_head]
+    best_tails = [idx for length, idx in tails if length == max_tail]
+    u, v = min((u, v) for u in best_heads[:2] for v in best_tails[:2]
+               if u != v)
+    return (nodes[u], nodes[v]), max_head + max_tail
+
+
+def _get_best_connecting_edge_exhaustive(graph, source, target):
+    """Return the best new edge by enumerating paths for every edge, see
+    get_best_connecting_edge."""
+    graph = graph.copy()
+    best_edge = (None, 0)
+    for u, v in itertools.permutations(graph.nodes(), 2):
+        # Add the edge to the graph unless it is already there
+        is_new = not graph.has_edge(u, v)
+        if is_new:
+            graph.add_edge(u, v)
+        # Find longest path between source and target
+        length = max((len(path) for path
+                      in nx.all_simple_paths(graph, source, target)),
+                     default=0)
+        if length > best_edge[1]:
+            best_edge = ((u, v), length)
+        # Now remove the edge we added before going on to the next
+        if is_new:
+            graph.remove_edge(u, v)
+    return best_edge
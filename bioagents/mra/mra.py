@@ -8,8 +8,10 @@ import copy
 import json
 import logging
 import networkx
+import threading
 import subprocess
 from datetime import datetime
+from collections import OrderedDict
 
 import kappy
 
@@ -20,13 +22,21 @@ from indra.statements import Complex, Activation, IncreaseAmount, \
 from indra.ontology.bio import bio_ontology
 from indra.assemblers.pysb import assembler as pysb_assembler
 from indra.assemblers.pysb import PysbAssembler
-from pysb.bng import BngInterfaceError
+from pysb.bng import BngInterfaceError, generate_equations
 from pysb.tools import render_reactions
 
 from pysb.export import export
 from indra.assemblers.pysb.kappa_util import im_json_to_graph, cm_json_to_graph
 from bioagents.mra.sbgn_colorizer import SbgnColorizer
-from bioagents.mra.model_diagnoser import ModelDiagnoser
+from bioagents.mra.model_diagnoser import ModelDiagnoser, ActivityIndex
+from bioagents.mra.refinement_index import RefinementIndex
+from bioagents.mra.version_store import ModelVersionStore
+from bioagents.mra.incremental_assembly import assemble_pysb_incremental
+from bioagents.mra.session_store import SessionStore
+from bioagents.mra.diagrams import Diagrams, diagram_renderer, \
+    diagram_cache
+from bioagents.model_cache import model_cache, get_writable, \
+    make_model_key, get_stmts_fingerprint
 logger = logging.getLogger('MRA')
 
 
@@ -34,14 +44,51 @@ DEFAULT_CELL_LINE = 'KP3_PANCREAS'
 
 
 class MRA(object):
-    def __init__(self):
-        self.models = {}
+    """The mechanistic reasoning agent.
+
+    Parameters
+    ----------
+    max_versions : Optional[int]
+        The number of most recent model versions that are kept, see
+        ModelVersionStore. If None, all versions are kept. Default: None
+    spill_dir : Optional[str]
+        A directory to which old model versions are moved from memory.
+        Default: None
+    lazy_diagrams : Optional[bool]
+        If True, the diagrams of a model are only rendered once they are
+        accessed, otherwise they are all rendered in parallel in the
+        background as soon as the model is assembled. Default: False
+    session_dir : Optional[str]
+        A directory in which changes to the state of the session are
+        recorded as they happen, see SessionStore. If it contains a
+        recorded session, the state of that session is restored.
+        Default: None
+    """
+    def __init__(self, max_versions=None, spill_dir=None,
+                 lazy_diagrams=False, session_dir=None):
+        self.models = ModelVersionStore(max_versions=max_versions,
+                                        spill_dir=spill_dir)
         self.transformations = []
         self.id_counter = 0
         self.default_policy = 'one_step'
         self.default_initial_amount = 100.0
         self.explain = None
         self.context = None
+        # Refinement indices of recently used model versions, and the
+        # ontology ancestors of entities shared by all indices
+        self.refinement_indices = OrderedDict()
+        self.max_refinement_indices = 8
+        self.ontology_closures = {}
+        self.lazy_diagrams = lazy_diagrams
+        # Diagnosis state reused across model versions
+        self.activity_index = ActivityIndex()
+        self.explanations = OrderedDict()
+        self.max_explanations = 16
+        self.session = None
+        if session_dir:
+            session = SessionStore(session_dir)
+            self.restore_session(session)
+            self.session = session
 
     def get_new_id(self):
         self.id_counter += 1
@@ -52,12 +99,81 @@ class MRA(object):
             return True
         return False
 
-    def assemble_pysb(self, stmts):
-        pa = PysbAssembler()
-        pa.add_statements(stmts)
-        pa.make_model(policies=self.default_policy)
-        pa.add_default_initial_conditions(self.default_initial_amount)
-        return pa.model
+    def get_refinement_index(self, model_id):
+        """Return the refinement index of the statements of a model.
+
+        The index is built once per model version and reused by all
+        operations on the same model id, see RefinementIndex.
+        """
+        stmts = self.models[model_id]
+        cached = self.refinement_indices.get(model_id)
+        # The list of statements of a model id can be replaced, e.g., by
+        # undo, in which case the index is rebuilt. The same statements can
+        # also come in a new list if the version was reconstructed.
+        if cached is not None and len(cached[1]) == len(stmts) and \
+                (cached[0] is stmts or
+                 all(a is b for a, b in zip(cached[0], stmts))):
+            self.refinement_indices.move_to_end(model_id)
+            return cached[1]
+        index = RefinementIndex(stmts, bio_ontology,
+                                closures=self.ontology_closures)
+        self.refinement_indices[model_id] = (stmts, index)
+        while len(self.refinement_indices) > self.max_refinement_indices:
+            self.refinement_indices.popitem(last=False)
+        return index
+
+    def assemble_pysb(self, stmts, base_stmts=None):
+        """Return the PySB model assembled from the statements.
+
+        If the statements of the model version that the statements are
+        derived from are given and the model of that version is cached, the
+        model is derived from it where possible, see
+        assemble_pysb_incremental. The model is shared through the model
+        cache and must not be modified, see
+        bioagents.model_cache.get_writable.
+        """
+        key = self.get_model_key(stmts)
+        model = model_cache.get(key)
+        if model is not None:
+            return model
+        if base_stmts is not None:
+            base_model = model_cache.get(self.get_model_key(base_stmts))
+            if base_model is not None:
+                try:
+                    model = assemble_pysb_incremental(
+                        base_model, base_stmts, stmts,
+                        policies=self.default_policy,
+                        initial_amount=self.default_initial_amount)
+                except Exception as e:
+                    logger.warning('Could not assemble model incrementally')
+                    logger.exception(e)
+        if model is None:
+            model = assemble_pysb(stmts, policies=self.default_policy,
+                                  initial_amount=self.default_initial_amount)
+        return model_cache.put(key, model)
+
+    def get_model_key(self, stmts, **kwargs):
+        """Return a key of the content of the model assembled from stmts,
+        extended by any further settings given as kwargs."""
+        return make_model_key(stmts, assemble_pysb,
+                              policies=self.default_policy,
+                              initial_amount=self.default_initial_amount,
+                              **kwargs)
+
+    def make_diagrams(self, model_exec, model_id):
+        """Return the diagrams of a model version, see make_diagrams.
+
+        Diagrams are cached by the content of the model and the cell line
+        used to color the SBGN, so a model version identical to a previous
+        one reuses its diagrams. Image files are named by the same key.
+        """
+        stmts = self.models[model_id]
+        key = self.get_model_key(stmts,
+                                 cell_line=get_cell_line(self.context))
+        return diagram_cache.get_diagrams(
+            key, lambda: make_diagrams(model_exec, key[:16], stmts,
+                                       self.context,
+                                       lazy=self.lazy_diagrams))
 
     # BUILD / EXPAND / REMOVE / UNDO
 
@@ -76,8 +192,7 @@ class MRA(object):
         res['ambiguities'] = ambiguities
         model_exec = self.assemble_pysb(stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id,
-                                        self.models[model_id], self.context)
+        res['diagrams'] = self.make_diagrams(model_exec, model_id)
         self.run_diagnoser(res, stmts, model_exec)
         return res
 
@@ -94,8 +209,7 @@ class MRA(object):
             return res
         model_exec = self.assemble_pysb(stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id,
-                                        self.models[model_id], self.context)
+        res['diagrams'] = self.make_diagrams(model_exec, model_id)
         self.run_diagnoser(res, stmts, model_exec)
         return res
 
@@ -116,11 +230,10 @@ class MRA(object):
         ambiguities = get_ambiguities(tp)
         res['ambiguities'] = ambiguities
         res['model_new'] = new_stmts
-        model_exec = self.assemble_pysb(model_stmts)
+        model_exec = self.assemble_pysb(model_stmts,
+                                        self.models.get(model_id))
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
+        res['diagrams'] = self.make_diagrams(model_exec, new_model_id)
         self.run_diagnoser(res, model_stmts, model_exec)
         return res
 
@@ -140,71 +253,64 @@ class MRA(object):
         if not model_stmts:
             return res
         res['model_new'] = new_stmts
-        model_exec = self.assemble_pysb(model_stmts)
+        model_exec = self.assemble_pysb(model_stmts,
+                                        self.models.get(model_id))
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
+        res['diagrams'] = self.make_diagrams(model_exec, new_model_id)
         self.run_diagnoser(res, model_stmts, model_exec)
         return res
 
     def extend_model(self, new_stmts, model_id):
-        # Lists to keep track of types of statements by their
-        # relation compared to the old set of statements
+        # Sets of (the ids of) statements to keep track of types of
+        # statements by their relation compared to the old set of statements
         old_stmts = self.models[model_id]
-        stmts_old_to_propagate = []
-        stmts_old_matched = []
-        stmts_old_refined = []
-        stmts_old_refinement = []
-        stmts_new_to_add = []
-        stmts_new_refined = []
-        stmts_new_matched = []
-        # Look at each old statement and determine the relationship
-        # of each new statement with respect to it
-        for ost in old_stmts:
-            for nst in new_stmts:
-                # The old and the new statements are exact matches
-                # We propagate the old one
-                if ost.matches(nst):
-                    if ost not in stmts_old_matched:
-                        stmts_old_matched.append(ost)
-                    if nst not in stmts_new_matched:
-                        stmts_new_matched.append(nst)
-                # The old statement is a refinement of the new one
-                # We propagate the old one
-                elif ost.refinement_of(nst, bio_ontology):
-                    if ost not in stmts_old_refinement:
-                        stmts_old_refinement.append(ost)
-                    if nst not in stmts_new_refined:
-                        stmts_new_refined.append(nst)
+        stmts_old_refined = set()
+        stmts_new_related = set()
+        # For each new statement that refines an old one, the index of the
+        # first old statement it refines
+        stmts_new_refining = {}
+        # Only pairs of old and new statements that could be related
+        # according to the index are compared
+        old_index = self.get_refinement_index(model_id)
+        for nidx, nst in enumerate(new_stmts):
+            for oidx in old_index.get_related_indices(nst):
+                ost = old_stmts[oidx]
+                # The old and the new statements are exact matches, or the
+                # old statement is a refinement of the new one. We propagate
+                # the old one.
+                if ost.matches(nst) or ost.refinement_of(nst, bio_ontology):
+                    stmts_new_related.add(id(nst))
                 # The new statement is a refinement of the old one
                 # We add the new statement and don't propagate the old one
                 elif nst.refinement_of(ost, bio_ontology):
-                    if ost not in stmts_old_refined:
-                        stmts_old_refined.append(ost)
-                    if nst not in stmts_new_to_add:
-                        stmts_new_to_add.append(nst)
-                # Otherwise there is no relation so the old statement
-                # won't be added to any of the lists above for this
-                # new statement
-            # Unless the old statement is refined, it is propagated
-            if ost not in stmts_old_refined:
-                stmts_old_to_propagate.append(ost)
-
-        # Add any new Statement that has not already been added
-        # or is not matched or refined by an old statement
+                    stmts_old_refined.add(id(ost))
+                    stmts_new_related.add(id(nst))
+                    stmts_new_refining.setdefault(id(nst), (oidx, nidx, nst))
+                # Otherwise there is no relation between the two statements
+        # Unless the old statement is refined, it is propagated
+        stmts_old_to_propagate = [ost for ost in old_stmts
+                                  if id(ost) not in stmts_old_refined]
+        # New statements that refine an old one are added in the order in
+        # which they are first found to refine an old statement, followed by
+        # any new statement that is not matched or refined by an old one.
+        stmts_new_to_add = [nst for _, _, nst in
+                            sorted(stmts_new_refining.values(),
+                                   key=lambda x: x[:2])]
+        added = set(stmts_new_refining)
         for nst in new_stmts:
-            if nst not in stmts_new_refined + stmts_new_matched + \
-                    stmts_new_to_add:
+            if id(nst) not in stmts_new_related and id(nst) not in added:
                 stmts_new_to_add.append(nst)
+                added.add(id(nst))
 
         logger.debug('Statements to propagate: %s' % stmts_old_to_propagate)
         logger.debug('Statements to add: %s' % stmts_new_to_add)
         new_model_id = self.get_new_id()
-        self.models[new_model_id] = stmts_old_to_propagate + stmts_new_to_add
+        self.add_model_version(new_model_id,
+                               stmts_old_to_propagate + stmts_new_to_add,
+                               model_id)
         # FIXME: Would undo-s work after a refinement?
-        self.transformations.append(('add_stmts', stmts_new_to_add, model_id,
-                                     new_model_id))
+        self.add_transformation(('add_stmts', stmts_new_to_add, model_id,
+                                 new_model_id))
         return new_model_id, stmts_new_to_add
 
     def remove_mechanism(self, mech_js, model_id):
@@ -216,30 +322,32 @@ class MRA(object):
         logger.info('Removing statements: %s' % rem_stmts)
 
         model_stmts = self.models[model_id]
+        index = self.get_refinement_index(model_id)
         # Statements that are matched in the model and will be removed
-        stmts_old_to_remove = []
+        old_to_remove_ids = set()
         # Statements to be removed that are matched in the model
-        stmts_rem_matched = []
-        for ost in model_stmts:
-            for rst in rem_stmts:
+        rem_matched_ids = set()
+        for rst in rem_stmts:
+            for ost in index.get_refinements_of(rst):
                 if ost.refinement_of(rst, bio_ontology):
-                    if ost not in stmts_old_to_remove:
-                        stmts_old_to_remove.append(ost)
-                    if rst not in stmts_rem_matched:
-                        stmts_rem_matched.append(rst)
+                    old_to_remove_ids.add(id(ost))
+                    rem_matched_ids.add(id(rst))
+        stmts_old_to_remove = _unique([st for st in model_stmts
+                                       if id(st) in old_to_remove_ids])
         # Statements that to be removed that didn't have any matching
         # Statements in the model
-        stmts_rem_unmatched = [st for st in rem_stmts if st not in
-                               stmts_rem_matched]
+        stmts_rem_unmatched = [st for st in rem_stmts if id(st) not in
+                               rem_matched_ids]
         # Statements in the model that weren't matched by and to-remove
         # Statements and therefore remain in the model.
-        stmts_old_propagate = [st for st in model_stmts if st not in
-                               stmts_old_to_remove]
+        stmts_old_propagate = [st for st in model_stmts if id(st) not in
+                               old_to_remove_ids]
         # Make a new model ID
         # FIXME: this should result in a proper remove transformation added
         #  to the set of transformations.
-        new_model_id = self.new_model(stmts_old_propagate)
-        model_exec = self.assemble_pysb(self.models[new_model_id])
+        new_model_id = self.new_model(stmts_old_propagate, model_id)
+        model_exec = self.assemble_pysb(self.models[new_model_id],
+                                        model_stmts)
         res = {'model_id': new_model_id, 'model': self.models[new_model_id],
                'model_exec': model_exec}
         if stmts_old_to_remove:
@@ -247,16 +355,13 @@ class MRA(object):
         if stmts_rem_unmatched:
             res['remove_unmatched'] = stmts_rem_unmatched
         if self.models[new_model_id]:
-            res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                            self.models[new_model_id],
-                                            self.context)
+            res['diagrams'] = self.make_diagrams(model_exec, new_model_id)
         return res
 
     def model_undo(self):
         """Revert to the previous model version."""
         # Figure out what the last forward action was, if any
-        forward_action = self.transformations.pop() if self.transformations \
-            else None
+        forward_action = self.pop_transformation()
         # Handle the case that there are no previous transformations (left).
         if not forward_action:
             return {'model_id': None, 'model': [],
@@ -277,7 +382,7 @@ class MRA(object):
             new_model_id = self.get_new_id()
             stmts = self.models[old_model_id] \
                 if old_model_id is not None else []
-            self.models[new_model_id] = stmts
+            self.add_model_version(new_model_id, stmts, old_model_id)
             undo_action = {'action': 'remove_stmts', 'statements': stmts_added}
 
         res = {'model_id': new_model_id,
@@ -288,47 +393,144 @@ class MRA(object):
         if not stmts:
             return res
         res['ambiguities'] = []
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
+        res['diagrams'] = self.make_diagrams(model_exec, new_model_id)
         return res
 
-    def new_model(self, stmts):
+    def new_model(self, stmts, base_id=None):
         model_id = self.get_new_id()
-        self.models[model_id] = stmts
-        self.transformations.append(('add_stmts', stmts, None, model_id))
+        self.add_model_version(model_id, stmts, base_id)
+        self.add_transformation(('add_stmts', stmts, None, model_id))
         return model_id
 
+    def add_model_version(self, model_id, stmts, base_id=None):
+        """Store the statements of a new model version.
+
+        If base_id is given, the version is stored as a difference from the
+        statements of that version. Transformations referring to versions
+        that are no longer kept are dropped since they can't be undone.
+        """
+        self.models.add(model_id, stmts, base_id)
+        self.transformations = [
+            tr for tr in self.transformations
+            if tr[3] in self.models and
+            (tr[2] is None or tr[2] in self.models)]
+        if self.session is not None:
+            self.session.add_version(model_id, stmts, base_id)
+            self.session.retain_versions(self.models.keys())
+        logger.debug('Model versions: %s' % self.models.get_memory_usage())
+
+    def add_transformation(self, transformation):
+        """Append a transformation that can be undone.
+
+        A transformation is a tuple of its type, the statements it added,
+        and the IDs of the model versions before and after it. It is
+        dropped if the version before it is no longer kept, e.g., if adding
+        the version after it discarded it.
+        """
+        old_id = transformation[2]
+        if old_id is not None and old_id not in self.models:
+            return
+        self.transformations.append(transformation)
+        if self.session is not None:
+            self.session.add_transformation(transformation)
+
+    def pop_transformation(self):
+        """Remove and return the last transformation, None if there is
+        none."""
+        if not self.transformations:
+            return None
+        if self.session is not None:
+            self.session.pop_transformation()
+        return self.transformations.pop()
+
+    def restore_session(self, session):
+        """Restore the state of a session recorded in a SessionStore.
+
+        Model versions, transformations, the explanation goal and the
+        context are restored without assembling any model, and the journal
+        is compacted to the restored state. If the model of the latest
+        version is in the model cache, e.g., on disk, it is loaded so that
+        it is ready for the next request.
+        """
+        for change in session.load():
+            if change[0] == 'version':
+                _, model_id, stmts, base_id = change
+                self.add_model_version(model_id, stmts, base_id)
+                self.id_counter = max(self.id_counter, model_id)
+            elif change[0] == 'push':
+                self.add_transformation(change[1])
+            elif change[0] == 'pop':
+                self.pop_transformation()
+            elif change[0] == 'goal':
+                _, self.explain, self.context = change
+        session.retain_versions(self.models.keys())
+        session.compact()
+        if self.id_counter in self.models:
+            model_cache.get(self.get_model_key(self.models[self.id_counter]))
+        logger.info('Restored session with %d model versions and %d '
+                    'transformations' % (len(self.models),
+                                         len(self.transformations)))
+
+    def get_memory_usage(self):
+        """Return statistics about the memory used by model versions."""
+        usage = self.models.get_memory_usage()
+        usage['num_transformations'] = len(self.transformations)
+        usage['transformation_stmt_refs'] = \
+            sum(len(tr[1]) for tr in self.transformations)
+        return usage
+
     # MODEL DIAGNOSIS
 
     def run_diagnoser(self, res, model_stmts, model_exec):
         # Use a model diagnoser to identify explanations given the executable
         # model, the current statements, and the explanation goal
         if self.explain:
-            md = ModelDiagnoser(model_stmts, model=model_exec,
-                                explain=self.explain)
-            md_result = md.check_explanation()
-            res.update(md_result)
-            # If we got a proposal for a statement, get a specific
-            # recommendation
-            connect_stmts = res.get('connect_stmts')
-            if connect_stmts:
-                u_stmt, v_stmt = connect_stmts
-                stmt_suggestions, sugg_subj, sugg_obj = \
-                    md.suggest_statements(u_stmt, v_stmt)
-                if stmt_suggestions:
-                    agents = [a.name for a in stmt_suggestions[0].agent_list()
-                              if a is not None]
-                    if len(set(agents)) > 1:
-                        res['stmt_suggestions'] = stmt_suggestions
-                        res['stmt_suggestions_subj'] = sugg_subj
-                        res['stmt_suggestions_obj'] = sugg_obj
-        md = ModelDiagnoser(model_stmts)
+            res.update(self.get_explanation(model_stmts, model_exec))
+        md = ModelDiagnoser(model_stmts, activity_index=self.activity_index)
         acts = md.get_missing_activities()
         if acts:
             logger.info('Missing activities found: %s' % acts)
             res['stmt_corrections'] = acts
 
+    def get_explanation(self, model_stmts, model_exec):
+        """Return how a model explains the explanation goal.
+
+        Checking a model builds its influence map, so results are cached
+        by the content of the model and of the explanation goal, and a
+        model identical to a previous one, e.g., after an undo, or an
+        unchanged model with the same goal reuse the previous result.
+        """
+        key = (self.get_model_key(model_stmts),
+               get_stmts_fingerprint([self.explain]))
+        cached = self.explanations.get(key)
+        if cached is not None:
+            self.explanations.move_to_end(key)
+            logger.info('Reusing the diagnosis of an identical model.')
+            return cached
+        res = {}
+        md = ModelDiagnoser(model_stmts, model=get_writable(model_exec),
+                            explain=self.explain)
+        md_result = md.check_explanation()
+        res.update(md_result)
+        # If we got a proposal for a statement, get a specific
+        # recommendation
+        connect_stmts = res.get('connect_stmts')
+        if connect_stmts:
+            u_stmt, v_stmt = connect_stmts
+            stmt_suggestions, sugg_subj, sugg_obj = \
+                md.suggest_statements(u_stmt, v_stmt)
+            if stmt_suggestions:
+                agents = [a.name for a in stmt_suggestions[0].agent_list()
+                          if a is not None]
+                if len(set(agents)) > 1:
+                    res['stmt_suggestions'] = stmt_suggestions
+                    res['stmt_suggestions_subj'] = sugg_subj
+                    res['stmt_suggestions_obj'] = sugg_obj
+        self.explanations[key] = res
+        while len(self.explanations) > self.max_explanations:
+            self.explanations.popitem(last=False)
+        return res
+
     def has_mechanism(self, mech_json, model_id):
         """Return True if the given model contains the given mechanism."""
         stmts = stmts_from_json(json.loads(mech_json))
@@ -338,8 +540,8 @@ class MRA(object):
             return res
         query_st = stmts[0]
         res['query'] = query_st
-        model_stmts = self.models[model_id]
-        for model_st in model_stmts:
+        index = self.get_refinement_index(model_id)
+        for model_st in index.get_refinements_of(query_st):
             if model_st.refinement_of(query_st, bio_ontology):
                 res['has_mechanism'] = True
                 return res
@@ -363,6 +565,8 @@ class MRA(object):
         context = explain.evidence[0].context
         if context and context.cell_line:
             self.context = context.cell_line.name
+        if self.session is not None:
+            self.session.set_goal(self.explain, self.context)
 
     def replace_agent(self, agent_name, agent_replacement_names, model_id):
         """Replace an agent in a model with other agents.
@@ -399,6 +603,17 @@ class MRA(object):
         return model
 
 
+def _unique(stmts):
+    """Return the statements without repeated objects, keeping the order."""
+    seen = set()
+    unique = []
+    for stmt in stmts:
+        if id(stmt) not in seen:
+            seen.add(id(stmt))
+            unique.append(stmt)
+    return unique
+
+
 def get_ambiguities(tp):
     terms = tp.tree.findall('TERM')
     all_ambiguities = {}
@@ -410,49 +625,165 @@ def get_ambiguities(tp):
     return all_ambiguities
 
 
-def make_diagrams(pysb_model, model_id, current_model, context=None):
+def assemble_pysb(stmts, policies, initial_amount):
+    """Return a PySB model assembled from a list of statements."""
+    pa = PysbAssembler()
+    pa.add_statements(stmts)
+    pa.make_model(policies=policies)
+    pa.add_default_initial_conditions(initial_amount)
+    return pa.model
+
+
+def make_diagrams(pysb_model, model_id, current_model, context=None,
+                  lazy=False, renderer=None):
+    """Return the diagrams of a model, rendered in parallel.
+
+    Parameters
+    ----------
+    pysb_model : pysb.Model
+        The assembled model. It isn't modified, the diagrams are drawn on
+        a copy if the model is shared through the model cache.
+    model_id : int or str
+        The ID of the model, used to name the image files.
+    current_model : list[indra.statements.Statement]
+        The statements of the model, used to color the SBGN.
+    context : Optional[str]
+        The cell line context used to color the SBGN.
+    lazy : Optional[bool]
+        If True, each diagram is only rendered when it is first accessed.
+        Default: False
+    renderer : Optional[bioagents.mra.diagrams.DiagramRenderer]
+        The pool of workers rendering the diagrams. By default, a pool
+        shared by the process is used.
+
+    Returns
+    -------
+    diagrams : bioagents.mra.diagrams.Diagrams
+        A mapping from the diagram types 'reactionnetwork', 'contactmap',
+        'influencemap' and 'sbgn' to the path of the image or the SBGN
+        XML, accessing which blocks until the diagram is rendered.
+    """
+    model = _DiagramModel(pysb_model)
+    jobs = [('reactionnetwork', lambda: model.draw(draw_reaction_network,
+                                                   model_id, bng=True)),
+            ('contactmap', lambda: model.draw(draw_contact_map, model_id)),
+            ('influencemap', lambda: model.draw(draw_influence_map,
+                                                model_id)),
+            ('sbgn', lambda: model.draw(make_colored_sbgn, model_id,
+                                        current_model, context, bng=True))]
+    return Diagrams(jobs, renderer or diagram_renderer, lazy=lazy)
+
+
+class _DiagramModel(object):
+    """A model shared by the jobs drawing its diagrams.
+
+    A writable copy of the model with extended initial conditions (needed
+    to draw the reactions of modified forms) is made once, when the first
+    diagram is drawn. The reaction network is generated with BNG once,
+    by the first job that needs it, and is then shared by the SBGN export
+    and the rendering of the reaction network. Generating the network adds
+    species, reactions and initial conditions to the model, so the jobs
+    exporting the model to Kappa draw from a second copy, made before any
+    job starts.
+    """
+    def __init__(self, pysb_model):
+        self._pysb_model = pysb_model
+        self._models = None
+        self._network_error = None
+        self._lock = threading.Lock()
+        self._bng_lock = threading.Lock()
+
+    def get(self, bng=False):
+        """Return the copy of the model for BNG jobs or for other jobs."""
+        with self._lock:
+            if self._models is None:
+                model = get_writable(self._pysb_model)
+                for m in model.monomers:
+                    pysb_assembler.set_extended_initial_condition(model,
+                                                                  m, 0)
+                self._models = (model, copy.deepcopy(model))
+        return self._models[0 if bng else 1]
+
+    def get_network(self):
+        """Return the model with its reaction network, or None if the
+        network could not be generated."""
+        model = self.get(bng=True)
+        with self._bng_lock:
+            if self._network_error is None:
+                try:
+                    generate_network(model)
+                except Exception as e:
+                    logger.error('Reaction network could not be generated.')
+                    logger.exception(e)
+                    self._network_error = e
+        return model if self._network_error is None else None
+
+    def draw(self, draw_func, *args, bng=False):
+        if not bng:
+            return draw_func(self.get(), *args)
+        model = self.get_network()
+        if model is None:
+            return None
+        return draw_func(model, *args)
+
+
+def make_colored_sbgn(pysb_model, model_id, current_model, context=None):
+    """Return the SBGN of a model colored by the cell line context."""
     sbgn = make_sbgn(pysb_model, model_id)
-    if sbgn is not None:
-        sbgn = sbgn.encode('utf-8')
-        if context:
-            try:
-                cell_line = ccle_map[context]
-            except KeyError:
-                logger.info('Could not find profile info for %s cell line' %
-                            context)
-                cell_line = DEFAULT_CELL_LINE
-        else:
-            cell_line = DEFAULT_CELL_LINE
+    if sbgn is None:
+        return None
+    sbgn = sbgn.encode('utf-8')
+    cell_line = get_cell_line(context)
+    try:
+        logger.info('Coloring SBGN to %s cell line.' % cell_line)
+        colorizer = SbgnColorizer(sbgn)
+        colorizer.set_style_expression_mutation(current_model,
+                                                cell_line=cell_line)
+        sbgn = colorizer.generate_xml()
+    except Exception as e:
+        logger.error('Could not set SBGN colors')
+        logger.error(e)
+    return sbgn
+
+
+def get_cell_line(context=None):
+    """Return the CCLE cell line of a context, or the default cell line."""
+    if context:
         try:
-            logger.info('Coloring SBGN to %s cell line.' % cell_line)
-            colorizer = SbgnColorizer(sbgn)
-            colorizer.set_style_expression_mutation(current_model,
-                                                    cell_line=cell_line)
-            sbgn = colorizer.generate_xml()
-        except Exception as e:
-            logger.error('Could not set SBGN colors')
-            logger.error(e)
-
-    rxn = draw_reaction_network(pysb_model, model_id)
-    cm = draw_contact_map(pysb_model, model_id)
-    im = draw_influence_map(pysb_model, model_id)
-    diagrams = {'reactionnetwork': rxn, 'contactmap': cm,
-                'influencemap': im, 'sbgn': sbgn}
-    return diagrams
+            return ccle_map[context]
+        except KeyError:
+            logger.info('Could not find profile info for %s cell line' %
+                        context)
+    return DEFAULT_CELL_LINE
 
 
 def make_pic_name(model_id, token):
     """Create a standardized picture name."""
-    s = 'model%d_%s' % (model_id, token)
+    s = 'model%s_%s' % (model_id, token)
     return get_img_path(s)
 
 
+def generate_network(pysb_model):
+    """Generate the reaction network of a model with BNG unless it exists.
+
+    Initial conditions are set for the modified forms of all monomers so
+    that the reactions involving them are part of the network. PySB stores
+    the network (species and reactions) on the model, and exporters that
+    need it, like the SBGN export and the reaction network rendering,
+    reuse it instead of running BNG again.
+    """
+    if pysb_model.reactions:
+        return
+    for m in pysb_model.monomers:
+        pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+    generate_equations(pysb_model)
+
+
 def make_sbgn(pysb_model, model_id):
     pa = PysbAssembler()
     pa.model = pysb_model
-    for m in pysb_model.monomers:
-        pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
     try:
+        generate_network(pysb_model)
         sbgn_str = pa.export_model('sbgn')
     except BngInterfaceError:
         logger.error('Reaction network could not be generated for SBGN.')
@@ -505,8 +836,7 @@ def make_contact_map(pysb_model):
 def draw_reaction_network(pysb_model, model_id):
     """Generate a PySB/BNG reaction network as a PNG file."""
     try:
-        for m in pysb_model.monomers:
-            pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+        generate_network(pysb_model)
         diagram_dot = render_reactions.run(pysb_model)
     # TODO: use specific PySB/BNG exceptions and handle them
     # here to show meaningful error messages
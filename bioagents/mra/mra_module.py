@@ -3,7 +3,8 @@ import sys
 import json
 import random
 import logging
-from threading import Thread
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import pysb.export
 
@@ -21,6 +22,8 @@ logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
 logger = logging.getLogger('MRA')
 
 from bioagents import Bioagent, BioagentException
+from bioagents.settings import MRA_SESSION_DIR, MRA_MAX_VERSIONS, \
+    MRA_SPILL_DIR
 from .mra import MRA
 
 
@@ -41,7 +44,12 @@ class MRA_Module(Bioagent):
 
     def __init__(self, **kwargs):
         # Instantiate a singleton MRA agent
-        self.mra = MRA()
+        # Diagrams are only rendered if they are displayed, and the session
+        # is restored if the agent is restarted
+        self.mra = MRA(max_versions=MRA_MAX_VERSIONS,
+                       spill_dir=MRA_SPILL_DIR, lazy_diagrams=True,
+                       session_dir=MRA_SESSION_DIR)
+        self._send_lock = Lock()
         super(MRA_Module, self).__init__(**kwargs)
         self.have_explanation = False
 
@@ -109,10 +117,10 @@ class MRA_Module(Bioagent):
         diagrams = res.get('diagrams')
         if not no_display:
             if diagrams:
+                self.send_display_model(diagrams)
                 rxn_diagram = diagrams.get('reactionnetwork')
                 if rxn_diagram:
                     msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
 
         # Indicate whether the goal has been explained
         has_expl = res.get('has_explanation')
@@ -206,10 +214,10 @@ class MRA_Module(Bioagent):
         if not no_display:
             diagrams = res.get('diagrams')
             if diagrams:
+                self.send_display_model(diagrams)
                 rxn_diagram = diagrams.get('reactionnetwork')
                 if rxn_diagram:
                     msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
         # Analyze the model for issues
 
         # Report ambiguities
@@ -253,10 +261,10 @@ class MRA_Module(Bioagent):
         diagrams = res.get('diagrams')
         if not no_display:
             if diagrams:
+                self.send_display_model(diagrams)
                 rxn_diagram = diagrams.get('reactionnetwork')
                 if rxn_diagram:
                     msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
         return msg
 
     def respond_model_has_mechanism(self, content):
@@ -322,10 +330,10 @@ class MRA_Module(Bioagent):
         logger.info(diagrams)
         if not no_display:
             if diagrams:
+                self.send_display_model(diagrams)
                 rxn_diagram = diagrams.get('reactionnetwork')
                 if rxn_diagram:
                     msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
         return msg
 
     def respond_model_get_upstream(self, content):
@@ -441,6 +449,8 @@ class MRA_Module(Bioagent):
         return diagnostic_tells
 
     def send_display_model(self, diagrams):
+        # Start rendering all diagrams in parallel before waiting for any
+        diagrams.render()
         for diagram_type, resource in diagrams.items():
             if not resource:
                 continue
@@ -454,6 +464,12 @@ class MRA_Module(Bioagent):
                 content.sets('path', resource)
             self.tell(content)
 
+    def send(self, msg):
+        # Support is sent from the threads of the support queries so sending
+        # has to be serialized
+        with self._send_lock:
+            super(MRA_Module, self).send(msg)
+
     def send_clean_model(self):
         msg = KQMLPerformative('request')
         content = KQMLList('clean-model')
@@ -461,35 +477,41 @@ class MRA_Module(Bioagent):
         self.send(msg)
 
     def send_background_support(self, stmts):
+        """Send the support of statements from the database as it arrives.
+
+        Statements that would result in the same query share it, and the
+        queries are run concurrently on a bounded pool, so this returns
+        right away.
+        """
         logger.info('Sending support for %d statements' % len(stmts))
+        for_what = 'the mechanism you added'
+
+        def send_support(stmt, future):
+            try:
+                idp = future.result()
+                matched = idp.statements
+                logger.info("Found %d statements supporting %s"
+                            % (len(matched), stmt))
+            except Exception as e:
+                logger.error("Got exception while looking for support for "
+                             "%s" % stmt)
+                logger.exception(e)
+                self.send_null_provenance(stmt, for_what,
+                                          'due to an internal error')
+                return
+            if matched:
+                ev_totals = {int(k): v for k, v in
+                             idp.get_ev_counts().items()}
+                self.send_provenance_for_stmts(matched, for_what,
+                    ev_counts=ev_totals,
+                    source_counts=idp.get_source_counts())
+            else:
+                self.send_null_provenance(stmt, for_what)
 
-        def send_support():
-            for_what = 'the mechanism you added'
-            for stmt in stmts:
-                try:
-                    idp = _get_matching_stmts(stmt)
-                    matched = idp.statements
-                    logger.info("Found %d statements supporting %s"
-                                % (len(matched), stmt))
-                except Exception as e:
-                    logger.error("Got exception while looking for support for "
-                                 "%s" % stmt)
-                    logger.exception(e)
-                    self.send_null_provenance(stmt, for_what,
-                                              'due to an internal error')
-                    continue
-                if matched:
-                    ev_totals = {int(k): v for k, v in
-                                 idp.get_ev_counts().items()}
-                    self.send_provenance_for_stmts(matched, for_what,
-                        ev_counts=ev_totals,
-                        source_counts=idp.get_source_counts())
-                else:
-                    self.send_null_provenance(stmt, for_what)
-
-        th = Thread(target=send_support)
-        th.start()
-        th.join(2)
+        for stmt in stmts:
+            future = support_queries.submit(stmt)
+            future.add_done_callback(
+                lambda f, stmt=stmt: send_support(stmt, f))
         return
 
     def _get_model_id(self, content):
@@ -600,9 +622,54 @@ def _get_agent_ref(agent):
     return '%s@%s' % (agent.name, 'TEXT')
 
 
-def _get_matching_stmts(stmt_ref):
-    if not CAN_CHECK_STATEMENTS:
-        return []
+class SupportQueries(object):
+    """Run queries for the support of statements on a bounded pool.
+
+    Statements of the same type with the same agent references result in
+    the same query, which is only run once while it is in progress.
+
+    Parameters
+    ----------
+    max_workers : Optional[int]
+        The number of queries run at the same time. Default: 8
+    """
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = Lock()
+
+    def submit(self, stmt):
+        """Return a Future of the query for the support of a statement."""
+        try:
+            key = _get_query_key(stmt)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+            future = self.executor.submit(_get_matching_stmts, stmt)
+            self._futures[key] = future
+        # Registered outside of the lock since it is called right away if
+        # the query is already done
+        future.add_done_callback(lambda f: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._futures.pop(key, None)
+
+
+def _get_query_key(stmt_ref):
+    """Return a key that is the same for statements with the same query."""
+    stmt_type, kwargs = _get_query_kwargs(stmt_ref)
+    return stmt_type, tuple(sorted((k, tuple(v) if isinstance(v, list)
+                                    else v) for k, v in kwargs.items()))
+
+
+def _get_query_kwargs(stmt_ref):
     # Filter by statement type.
     stmt_type = stmt_ref.__class__.__name__
     agent_name_list = [_get_agent_ref(ag) for ag in stmt_ref.agent_list()]
@@ -616,11 +683,22 @@ def _get_matching_stmts(stmt_ref):
         if not any(kwargs.values()):
             raise BioagentException('Either subject or object must be '
                                     'something other than None.')
+    return stmt_type, kwargs
+
+
+def _get_matching_stmts(stmt_ref):
+    if not CAN_CHECK_STATEMENTS:
+        return []
+    stmt_type, kwargs = _get_query_kwargs(stmt_ref)
     kwargs['ev_limit'] = 2
     kwargs['persist'] = False
     return get_statements(stmt_type=stmt_type, **kwargs)
 
 
+# Queries shared by all MRA modules in this process
+support_queries = SupportQueries()
+
+
 _resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/../resources/'
 
 if __name__ == "__main__":
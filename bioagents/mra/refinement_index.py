@@ -0,0 +1,170 @@
+"""An index of Statements that finds candidates for refinement relations.
+
+Checking whether one Statement is a refinement of another is costly, and
+comparing every pair of Statements in two lists grows quadratically with
+the size of a model. A refinement relation can only hold between
+Statements of the same type whose agents are either the same entity or
+related in the ontology (by isa or partof). The index therefore keys
+Statements by their type and by the entities (and the ontology ancestors
+of the entities) of their agents, so that only the pairs of Statements
+that could refine each other need to be compared with `refinement_of`.
+"""
+
+import networkx
+from indra.statements import Modification, SelfModification, \
+    RegulateActivity, RegulateAmount, ActiveForm, HasActivity, Gef, Gap, \
+    Translocation, Complex
+
+
+# Statement types whose agents are only compared position by position
+POSITIONAL_TYPES = (Modification, SelfModification, RegulateActivity,
+                    RegulateAmount, ActiveForm, HasActivity, Gef, Gap,
+                    Translocation)
+# Statement types whose agents are compared in any order
+UNORDERED_TYPES = (Complex,)
+
+
+class RefinementIndex(object):
+    """Index a list of Statements to look up refinement candidates.
+
+    The candidates returned by the index are a superset of the Statements
+    that are actually related to a given Statement, the relation still has
+    to be checked with `refinement_of`. Statements of types whose
+    refinement relation isn't known to be based on their agents are
+    returned as candidates for any Statement of the same type.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The Statements to index.
+    ontology : indra.ontology.IndraOntology
+        The ontology used to check refinements.
+    closures : Optional[dict]
+        A dict in which the ontology ancestors of entities are cached,
+        which can be shared by several indices.
+    """
+    def __init__(self, stmts, ontology, closures=None):
+        self.stmts = list(stmts)
+        self.ontology = ontology
+        self.closures = closures if closures is not None else {}
+        # The indices of Statements by type
+        self._by_type = {}
+        # The indices of Statements by (type, position, key) where key is an
+        # entity or an ancestor of the entity of the agent at the position
+        self._by_closure = {}
+        # The indices of Statements by (type, position, key) where key is
+        # the entity of the agent at the position
+        self._by_key = {}
+        # The entities of the members of unordered Statements
+        self._member_keys = {}
+        for idx, stmt in enumerate(self.stmts):
+            self._add(idx, stmt)
+
+    def __len__(self):
+        return len(self.stmts)
+
+    def _add(self, idx, stmt):
+        stmt_type = type(stmt)
+        self._by_type.setdefault(stmt_type, set()).add(idx)
+        for pos, agent in _get_agent_positions(stmt):
+            if agent is None:
+                self._by_key.setdefault((stmt_type, pos, None),
+                                        set()).add(idx)
+                continue
+            key = agent.entity_matches_key()
+            self._by_key.setdefault((stmt_type, pos, key), set()).add(idx)
+            for anc_key in self.get_closure(agent):
+                self._by_closure.setdefault((stmt_type, pos, anc_key),
+                                            set()).add(idx)
+        if isinstance(stmt, UNORDERED_TYPES):
+            self._member_keys[idx] = {agent.entity_matches_key() for agent
+                                      in stmt.agent_list()
+                                      if agent is not None}
+
+    def get_closure(self, agent):
+        """Return the keys of an agent's entity and its ancestors."""
+        key = agent.entity_matches_key()
+        closure = self.closures.get(key)
+        if closure is None:
+            closure = {key}
+            db_ns, db_id = agent.get_grounding()
+            if db_ns and db_id:
+                try:
+                    parents = self.ontology.get_parents(db_ns, db_id)
+                except networkx.NetworkXError:
+                    # The entity is not in the ontology
+                    parents = []
+                closure |= {str(tuple(parent)) for parent in parents}
+            self.closures[key] = closure
+        return closure
+
+    def get_refinements_of(self, stmt):
+        """Return the indexed Statements that could be refinements of stmt.
+
+        Returns
+        -------
+        candidates : list[indra.statements.Statement]
+            The candidate Statements, in the order in which they were
+            indexed.
+        """
+        return self._get_stmts(self._get_refinements_of(stmt))
+
+    def get_refined_by(self, stmt):
+        """Return the indexed Statements that stmt could be a refinement of.
+
+        Returns
+        -------
+        candidates : list[indra.statements.Statement]
+            The candidate Statements, in the order in which they were
+            indexed.
+        """
+        return self._get_stmts(self._get_refined_by(stmt))
+
+    def get_related_indices(self, stmt):
+        """Return the indices of Statements that could match or refine stmt,
+        or be refined by it, in increasing order."""
+        return sorted(self._get_refinements_of(stmt) |
+                      self._get_refined_by(stmt))
+
+    def _get_refinements_of(self, stmt):
+        stmt_type = type(stmt)
+        candidates = self._by_type.get(stmt_type, set())
+        for pos, agent in _get_agent_positions(stmt):
+            # Any agent refines a missing agent
+            if agent is None:
+                continue
+            key = agent.entity_matches_key()
+            candidates = candidates & \
+                self._by_closure.get((stmt_type, pos, key), set())
+        return candidates
+
+    def _get_refined_by(self, stmt):
+        stmt_type = type(stmt)
+        candidates = self._by_type.get(stmt_type, set())
+        if isinstance(stmt, UNORDERED_TYPES):
+            closure = set()
+            for agent in stmt.agent_list():
+                if agent is not None:
+                    closure |= self.get_closure(agent)
+            return {idx for idx in candidates
+                    if self._member_keys[idx] <= closure}
+        for pos, agent in _get_agent_positions(stmt):
+            # A missing agent is only a refinement of a missing agent
+            matching = set(self._by_key.get((stmt_type, pos, None), set()))
+            if agent is not None:
+                for key in self.get_closure(agent):
+                    matching |= self._by_key.get((stmt_type, pos, key), set())
+            candidates = candidates & matching
+        return candidates
+
+    def _get_stmts(self, indices):
+        return [self.stmts[idx] for idx in sorted(indices)]
+
+
+def _get_agent_positions(stmt):
+    """Return (position, agent) pairs by which a Statement is indexed."""
+    if isinstance(stmt, POSITIONAL_TYPES):
+        return list(enumerate(stmt.agent_list()))
+    elif isinstance(stmt, UNORDERED_TYPES):
+        return [('*', agent) for agent in stmt.agent_list()]
+    return []
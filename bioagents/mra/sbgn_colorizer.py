@@ -1,17 +1,16 @@
 from lxml import etree
-import os
 import re
-import json
 import copy
 import logging
 import collections
+import numpy
 from matplotlib import cm
 from matplotlib import colors
 
 from indra.sources.indra_db_rest import get_statements
 from indra.ontology.bio import bio_ontology
-from indra.databases import context_client
 from indra.assemblers.pysb.assembler import _n
+from bioagents.mra.context_store import context_store
 
 
 logger = logging.getLogger('sbgn_colorizer')
@@ -20,6 +19,14 @@ logger = logging.getLogger('sbgn_colorizer')
 Style = collections.namedtuple('Style', ['border_color', 'fill_color'])
 
 
+def _get_stroke_color(mut_status):
+    """Return the stroke color of a gene given its mutations."""
+    if len(mut_status) > 0:
+        return '#ff0000'
+    else:
+        return '#555555'
+
+
 def is_mutation_activating(gene_name, mutation_status):
     """Checks the database for whether a mutation is activating.
 
@@ -62,7 +69,7 @@ class SbgnColorizer(object):
         from the node's label to the node's style
     """
 
-    def __init__(self, sbgn_text):
+    def __init__(self, sbgn_text, store=None):
         """Initializes colorizes with uncolorized sbgn generated from a pysb
         model.
 
@@ -71,6 +78,9 @@ class SbgnColorizer(object):
         sbgn_text: str
             The XML text of the original uncolorized SBGN-ML document generated
             from a pySB model
+        store: Optional[bioagents.mra.context_store.CellLineContextStore]
+            The store of expression and mutation data. By default, the store
+            shared by the process is used.
         """
         self.label_to_style = {}
         self.sbgn_text = sbgn_text
@@ -97,14 +107,8 @@ class SbgnColorizer(object):
             if 'id' in element.attrib:
                 self.element_ids.add(element.attrib['id'])
 
-        # Load caches
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                            '../resources/expression_cache.json'), 'r') as fh:
-
-            self.expr = json.load(fh)
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                            '../resources/mutation_cache.json'), 'r') as fh:
-            self.mut = json.load(fh)
+        # Expression and mutation data are shared by all colorizers
+        self.context_store = context_store if store is None else store
 
     def get_nodes(self):
         """Returns the labels of the nodes that can be colorized;
@@ -153,20 +157,10 @@ class SbgnColorizer(object):
             self.label_to_style[label] = Style(border_color, fill_color)
 
     def get_mutations(self, gene, cell_line):
-        if cell_line in self.mut:
-            mut = self.mut[cell_line].get(gene, [])
-            return {cell_line: {gene: mut}}
-        else:
-            return context_client.get_mutations([gene], [cell_line])
+        return self.context_store.get_mutations([gene], cell_line)
 
     def get_expression(self, genes, cell_line):
-        if cell_line in self.expr:
-            ret = {cell_line: {g: None for g in genes}}
-            for gene in genes:
-                ret[cell_line][gene] = self.expr[cell_line].get(gene, None)
-            return ret
-        else:
-            return context_client.get_protein_expression(genes, [cell_line])
+        return self.context_store.get_expression(genes, cell_line)
 
     def _choose_stroke_color_from_mutation_status(self, gene_name, cell_line):
         """Chooses the stroke color based on whether the gene is mutated
@@ -194,10 +188,7 @@ class SbgnColorizer(object):
         # if len(mut_status) > 0:
         #   is_activating = is_mutation_activating(gene_name, mut_status)
 
-        if len(mut_status) > 0:
-            return '#ff0000'
-        else:
-            return '#555555'
+        return _get_stroke_color(mut_status)
 
     def set_style_expression_mutation(self, model, cell_line='A375_SKIN'):
         """Sets the fill color of each node based on its expression level
@@ -211,86 +202,72 @@ class SbgnColorizer(object):
         cell_line: str
             A cell line for which we're interested in protein expression level
         """
-        labels = self.label_to_glyph_ids.keys()
-
-        label_to_agent = {}
-        for label in labels:
-            for statement in model:
-                for agent in statement.agent_list():
-                    if agent is not None and _n(agent.name) == label:
-                        label_to_agent[label] = agent
-
-        agent_to_expression_level = {}
-        for agent in label_to_agent.values():
+        # Index agents by their normalized names in a single pass, the last
+        # agent with a given name is used
+        name_to_agent = {}
+        for statement in model:
+            for agent in statement.agent_list():
+                if agent is not None:
+                    name_to_agent[_n(agent.name)] = agent
+        agents = [name_to_agent[label] for label in self.label_to_glyph_ids
+                  if label in name_to_agent]
+        if not agents:
+            return
+
+        # The genes whose expression is averaged for each agent, None for
+        # agents that aren't genes
+        agent_genes = []
+        for agent in agents:
             if 'HGNC' not in agent.db_refs and 'FPLX' not in agent.db_refs:
-                # This is not a gene
-                agent_to_expression_level[agent] = 0
-                continue
-
-            if 'FPLX' not in agent.db_refs:
-                gene_names = [agent.name]
+                agent_genes.append(None)
+            elif 'FPLX' not in agent.db_refs:
+                agent_genes.append([agent.name])
             else:
                 children = bio_ontology.get_children('FPLX',
                                                      agent.db_refs['FPLX'])
-                gene_names = [bio_ontology.get_name(*child) for child
-                              in children]
-
-            # Compute mean expression level
-            expression_levels = []
-            logger.info('Getting expression status of proteins: %s' %
-                        str(gene_names))
-            l = self.get_expression(gene_names, cell_line)
-            for line in l:
-                for element in l[line]:
-                    level = l[line][element]
-                    if level is not None:
-                        expression_levels.append(l[line][element])
-            if len(expression_levels) == 0:
-                mean_level = None
-            else:
-                mean_level = sum(expression_levels) / len(expression_levels)
-
-            agent_to_expression_level[agent] = mean_level
+                agent_genes.append([bio_ontology.get_name(*child) for child
+                                    in children])
+
+        # Fetch the expression and mutations of all genes at once
+        all_genes = sorted({gene for genes in agent_genes if genes
+                            for gene in genes})
+        logger.info('Getting expression status of proteins: %s' %
+                    str(all_genes))
+        expression = self.get_expression(all_genes, cell_line)[cell_line]
+        logger.info('Getting mutation status of proteins')
+        mutations = self.context_store.get_mutations(
+            sorted({agent.name for agent in agents}), cell_line)[cell_line]
+
+        # Compute the mean expression level of each agent, agents that
+        # aren't genes have a level of 0 and unknown levels are NaN
+        levels = numpy.full(len(agents), numpy.nan)
+        for idx, genes in enumerate(agent_genes):
+            if genes is None:
+                levels[idx] = 0
+                continue
+            gene_levels = [expression[gene] for gene in genes
+                           if expression.get(gene) is not None]
+            if gene_levels:
+                levels[idx] = sum(gene_levels) / len(gene_levels)
 
         # Create a normalized expression score between 0 and 1
-        # Compute min and maximum levels
-        min_level = None
-        max_level = None
-        for agent, level in agent_to_expression_level.items():
-            if level is None:
-                continue
-            if min_level is None:
-                min_level = level
-            if max_level is None:
-                max_level = level
-            if level < min_level:
-                min_level = level
-            if level > max_level:
-                max_level = level
-        # Compute scores
-        agent_to_score = {}
-        if max_level is not None:
-            level_span = max_level - min_level
-        for agent, level in agent_to_expression_level.items():
-            if level is None or level_span == 0:
-                agent_to_score[agent] = 0
-            else:
-                agent_to_score[agent] = (level - min_level) / level_span
+        known = ~numpy.isnan(levels)
+        scores = numpy.zeros(len(agents))
+        if known.any():
+            min_level = levels[known].min()
+            level_span = levels[known].max() - min_level
+            if level_span != 0:
+                scores[known] = (levels[known] - min_level) / level_span
 
         # Map scores to colors and assign colors to labels
-        agent_to_color = {}
-        for agent, score in agent_to_score.items():
-            if 'HGNC' not in agent.db_refs and 'FPLX' not in agent.db_refs:
-                color = cm.Blues(0.3)
-                color_str = colors.to_hex(color[:3])
-            else:
-                # color = cm.plasma(score)
-                color = cm.Greens(0.6*score + 0.2)
-                color_str = colors.to_hex(color[:3])
+        is_gene = numpy.array([genes is not None for genes in agent_genes])
+        fill_colors = numpy.where(is_gene[:, None],
+                                  cm.Greens(0.6 * scores + 0.2),
+                                  cm.Blues(numpy.full(len(agents), 0.3)))
+        for agent, fill_color in zip(agents, fill_colors):
+            color_str = colors.to_hex(fill_color[:3])
             assert(len(color_str) == 7)
-            stroke_color = \
-                    self._choose_stroke_color_from_mutation_status(agent.name,
-                                                                   cell_line)
+            stroke_color = _get_stroke_color(mutations[agent.name])
             self.set_style(agent.name, stroke_color, color_str)
 
     def generate_xml(self):
@@ -0,0 +1,354 @@
+"""A journal of the state of an MRA session that can be restored quickly.
+
+The state of the MRA (its model versions, the transformations that can be
+undone, the explanation goal and the cell line context) only lives in
+memory, so restarting the agent would otherwise mean replaying the whole
+dialogue, including assembling models and drawing diagrams. Instead, each
+change to the state is appended to a journal as it happens, and the state
+is restored on startup by replaying the journal without assembling
+anything.
+
+The journal is a file of JSON lines. Statements are stored once, keyed by
+a hash of their content (their JSON without their UUID), and referred to
+by hash everywhere else, so a statement shared by many model versions, or
+added again as the same mechanism, takes the space of one hash per
+version. Model versions are stored as the positions of the statements
+removed from their base version and the hashes of the statements appended
+to it, like in ModelVersionStore. Once the journal mostly consists of
+versions and transformations that were discarded or undone, it is
+rewritten with only the current state, so that its size, and the time it
+takes to restore it, is bounded by the state rather than by the length of
+the session. Assembled PySB models aren't part of the journal, they are
+found again by the content of their statements in the model cache (see
+bioagents.model_cache), which is kept on disk if MODEL_CACHE_DIR is set.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from indra.statements import stmts_from_json
+
+
+logger = logging.getLogger('session_store')
+
+
+class SessionStore(object):
+    """Record changes to the state of an MRA session and replay them.
+
+    Parameters
+    ----------
+    session_dir : str
+        The directory in which the journal of the session is kept. It is
+        created if needed.
+    min_compact : Optional[int]
+        The number of discarded or undone changes in the journal from
+        which it is compacted, once they also outnumber the changes that
+        make up the current state. Default: 32
+    """
+    def __init__(self, session_dir, min_compact=32):
+        self.session_dir = session_dir
+        if not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        self.path = os.path.join(session_dir, 'session.jsonl')
+        self.min_compact = min_compact
+        self._lock = threading.Lock()
+        # The hashes of statements by UUID, for statements already written
+        self._hashes = {}
+        # The hashes of the statements in the journal
+        self._written = set()
+        # The statement hashes and the base IDs of the current versions
+        self._versions = OrderedDict()
+        self._bases = {}
+        # The records of the current transformations and goal
+        self._transformations = []
+        self._goal = None
+        # The number of changes in the journal that are no longer part of
+        # the current state
+        self._num_garbage = 0
+
+    def add_version(self, model_id, stmts, base_id=None):
+        """Record a new model version, see ModelVersionStore.add."""
+        hashes = self._write_stmts(stmts)
+        self._write([self._make_version_record(model_id, hashes, base_id)])
+
+    def retain_versions(self, model_ids):
+        """Record that only the given model versions are kept.
+
+        Transformations referring to versions that are no longer kept are
+        dropped, like in MRA.add_model_version.
+        """
+        model_ids = set(model_ids)
+        for model_id in list(self._versions):
+            if model_id not in model_ids:
+                del self._versions[model_id]
+                self._bases.pop(model_id, None)
+                self._num_garbage += 1
+        transformations = [
+            tr for tr in self._transformations
+            if tr['new_id'] in self._versions and
+            (tr['old_id'] is None or tr['old_id'] in self._versions)]
+        self._num_garbage += \
+            len(self._transformations) - len(transformations)
+        self._transformations = transformations
+        self._maybe_compact()
+
+    def add_transformation(self, transformation):
+        """Record a transformation appended to the list of transformations.
+
+        Parameters
+        ----------
+        transformation : tuple
+            The type of the transformation, the statements it added, and
+            the IDs of the model versions before and after it.
+        """
+        tr_type, stmts, old_id, new_id = transformation
+        record = {'op': 'push', 'type': tr_type,
+                  'stmts': self._write_stmts(stmts),
+                  'old_id': old_id, 'new_id': new_id}
+        self._transformations.append(record)
+        self._write([record])
+
+    def pop_transformation(self):
+        """Record that the last transformation was removed, e.g., undone."""
+        if self._transformations:
+            self._transformations.pop()
+            self._num_garbage += 2
+        self._write([{'op': 'pop'}])
+        self._maybe_compact()
+
+    def set_goal(self, explain, context):
+        """Record the explanation goal and the cell line context."""
+        explain_hash = self._write_stmts([explain])[0] \
+            if explain is not None else None
+        if self._goal is not None:
+            self._num_garbage += 1
+        self._goal = {'op': 'goal', 'explain': explain_hash,
+                      'context': context}
+        self._write([self._goal])
+        self._maybe_compact()
+
+    def load(self):
+        """Return the changes recorded in the journal, in order.
+
+        Returns
+        -------
+        changes : list[tuple]
+            Each change is one of ('version', model_id, stmts, base_id),
+            ('push', transformation), ('pop',) or ('goal', explain,
+            context), where statements are shared between changes that
+            refer to the same statement.
+        """
+        records = self._read()
+        # All statements are deserialized at once so that support relations
+        # between them are resolved
+        stmt_hashes = []
+        stmt_jsons = []
+        for record in records:
+            if record['op'] == 'stmts':
+                for stmt_hash, stmt_json in record['stmts']:
+                    stmt_hashes.append(stmt_hash)
+                    stmt_jsons.append(stmt_json)
+        stmts_by_hash = dict(zip(stmt_hashes, stmts_from_json(stmt_jsons)))
+        for stmt_hash, stmt in stmts_by_hash.items():
+            self._hashes[stmt.uuid] = stmt_hash
+        self._written = set(stmts_by_hash)
+
+        changes = []
+        for record in records:
+            op = record['op']
+            if op == 'version':
+                if 'stmts' in record:
+                    hashes = record['stmts']
+                    base_id = None
+                else:
+                    base_id = record['base_id']
+                    removed = set(record['removed'])
+                    hashes = [h for idx, h
+                              in enumerate(self._versions[base_id])
+                              if idx not in removed] + record['added']
+                self._versions[record['model_id']] = hashes
+                self._bases[record['model_id']] = base_id
+                changes.append(('version', record['model_id'],
+                                [stmts_by_hash[h] for h in hashes],
+                                base_id))
+            elif op == 'push':
+                self._transformations.append(record)
+                stmts = [stmts_by_hash[h] for h in record['stmts']]
+                changes.append(('push', (record['type'], stmts,
+                                         record['old_id'],
+                                         record['new_id'])))
+            elif op == 'pop':
+                if self._transformations:
+                    self._transformations.pop()
+                    self._num_garbage += 2
+                changes.append(('pop',))
+            elif op == 'goal':
+                if self._goal is not None:
+                    self._num_garbage += 1
+                self._goal = record
+                explain = stmts_by_hash[record['explain']] \
+                    if record['explain'] is not None else None
+                changes.append(('goal', explain, record['context']))
+        logger.info('Loaded %d changes with %d statements from %s' %
+                    (len(changes), len(stmts_by_hash), self.path))
+        return changes
+
+    def compact(self):
+        """Rewrite the journal with only the changes of the current state.
+
+        The statements of discarded versions and undone transformations
+        are dropped, along with the records of those changes.
+        """
+        with self._lock:
+            if not self._num_garbage or not os.path.exists(self.path):
+                return
+            live_hashes = OrderedDict()
+            for hashes in self._versions.values():
+                live_hashes.update((h, None) for h in hashes)
+            for record in self._transformations:
+                live_hashes.update((h, None) for h in record['stmts'])
+            if self._goal is not None and \
+                    self._goal['explain'] is not None:
+                live_hashes[self._goal['explain']] = None
+            stmt_jsons = {}
+            for record in self._read():
+                if record['op'] == 'stmts':
+                    for stmt_hash, stmt_json in record['stmts']:
+                        if stmt_hash in live_hashes:
+                            stmt_jsons[stmt_hash] = stmt_json
+            records = [{'op': 'stmts',
+                        'stmts': [(h, stmt_jsons[h]) for h in live_hashes]}]
+            versions = self._versions
+            self._versions = OrderedDict()
+            for model_id, hashes in versions.items():
+                records.append(self._make_version_record(
+                    model_id, hashes, self._bases.get(model_id)))
+            records += self._transformations
+            if self._goal is not None:
+                records.append(self._goal)
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as fh:
+                    for record in records:
+                        fh.write(json.dumps(record) + '\n')
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning('Could not compact session in %s' %
+                               self.path)
+                logger.exception(e)
+                return
+            self._written = set(live_hashes)
+            self._hashes = {uuid: h for uuid, h in self._hashes.items()
+                            if h in self._written}
+            logger.info('Compacted session in %s, dropping %d changes' %
+                        (self.path, self._num_garbage))
+            self._num_garbage = 0
+
+    def clear(self):
+        """Remove all recorded changes."""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._hashes = {}
+            self._written = set()
+            self._versions = OrderedDict()
+            self._bases = {}
+            self._transformations = []
+            self._goal = None
+            self._num_garbage = 0
+
+    def _maybe_compact(self):
+        num_live = len(self._versions) + len(self._transformations) + 1
+        if self._num_garbage >= max(self.min_compact, num_live):
+            self.compact()
+
+    def _make_version_record(self, model_id, hashes, base_id):
+        record = {'op': 'version', 'model_id': model_id}
+        base_hashes = self._versions.get(base_id)
+        delta = _make_delta(base_hashes, hashes) \
+            if base_hashes is not None else None
+        if delta is not None:
+            record['base_id'] = base_id
+            record['removed'], record['added'] = delta
+        else:
+            record['stmts'] = hashes
+            base_id = None
+        self._versions[model_id] = hashes
+        self._bases[model_id] = base_id
+        return record
+
+    def _write_stmts(self, stmts):
+        """Return the hashes of statements, writing those not yet written."""
+        hashes = []
+        new_stmts = []
+        for stmt in stmts:
+            stmt_hash = self._hashes.get(stmt.uuid)
+            if stmt_hash is None:
+                stmt_json = stmt.to_json()
+                stmt_hash = _get_stmt_hash(stmt_json)
+                self._hashes[stmt.uuid] = stmt_hash
+                # A statement with the same content may have been written
+                # under another UUID
+                if stmt_hash not in self._written:
+                    self._written.add(stmt_hash)
+                    new_stmts.append((stmt_hash, stmt_json))
+            hashes.append(stmt_hash)
+        if new_stmts:
+            self._write([{'op': 'stmts', 'stmts': new_stmts}])
+        return hashes
+
+    def _write(self, records):
+        with self._lock:
+            try:
+                with open(self.path, 'a') as fh:
+                    for record in records:
+                        fh.write(json.dumps(record) + '\n')
+            except Exception as e:
+                logger.warning('Could not write session to %s' % self.path)
+                logger.exception(e)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        valid_size = 0
+        with open(self.path, 'rb') as fh:
+            for line in fh:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete line')
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    # A change that was only partially written before the
+                    # agent stopped is dropped, along with anything after it
+                    logger.warning('Dropping incomplete changes from %s' %
+                                   self.path)
+                    break
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.path):
+            with open(self.path, 'ab') as fh:
+                fh.truncate(valid_size)
+        return records
+
+
+def _make_delta(base_hashes, hashes):
+    """Return the positions of removed base statements and the appended
+    statements, or None if the statements aren't of that form."""
+    kept_hashes = set(hashes)
+    removed = [idx for idx, h in enumerate(base_hashes)
+               if h not in kept_hashes]
+    removed_set = set(removed)
+    kept = [h for idx, h in enumerate(base_hashes) if idx not in removed_set]
+    if kept != hashes[:len(kept)]:
+        return None
+    return removed, hashes[len(kept):]
+
+
+def _get_stmt_hash(stmt_json):
+    # The UUID of a statement doesn't change the mechanism it represents
+    content = {k: v for k, v in stmt_json.items() if k != 'id'}
+    s = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
@@ -0,0 +1,306 @@
+"""A store of the statements of model versions with structural sharing.
+
+Each operation on a model (e.g., expanding it or removing a mechanism)
+creates a new model version, which typically only differs from the version
+it was derived from by a few statements. Rather than keeping a full list of
+statements for every version, the store keeps versions as differences from
+the version they are based on: the positions of the statements removed
+from it and the statements appended to it. Statement objects are therefore
+shared by all versions containing them. A full snapshot is kept every few
+versions so that reconstructing a version never walks a long chain of
+differences. Old versions can be discarded, or moved to disk, to bound the
+memory used over long sessions. Statements of versions loaded back from
+disk are replaced by the statement objects with the same UUIDs that are
+still in use, so that statements keep their identity across versions.
+"""
+
+import os
+import sys
+import pickle
+import logging
+import weakref
+from collections import OrderedDict
+
+
+logger = logging.getLogger('version_store')
+
+
+class ModelVersionStore(object):
+    """Store the statements of model versions by their model IDs.
+
+    The store can be used like a dict from model IDs to lists of
+    statements. Lists returned by the store are shared between callers and
+    must not be modified.
+
+    Parameters
+    ----------
+    max_versions : Optional[int]
+        The number of most recent versions that are kept, older versions
+        are discarded. If None, all versions are kept. Default: None
+    max_in_memory : Optional[int]
+        The number of most recent versions that are kept in memory if a
+        spill directory is given, older versions are moved to disk.
+        Default: 32
+    spill_dir : Optional[str]
+        A directory to which old versions are moved. If None, all kept
+        versions stay in memory. Default: None
+    max_delta_depth : Optional[int]
+        The maximal number of differences applied on top of a snapshot to
+        reconstruct a version. Default: 16
+    max_cached : Optional[int]
+        The number of reconstructed lists of statements that are cached.
+        Default: 8
+    """
+    def __init__(self, max_versions=None, max_in_memory=32, spill_dir=None,
+                 max_delta_depth=16, max_cached=8):
+        self.max_versions = max_versions
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        self.max_delta_depth = max_delta_depth
+        self.max_cached = max_cached
+        # The versions in the order in which they were added, each is either
+        # a ModelVersion or None if it was moved to disk.
+        self._versions = OrderedDict()
+        # The IDs of the base versions of versions (None for snapshots)
+        self._bases = {}
+        # The reconstructed lists of statements of recently used versions
+        self._lists = OrderedDict()
+        # The statements of versions in use by UUID, to which statements
+        # loaded from disk are resolved
+        self._stmts = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __contains__(self, model_id):
+        return model_id in self._versions
+
+    def __iter__(self):
+        return iter(self._versions)
+
+    def keys(self):
+        return self._versions.keys()
+
+    def __getitem__(self, model_id):
+        if model_id not in self._versions:
+            raise KeyError(model_id)
+        stmts = self._lists.get(model_id)
+        if stmts is None:
+            stmts = self._reconstruct(model_id)
+            self._cache_list(model_id, stmts)
+        else:
+            self._lists.move_to_end(model_id)
+        return stmts
+
+    def get(self, model_id, default=None):
+        try:
+            return self[model_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, model_id, stmts):
+        # Without an explicit base, a version is assumed to be derived from
+        # the most recent one.
+        base_id = next(reversed(self._versions)) if self._versions else None
+        self.add(model_id, stmts, base_id)
+
+    def add(self, model_id, stmts, base_id=None):
+        """Add a version of a model.
+
+        Parameters
+        ----------
+        model_id : int
+            The ID of the new version.
+        stmts : list[indra.statements.Statement]
+            The statements of the new version.
+        base_id : Optional[int]
+            The ID of the version that the new version is derived from. If
+            the new version consists of the statements of the base version,
+            some of which were removed, followed by new statements, only the
+            difference is stored, otherwise a snapshot of the full list.
+        """
+        stmts = list(stmts)
+        version = None
+        if base_id is not None and base_id in self._versions:
+            base_version = self._load(base_id)
+            if base_version.depth < self.max_delta_depth:
+                version = _make_delta(base_id, base_version, self[base_id],
+                                      stmts)
+        if version is None:
+            version = ModelVersion(None, (), stmts, len(stmts), 0)
+        for stmt in version.added:
+            self._stmts.setdefault(stmt.uuid, stmt)
+        self._versions.pop(model_id, None)
+        self._versions[model_id] = version
+        self._bases[model_id] = version.base_id
+        self._cache_list(model_id, stmts)
+        self._enforce_limits()
+
+    def get_memory_usage(self):
+        """Return statistics about the memory used by the store.
+
+        Returns
+        -------
+        usage : dict
+            The number of versions (in total, in memory and on disk), the
+            number of references to statements held by versions in memory
+            and the number that full lists of statements would hold, the
+            number of distinct statements referenced in memory, the
+            approximate size of the containers in memory in bytes and the
+            size of the versions on disk in bytes.
+        """
+        in_memory = [v for v in self._versions.values() if v is not None]
+        stmt_refs = sum(len(v.added) + len(v.removed) for v in in_memory)
+        full_refs = sum(v.length for v in in_memory)
+        unique_stmts = {id(stmt) for v in in_memory for stmt in v.added}
+        unique_stmts |= {id(stmt) for stmts in self._lists.values()
+                         for stmt in stmts}
+        container_bytes = sum(sys.getsizeof(v.added) +
+                              sys.getsizeof(v.removed) for v in in_memory)
+        container_bytes += sum(sys.getsizeof(stmts)
+                               for stmts in self._lists.values())
+        disk_bytes = sum(os.path.getsize(self._path(model_id))
+                         for model_id, v in self._versions.items()
+                         if v is None)
+        return {'num_versions': len(self._versions),
+                'num_in_memory': len(in_memory),
+                'num_on_disk': len(self._versions) - len(in_memory),
+                'stmt_refs': stmt_refs,
+                'full_stmt_refs': full_refs,
+                'unique_stmts': len(unique_stmts),
+                'container_bytes': container_bytes,
+                'disk_bytes': disk_bytes}
+
+    def _reconstruct(self, model_id):
+        # Collect the chain of differences down to a snapshot
+        chain = []
+        while True:
+            cached = self._lists.get(model_id)
+            if cached is not None:
+                stmts = cached
+                break
+            version = self._load(model_id)
+            if version.base_id is None:
+                stmts = version.added
+                break
+            chain.append(version)
+            model_id = version.base_id
+        for version in reversed(chain):
+            stmts = version.apply(stmts)
+        return list(stmts)
+
+    def _cache_list(self, model_id, stmts):
+        self._lists[model_id] = stmts
+        self._lists.move_to_end(model_id)
+        while len(self._lists) > self.max_cached:
+            self._lists.popitem(last=False)
+
+    def _load(self, model_id):
+        version = self._versions[model_id]
+        if version is None:
+            with open(self._path(model_id), 'rb') as fh:
+                version = pickle.load(fh)
+            version.added = [self._stmts.setdefault(stmt.uuid, stmt)
+                             for stmt in version.added]
+        return version
+
+    def _enforce_limits(self):
+        if self.max_versions is not None:
+            while len(self._versions) > self.max_versions:
+                self._discard(next(iter(self._versions)))
+        if self.spill_dir is None:
+            return
+        in_memory = [model_id for model_id, v in self._versions.items()
+                     if v is not None]
+        for model_id in in_memory[:-self.max_in_memory or None]:
+            self._spill(model_id)
+
+    def _discard(self, model_id):
+        # Versions based on the discarded one become snapshots
+        for other_id, base_id in list(self._bases.items()):
+            if base_id != model_id:
+                continue
+            spilled = self._versions[other_id] is None
+            stmts = self[other_id]
+            self._versions[other_id] = \
+                ModelVersion(None, (), stmts, len(stmts), 0)
+            self._bases[other_id] = None
+            if spilled:
+                self._spill(other_id)
+        version = self._versions.pop(model_id)
+        self._bases.pop(model_id)
+        self._lists.pop(model_id, None)
+        if version is None:
+            os.remove(self._path(model_id))
+        logger.debug('Discarded model version %s' % model_id)
+
+    def _spill(self, model_id):
+        version = self._versions[model_id]
+        fname = self._path(model_id)
+        tmp_fname = fname + '.tmp'
+        try:
+            with open(tmp_fname, 'wb') as fh:
+                pickle.dump(version, fh)
+            os.replace(tmp_fname, fname)
+        except Exception as e:
+            logger.warning('Could not move model version %s to %s' %
+                           (model_id, fname))
+            logger.exception(e)
+            return
+        self._versions[model_id] = None
+        logger.debug('Moved model version %s to disk' % model_id)
+
+    def _path(self, model_id):
+        return os.path.join(self.spill_dir, 'model_%s.pkl' % model_id)
+
+
+class ModelVersion(object):
+    """A version of a model as a difference from its base version.
+
+    Parameters
+    ----------
+    base_id : int or None
+        The ID of the base version, None if this is a snapshot.
+    removed : tuple[int]
+        The positions of the statements of the base version that were
+        removed.
+    added : list[indra.statements.Statement]
+        The statements appended to the remaining statements of the base
+        version, or all statements of a snapshot.
+    length : int
+        The number of statements in this version.
+    depth : int
+        The number of differences between this version and a snapshot.
+    """
+    __slots__ = ['base_id', 'removed', 'added', 'length', 'depth']
+
+    def __init__(self, base_id, removed, added, length, depth):
+        self.base_id = base_id
+        self.removed = removed
+        self.added = added
+        self.length = length
+        self.depth = depth
+
+    def apply(self, base_stmts):
+        """Return the statements of this version given those of its base."""
+        removed = set(self.removed)
+        return [stmt for idx, stmt in enumerate(base_stmts)
+                if idx not in removed] + self.added
+
+
+def _make_delta(base_id, base_version, base_stmts, stmts):
+    # Statements of the base version that aren't in the new version
+    stmt_ids = {id(stmt) for stmt in stmts}
+    removed = tuple(idx for idx, stmt in enumerate(base_stmts)
+                    if id(stmt) not in stmt_ids)
+    removed_set = set(removed)
+    kept = [stmt for idx, stmt in enumerate(base_stmts)
+            if idx not in removed_set]
+    # The new version has to start with the remaining base statements
+    if len(kept) > len(stmts) or \
+            any(a is not b for a, b in zip(kept, stmts)):
+        return None
+    return ModelVersion(base_id, removed, stmts[len(kept):], len(stmts),
+                        base_version.depth + 1)
@@ -1,6 +1,7 @@
-__all__ = ['IMAGE_DIR', 'TIMESTAMP_PICS']
+__all__ = ['IMAGE_DIR', 'TIMESTAMP_PICS', 'MODEL_CACHE_DIR', 'MRA_SESSION_DIR',
+           'MRA_MAX_VERSIONS', 'MRA_SPILL_DIR']
 
-from os import path, mkdir
+from os import path, mkdir, environ
 
 # Select the directory where images are stored. By default, it is in a
 # directory called `images` alongside this file. Note that if this file does
@@ -13,3 +14,24 @@ if not path.exists(IMAGE_DIR):
 # Choose whether images are given a timestamp. This can cause a buildup of
 # images over time, however it guarantees overall uniqueness over a single run.
 TIMESTAMP_PICS = False
+
+# Choose a directory in which assembled models are cached so that they can be
+# shared between agents running in separate processes and across runs. If
+# None, models are only cached in memory.
+MODEL_CACHE_DIR = environ.get('BIOAGENTS_MODEL_CACHE_DIR')
+
+# Choose a directory in which the MRA records the state of its session (model
+# versions, undoable transformations and the explanation goal) so that it is
+# restored when the MRA is restarted. If None, the session is only kept in
+# memory.
+MRA_SESSION_DIR = environ.get('BIOAGENTS_MRA_SESSION_DIR')
+
+# Choose the number of most recent model versions that the MRA keeps, older
+# versions are discarded along with the transformations that refer to them.
+# If None, all versions are kept.
+MRA_MAX_VERSIONS = int(environ['BIOAGENTS_MRA_MAX_VERSIONS']) \
+    if environ.get('BIOAGENTS_MRA_MAX_VERSIONS') else None
+
+# Choose a directory to which the MRA moves model versions other than the
+# most recent ones out of memory. If None, all kept versions stay in memory.
+MRA_SPILL_DIR = environ.get('BIOAGENTS_MRA_SPILL_DIR')
@@ -1,14 +1,33 @@
+import os
 import json
+import random
+import shutil
+import itertools
+import networkx
+import tempfile
 import unittest
 import xml.etree.ElementTree as ET
 from kqml.kqml_list import KQMLList
 import indra.statements as sts
+from indra.ontology.bio import bio_ontology
 from bioagents.tests.util import ekb_from_text, ekb_kstring_from_text, \
         get_request, stmts_json_from_text, stmts_clj_from_text
 from bioagents.tests.integration import _IntegrationTest, _FailureTest
-from bioagents.mra.mra import MRA, make_influence_map, make_contact_map
+from bioagents.mra.mra import MRA, make_influence_map, make_contact_map, \
+    assemble_pysb, generate_network, make_sbgn, _DiagramModel
+from bioagents.mra.refinement_index import RefinementIndex
+from bioagents.mra.version_store import ModelVersionStore
+from bioagents.mra.incremental_assembly import assemble_pysb_incremental
+from bioagents.mra.context_store import CellLineContextStore
+from bioagents.mra.sbgn_colorizer import SbgnColorizer
+from bioagents.mra.model_diagnoser import get_best_connecting_edge, \
+    ActivityIndex, ModelDiagnoser
+from bioagents.mra.diagrams import Diagrams, DiagramRenderer, DiagramCache
+from bioagents.model_cache import ModelCache, get_stmts_fingerprint, \
+    get_writable, is_frozen
 from bioagents.mra.mra_module import MRA_Module, ekb_from_agent, get_target, \
-    _get_matching_stmts, CAN_CHECK_STATEMENTS, InvalidModelDescriptionError
+    _get_matching_stmts, CAN_CHECK_STATEMENTS, InvalidModelDescriptionError, \
+    _get_query_key
 from nose.plugins.attrib import attr
 
 
@@ -89,6 +108,235 @@ def test_transformations():
     assert(tr[3] == 2)
 
 
+def test_extend_model_refinements():
+    m = MRA()
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    erk = sts.Agent('ERK', db_refs={'FPLX': 'ERK'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    generic = sts.Phosphorylation(mek, erk)
+    unrelated = sts.Activation(sts.Agent('A'), sts.Agent('B'))
+    m.new_model([generic, unrelated])
+    # A refinement replaces the generic statement, an exact match and a
+    # statement refined by one in the model are not added
+    specific = sts.Phosphorylation(map2k1, mapk1)
+    matched = sts.Activation(sts.Agent('A'), sts.Agent('B'))
+    new_id, added = m.extend_model([specific, matched], 1)
+    assert added == [specific]
+    assert m.models[new_id] == [unrelated, specific]
+    new_id, added = m.extend_model([sts.Phosphorylation(mek, mapk1)],
+                                   new_id)
+    assert added == []
+    assert m.models[new_id] == [unrelated, specific]
+
+
+def test_refinement_index():
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    stmts = [sts.Phosphorylation(mek, mapk1),
+             sts.Phosphorylation(map2k1, mapk1),
+             sts.Phosphorylation(None, mapk1),
+             sts.Activation(map2k1, mapk1),
+             sts.Complex([mapk1, map2k1])]
+    index = RefinementIndex(stmts, bio_ontology)
+    assert index.get_refinements_of(stmts[0]) == stmts[:2]
+    assert index.get_refined_by(stmts[1]) == stmts[:3]
+    assert index.get_refinements_of(stmts[2]) == stmts[:3]
+    assert index.get_refined_by(stmts[2]) == stmts[2:3]
+    assert index.get_refinements_of(sts.Complex([mek, mapk1])) == \
+        stmts[4:]
+    assert index.get_related_indices(sts.Activation(mek, mapk1)) == [3]
+
+
+def test_refinement_index_reuse():
+    m = MRA()
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    stmts = [sts.Phosphorylation(map2k1, mapk1),
+             sts.Activation(sts.Agent('A'), sts.Agent('B'))]
+    model_id = m.new_model(stmts)
+    index = m.get_refinement_index(model_id)
+    query = json.dumps(sts.stmts_to_json([sts.Phosphorylation(mek,
+                                                              mapk1)]))
+    assert m.has_mechanism(query, model_id)['has_mechanism']
+    assert m.get_refinement_index(model_id) is index
+    res = m.remove_mechanism_from_stmts([sts.Phosphorylation(mek, mapk1)],
+                                        model_id)
+    assert res['removed'] == stmts[:1]
+    assert res['model'] == stmts[1:]
+    assert m.get_refinement_index(model_id) is index
+    m.extend_model([sts.Phosphorylation(mek, mapk1)], model_id)
+    assert m.get_refinement_index(model_id) is index
+
+
+def test_model_version_store():
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(10)]
+    spill_dir = tempfile.mkdtemp()
+    try:
+        store = ModelVersionStore(max_versions=4, max_in_memory=2,
+                                  spill_dir=spill_dir, max_cached=1)
+        store.add(1, stmts[:5])
+        store.add(2, stmts[:5] + stmts[5:7], 1)
+        store.add(3, [stmts[0]] + stmts[2:7] + stmts[7:8], 2)
+        # Reordered statements are stored as a snapshot
+        store.add(4, list(reversed(stmts)), 3)
+        assert store[4] == list(reversed(stmts))
+        # Versions moved to disk are reconstructed from the statements in
+        # use, so that they keep their identity
+        assert _same_stmts(store[3], [stmts[0]] + stmts[2:8])
+        assert _same_stmts(store[2], stmts[:7])
+        usage = store.get_memory_usage()
+        assert usage['num_versions'] == 4
+        assert usage['num_on_disk'] == 2
+        assert usage['disk_bytes'] > 0
+        store.add(5, list(reversed(stmts))[:3], 4)
+        assert 1 not in store
+        assert _same_stmts(store[2], stmts[:7])
+        assert store[5] == list(reversed(stmts))[:3]
+    finally:
+        shutil.rmtree(spill_dir)
+
+
+def _same_stmts(stmts, other):
+    return len(stmts) == len(other) and \
+        all(a is b for a, b in zip(stmts, other))
+
+
+def test_refinement_index_spilled_version():
+    spill_dir = tempfile.mkdtemp()
+    try:
+        m = MRA(spill_dir=spill_dir)
+        m.models.max_in_memory = 1
+        m.models.max_cached = 1
+        stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+                 for i in range(2)]
+        model_id = m.new_model(stmts[:1])
+        index = m.get_refinement_index(model_id)
+        m.extend_model(stmts[1:], model_id)
+        # The version moved to disk is loaded with the same statements, so
+        # its index is still used
+        assert m.models.get_memory_usage()['num_on_disk'] == 1
+        assert _same_stmts(m.models[model_id], stmts[:1])
+        assert m.get_refinement_index(model_id) is index
+    finally:
+        shutil.rmtree(spill_dir)
+
+
+def _enz_names(stmts):
+    return [stmt.enz.name for stmt in stmts]
+
+
+def test_model_version_retention():
+    m = MRA(max_versions=3)
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(5)]
+    model_id = m.new_model(stmts[:1])
+    for stmt in stmts[1:]:
+        model_id, _ = m.extend_model([stmt], model_id)
+    assert m.models[model_id] == stmts
+    assert m.get_model_by_id(1) is None
+    assert len(m.transformations) == 2
+    usage = m.get_memory_usage()
+    assert usage['num_versions'] == 3
+    assert usage['stmt_refs'] < usage['full_stmt_refs']
+    res = m.model_undo()
+    assert res['model'] == stmts[:4]
+    assert res['action']['statements'] == stmts[4:]
+    # Extending the oldest version discards it, so that can't be undone
+    old_id = next(iter(m.models))
+    m.extend_model([sts.Phosphorylation(sts.Agent('C'), sts.Agent('B'))],
+                   old_id)
+    assert old_id not in m.models
+    assert all(tr[2] in m.models for tr in m.transformations)
+
+
+def _get_uuids(stmts):
+    return [stmt.uuid for stmt in stmts]
+
+
+def test_session_restore():
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(5)]
+    ev = sts.Evidence(context=sts.BioContext(
+        cell_line=sts.RefContext('BT20')))
+    explain = sts.Activation(sts.Agent('A0'), sts.Agent('B'), evidence=[ev])
+    session_dir = tempfile.mkdtemp()
+    try:
+        m = MRA(session_dir=session_dir)
+        model_id = m.new_model(stmts[:2])
+        for stmt in stmts[2:]:
+            model_id, _ = m.extend_model([stmt], model_id)
+        m.set_user_goal(explain)
+        m.model_undo()
+        m2 = MRA(session_dir=session_dir)
+        assert list(m2.models) == list(m.models)
+        for model_id in m.models:
+            assert _get_uuids(m2.models[model_id]) == \
+                _get_uuids(m.models[model_id])
+        # Statements are shared by the versions they are part of
+        assert m2.models[2][0] is m2.models[5][0]
+        assert [(tr[0], _get_uuids(tr[1]), tr[2], tr[3])
+                for tr in m2.transformations] == \
+            [(tr[0], _get_uuids(tr[1]), tr[2], tr[3])
+             for tr in m.transformations]
+        assert m2.id_counter == m.id_counter == 5
+        assert m2.explain.uuid == explain.uuid
+        assert m2.context == 'BT20'
+        # Each statement is stored once
+        with open(os.path.join(session_dir, 'session.jsonl'), 'r') as fh:
+            records = [json.loads(line) for line in fh]
+        assert sum(len(r['stmts']) for r in records
+                   if r['op'] == 'stmts') == 6
+        # Changes to a restored session are recorded, and a change that
+        # was only partially written is dropped
+        m2.extend_model(stmts[4:], 5)
+        with open(os.path.join(session_dir, 'session.jsonl'), 'a') as fh:
+            fh.write('{"op": "ver')
+        m3 = MRA(session_dir=session_dir)
+        assert _get_uuids(m3.models[6]) == _get_uuids(stmts)
+        assert len(m3.transformations) == len(m2.transformations)
+    finally:
+        shutil.rmtree(session_dir)
+
+
+def test_session_compaction():
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(20)]
+    session_dir = tempfile.mkdtemp()
+    session_file = os.path.join(session_dir, 'session.jsonl')
+    try:
+        m = MRA(max_versions=3, session_dir=session_dir)
+        m.session.min_compact = 4
+        model_id = m.new_model(stmts[:1])
+        for stmt in stmts[1:]:
+            model_id, _ = m.extend_model([stmt], model_id)
+        # The same mechanism added again is stored once
+        m.new_model([sts.Phosphorylation(sts.Agent('A0'), sts.Agent('B'))])
+        # Only a bounded number of discarded versions are in the journal
+        with open(session_file, 'r') as fh:
+            records = [json.loads(line) for line in fh]
+        assert sum(r['op'] == 'version' for r in records) < 10
+        assert sum(len(r['stmts']) for r in records
+                   if r['op'] == 'stmts') == 20
+        m2 = MRA(max_versions=3, session_dir=session_dir)
+        assert list(m2.models) == list(m.models) == [19, 20, 21]
+        assert _get_uuids(m2.models[20]) == _get_uuids(stmts)
+        assert m2.models[21][0] is m2.models[20][0]
+        assert [tr[3] for tr in m2.transformations] == \
+            [tr[3] for tr in m.transformations]
+        # Restoring compacts the journal to the current state
+        with open(session_file, 'r') as fh:
+            records = [json.loads(line) for line in fh]
+        assert sum(r['op'] == 'version' for r in records) == 3
+        assert sum(len(r['stmts']) for r in records
+                   if r['op'] == 'stmts') == 20
+    finally:
+        shutil.rmtree(session_dir)
+
+
 def test_model_undo():
     m = MRA()
     stmts1 = [sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))]
@@ -132,6 +380,212 @@ def test_make_diagrams():
     assert diagrams['influencemap'].endswith('.png')
 
 
+def test_diagram_model_copies():
+    model = assemble_pysb([sts.Phosphorylation(sts.Agent('A'),
+                                               sts.Agent('B'))],
+                          'one_step', 100.0)
+    diagram_model = _DiagramModel(model)
+    network_model = diagram_model.get_network()
+    assert network_model is diagram_model.get(bng=True)
+    assert network_model.reactions
+    # Jobs exporting the model to Kappa don't read the model to which the
+    # network is added
+    assert diagram_model.get() is not network_model
+    assert not diagram_model.get().reactions
+    assert len(diagram_model.get().initials) == len(network_model.initials)
+
+
+def test_lazy_diagrams():
+    rendered = []
+
+    def draw(name):
+        rendered.append(name)
+        return name + '.png'
+
+    jobs = [(name, lambda name=name: draw(name)) for name in ('a', 'b')]
+    diagrams = Diagrams(jobs, DiagramRenderer(max_workers=2), lazy=True)
+    assert list(diagrams) == ['a', 'b']
+    assert not rendered
+    assert diagrams['b'] == 'b.png'
+    assert rendered == ['b']
+    assert not diagrams.is_started('a')
+    futures = diagrams.render()
+    assert futures['a'].result() == 'a.png'
+    assert sorted(rendered) == ['a', 'b']
+    assert diagrams.get('c') is None
+
+
+def test_diagram_cache():
+    image_dir = tempfile.mkdtemp()
+    renderer = DiagramRenderer(max_workers=1)
+    made = []
+
+    def make(name):
+        def draw():
+            fname = os.path.join(image_dir, name + '.png')
+            with open(fname, 'w') as fh:
+                fh.write(name)
+            return fname
+        made.append(name)
+        return Diagrams([('rxn', draw)], renderer)
+
+    try:
+        cache = DiagramCache(max_size=2, image_dir=image_dir)
+        d1 = cache.get_diagrams('k1', lambda: make('a'))
+        fname1 = d1['rxn']
+        assert cache.get_diagrams('k1', lambda: make('b')) is d1
+        assert made == ['a']
+        cache.get_diagrams('k2', lambda: make('c'))['rxn']
+        # A deleted file is rendered again
+        os.remove(fname1)
+        assert cache.get_diagrams('k1', lambda: make('a'))['rxn'] == fname1
+        assert made == ['a', 'c', 'a']
+        # Evicting the least recently used diagrams deletes their files
+        cache.get_diagrams('k3', lambda: make('d'))['rxn']
+        renderer.executor.shutdown(wait=True)
+        assert 'k2' not in cache
+        assert sorted(os.listdir(image_dir)) == ['a.png', 'd.png']
+    finally:
+        shutil.rmtree(image_dir)
+
+
+def test_generate_network():
+    stmts = [sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1'))]
+    model = assemble_pysb(stmts, 'one_step', 100.0)
+    generate_network(model)
+    assert 'MAPK1_0_mod' in model.parameters.keys()
+    species = list(model.species)
+    reactions = list(model.reactions)
+    assert reactions
+    # The SBGN export reuses the network rather than generating it again
+    sbgn = make_sbgn(model, 1)
+    assert '<glyph' in sbgn
+    assert model.species == species
+    assert model.reactions == reactions
+
+
+def test_context_store():
+    tmp_dir = tempfile.mkdtemp()
+    expr_file = os.path.join(tmp_dir, 'expr.json')
+    mut_file = os.path.join(tmp_dir, 'mut.json')
+    with open(expr_file, 'w') as fh:
+        json.dump({'A375_SKIN': {'BRAF': 12.5, 'KRAS': None},
+                   'BT20_BREAST': {'BRAF': 3.0}}, fh)
+    with open(mut_file, 'w') as fh:
+        json.dump({'A375_SKIN': {'BRAF': ['V600E'], 'KRAS': []},
+                   'BT20_BREAST': {'BRAF': []}}, fh)
+    try:
+        store = CellLineContextStore(expr_file, mut_file)
+        expr = store.get_expression(['BRAF', 'KRAS', 'XYZ'], 'A375_SKIN')
+        assert expr == {'A375_SKIN': {'BRAF': 12.5, 'KRAS': None,
+                                      'XYZ': None}}
+        expr = store.get_expression(['BRAF', 'KRAS'], 'BT20_BREAST')
+        assert expr == {'BT20_BREAST': {'BRAF': 3.0, 'KRAS': None}}
+        mut = store.get_mutations(['BRAF', 'KRAS'], 'A375_SKIN')
+        assert mut == {'A375_SKIN': {'BRAF': ['V600E'], 'KRAS': []}}
+        assert store.get_mutations(['BRAF'], 'BT20_BREAST') == \
+            {'BT20_BREAST': {'BRAF': []}}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_sbgn_colorizer_styles():
+    sbgn = ('<sbgn xmlns="http://sbgn.org/libsbgn/0.2"><map>'
+            '<glyph id="g1"><label text="BRAF"/></glyph>'
+            '<glyph id="g2"><label text="MAP2K1"/></glyph>'
+            '<glyph id="g3"><label text="vemurafenib"/></glyph>'
+            '</map></sbgn>')
+    stmts = [sts.Phosphorylation(sts.Agent('BRAF', db_refs={'HGNC': '1097'}),
+                                 sts.Agent('MAP2K1',
+                                           db_refs={'HGNC': '6840'})),
+             sts.Inhibition(sts.Agent('vemurafenib', db_refs={}),
+                            sts.Agent('BRAF', db_refs={'HGNC': '1097'}))]
+    colorizer = SbgnColorizer(sbgn.encode('utf-8'))
+    colorizer.set_style_expression_mutation(stmts, cell_line='A375_SKIN')
+    styles = colorizer.label_to_style
+    assert set(styles) == {'BRAF', 'MAP2K1', 'vemurafenib'}
+    # BRAF is mutated in A375
+    assert styles['BRAF'].border_color == '#ff0000'
+    assert styles['MAP2K1'].border_color == '#555555'
+    # MAP2K1 is more highly expressed than BRAF
+    assert styles['MAP2K1'].fill_color != styles['BRAF'].fill_color
+    assert styles['vemurafenib'].fill_color != styles['BRAF'].fill_color
+
+
+def test_best_connecting_edge():
+    im = networkx.DiGraph()
+    im.add_edges_from([('SOURCE', 'a'), ('a', 'b'), ('b', 'c'), ('a', 'c'),
+                       ('d', 'e'), ('e', 'TARGET'), ('f', 'TARGET')])
+    # The longest path is SOURCE, a, b, c, d, e, TARGET
+    assert get_best_connecting_edge(im, 'SOURCE', 'TARGET') == \
+        (('c', 'd'), 7)
+    # With a cycle, the edge still leads from the end of the longest path
+    # from the source to the longest path to the target
+    im.add_edge('c', 'SOURCE')
+    assert get_best_connecting_edge(im, 'SOURCE', 'TARGET') == \
+        (('c', 'd'), 7)
+    im = networkx.DiGraph()
+    im.add_nodes_from(['SOURCE', 'TARGET'])
+    assert get_best_connecting_edge(im, 'SOURCE', 'TARGET') == \
+        (('SOURCE', 'TARGET'), 2)
+
+
+def test_best_connecting_edge_cycles():
+    def get_best_edge_by_search(im):
+        im = im.copy()
+        best_edge = (None, 0)
+        for u, v in itertools.permutations(im.nodes(), 2):
+            is_new = not im.has_edge(u, v)
+            im.add_edge(u, v)
+            paths = list(networkx.all_simple_paths(im, 'SOURCE', 'TARGET'))
+            length = max([len(p) for p in paths] + [0])
+            if length > best_edge[1]:
+                best_edge = ((u, v), length)
+            if is_new:
+                im.remove_edge(u, v)
+        return best_edge
+    # The longest path from the source goes around the cycle of a, b and c,
+    # and the longest path to the target enters the cycle of e and f at e
+    im = networkx.DiGraph()
+    im.add_edges_from([('SOURCE', 'a'), ('a', 'b'), ('b', 'c'), ('c', 'a'),
+                       ('b', 'd'), ('e', 'f'), ('f', 'e'), ('f', 'g'),
+                       ('e', 'TARGET'), ('g', 'TARGET')])
+    assert get_best_connecting_edge(im, 'SOURCE', 'TARGET') == \
+        get_best_edge_by_search(im) == (('c', 'e'), 8)
+    rng = random.Random(0)
+    for _ in range(20):
+        im = networkx.DiGraph()
+        nodes = ['SOURCE', 'TARGET'] + ['n%d' % i for i in range(5)]
+        im.add_nodes_from(nodes)
+        for u, v in itertools.permutations(nodes, 2):
+            if u != 'TARGET' and v != 'SOURCE' and (u, v) != \
+                    ('SOURCE', 'TARGET') and rng.random() < 0.2:
+                im.add_edge(u, v)
+        assert get_best_connecting_edge(im, 'SOURCE', 'TARGET') == \
+            get_best_edge_by_search(im)
+
+
+def test_activity_index():
+    braf = sts.Agent('BRAF')
+    braf_act = sts.Agent('BRAF', activity=sts.ActivityCondition('kinase',
+                                                                True))
+    st1 = sts.Phosphorylation(braf, sts.Agent('MAP2K1'))
+    st2 = sts.Activation(sts.Agent('KRAS'), braf)
+    index = ActivityIndex()
+    acts = ModelDiagnoser([st1, st2],
+                          activity_index=index).get_missing_activities()
+    assert len(acts) == 1
+    assert acts[0].enz.activity.activity_type == 'activity'
+    # A new version of the model reuses what was found for the old one
+    st3 = sts.Phosphorylation(braf_act, sts.Agent('MAPK1'))
+    acts2 = ModelDiagnoser([st1, st2, st3],
+                           activity_index=index).get_missing_activities()
+    assert len(acts2) == 1
+    assert acts2[0] is acts[0]
+    assert index.get_activity_types([st3, st2]) == \
+        {'BRAF': ['kinase', 'activity']}
+
+
 def test_make_im():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
@@ -152,6 +606,90 @@ def test_make_cm():
     assert len(list(cm.edges())) == 2
 
 
+def test_model_cache():
+    stmts = [sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1')),
+             sts.Activation(sts.Agent('BRAF'), sts.Agent('MAP2K1'))]
+    # Same content in a different order and with different UUIDs
+    stmts2 = [sts.Activation(sts.Agent('BRAF'), sts.Agent('MAP2K1')),
+              sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1'))]
+    assert get_stmts_fingerprint(stmts) == get_stmts_fingerprint(stmts2)
+    assert get_stmts_fingerprint(stmts) != \
+        get_stmts_fingerprint(stmts[:1])
+    m = MRA()
+    res = m.build_model_from_stmts(stmts)
+    res2 = m.build_model_from_stmts(stmts2)
+    model = res['model_exec']
+    assert res2['model_exec'] is model
+    assert is_frozen(model)
+    # Drawing diagrams doesn't modify the shared model
+    assert len(model.initials) == \
+        len(assemble_pysb(stmts, 'one_step', 100.0).initials)
+    writable = get_writable(model)
+    assert writable is not model
+    assert not is_frozen(writable)
+    assert get_writable(writable) is writable
+    # A persistent cache can be shared across instances
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ModelCache(cache_dir=cache_dir)
+        model = cache.get_model(stmts, assemble_pysb, policies='one_step',
+                                initial_amount=100.0)
+        cache2 = ModelCache(cache_dir=cache_dir)
+        model2 = cache2.get_model(stmts2, assemble_pysb, policies='one_step',
+                                  initial_amount=100.0)
+        assert model2 is not model
+        assert [r.name for r in model2.rules] == \
+            [r.name for r in model.rules]
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def _get_model_content(model):
+    return ([(m.name, m.sites, m.site_states) for m in model.monomers],
+            [(p.name, p.value) for p in model.parameters],
+            [repr(r) for r in model.rules],
+            [repr(ic) for ic in model.initials],
+            [repr(a) for a in model.annotations])
+
+
+def test_assemble_pysb_incremental():
+    base_stmts = [
+        sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1'), 'T',
+                            '185'),
+        sts.Complex([sts.Agent('BRAF'), sts.Agent('MAP2K1')]),
+        sts.IncreaseAmount(None, sts.Agent('MAPK1')),
+        sts.Activation(sts.Agent('MAPK1'), sts.Agent('ELK1'))]
+    base_model = assemble_pysb(base_stmts, 'one_step', 100.0)
+    # Adding a site to MAPK1 changes the rule of its synthesis
+    stmts = base_stmts[:2] + base_stmts[3:] + [
+        sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1'), 'Y',
+                            '187'),
+        sts.Complex([sts.Agent('BRAF'), sts.Agent('RAF1')])]
+    model = assemble_pysb_incremental(base_model, base_stmts, stmts,
+                                      'one_step', 100.0)
+    assert _get_model_content(model) == \
+        _get_model_content(assemble_pysb(stmts, 'one_step', 100.0))
+    # The base model is left as it was
+    assert _get_model_content(base_model) == \
+        _get_model_content(assemble_pysb(base_stmts, 'one_step', 100.0))
+    # Active forms affect the rules of other statements
+    af = sts.ActiveForm(sts.Agent('MAPK1', mods=[
+        sts.ModCondition('phosphorylation', 'T', '185')]), 'activity', True)
+    assert assemble_pysb_incremental(base_model, base_stmts,
+                                     base_stmts + [af], 'one_step',
+                                     100.0) is None
+    # Models derived from a new version are cached and used as the base of
+    # later versions
+    m = MRA()
+    res = m.build_model_from_stmts(base_stmts)
+    res = m.expand_model_from_stmts(stmts[3:], res['model_id'])
+    assert _get_model_content(res['model_exec']) == \
+        _get_model_content(assemble_pysb(res['model'], 'one_step', 100.0))
+    res = m.remove_mechanism_from_stmts(base_stmts[1:2], res['model_id'])
+    assert _get_model_content(res['model_exec']) == \
+        _get_model_content(assemble_pysb(res['model'], 'one_step', 100.0))
+
+
 # #####################
 # MRA_Module unit tests
 # #####################
@@ -241,6 +779,20 @@ def test_get_matching_statements():
         "Expected > 1 matching, got matching: %s" % matching
 
 
+def test_support_query_key():
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    st1 = sts.Phosphorylation(braf, map2k1)
+    st2 = sts.Phosphorylation(braf, map2k1, 'S', '222')
+    st3 = sts.Phosphorylation(map2k1, braf)
+    st4 = sts.Complex([braf, map2k1])
+    # Statements resulting in the same query share it
+    assert _get_query_key(st1) == _get_query_key(st2)
+    assert _get_query_key(st1) != _get_query_key(st3)
+    assert _get_query_key(st4) == \
+        ('Complex', (('agents', ('1097@HGNC', '6840@HGNC')),))
+
+
 # #####################
 # MRA integration tests
 # #####################
@@ -1,8 +1,11 @@
 import json
+import numpy
 from nose.tools import raises
 import sympy.physics.units as units
 from bioagents.tra import tra_module
 from bioagents.tra import tra
+from bioagents.tra.sim_cache import SimulationCache
+from concurrent.futures import ThreadPoolExecutor
 from pysb import Model, Rule, Monomer, Parameter, Initial, SelfExporter
 from indra.statements import *
 from kqml import KQMLPerformative, KQMLList, KQMLToken
@@ -401,6 +404,260 @@ def test_seq_hyp_test():
     assert sat_rate == 1.0
     assert num_sim == 18
 
+
+def test_seq_hyp_test_batched():
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS'))]
+    model = tra_module.assemble_model(stmts)
+    entity = Agent('KRAS', activity=ActivityCondition('activity', True))
+    quant = tra.MolecularQuantity('qualitative', 'high')
+    pattern = tra.TemporalPattern('sometime_value', [entity], None,
+                                  value=quant)
+    t = tra.TRA()
+    from bioagents.tra.model_checker import HypothesisTester
+    ht = HypothesisTester(alpha=0.1, beta=0.1, delta=0.05, prob=0.8)
+    res = t.check_property(model, pattern, conditions=None,
+                           max_time=20000, num_times=100,
+                           hypothesis_tester=ht, max_batch_size=8)
+    sat_rate, num_sim, kpat, pat_obj, fig_path = res
+    # Batching must not change the outcome of the sequential test
+    assert sat_rate == 1.0
+    assert num_sim == 18
+
+
+def test_hyp_test_incremental():
+    from bioagents.tra.model_checker import HypothesisTester
+    ht = HypothesisTester(alpha=0.1, beta=0.1, delta=0.05, prob=0.8)
+    samples = [True, False, True, True, False, True, True, True]
+    for i, sample in enumerate(samples):
+        assert ht.update(sample) == ht.test(samples[:i+1])
+    assert ht.get_min_samples_to_decide() >= 1
+    ht.reset()
+    assert ht.num_pos == 0 and ht.num_neg == 0
+
+
+def test_simulation_cache():
+    model = _get_gk_model()
+    tra.get_create_observable(model, Agent('MAPK1'))
+    t = tra.TRA(use_kappa=False)
+    res1 = t.run_simulations(model, None, 2, 0, 1000, 10)
+    # Deterministic runs with the same settings share a single cache entry
+    assert len(t.sim_cache) == 1
+    res2 = t.run_simulations(model, None, 1, 0, 1000, 10)
+    assert len(t.sim_cache) == 1
+    assert (res1[0][1] == res2[0][1]).all()
+    t.run_simulations(model, None, 1, 0, 2000, 10)
+    assert len(t.sim_cache) == 2
+
+
+def test_simulation_cache_threads():
+    cache = SimulationCache(max_size=4)
+    tspan = numpy.linspace(0, 10, 11)
+
+    def use_cache(i):
+        key = 'key%d' % (i % 8)
+        if cache.get(key) is None:
+            cache.put(key, tspan, numpy.full((11, 2), i % 8))
+        return i % 8, cache.get(key)
+
+    # Hits and evictions from concurrent workers must not interfere
+    with ThreadPoolExecutor(8) as pool:
+        res = list(pool.map(use_cache, range(2000)))
+    assert len(cache) == 4
+    for value, cached in res:
+        # The entry may have been evicted again by another worker
+        if cached is not None:
+            assert (cached[1] == value).all()
+
+
+def test_simulation_cache_key_chunked():
+    t = tra.TRA(use_kappa=False)
+    # Online ODE runs are integrated in chunks, unlike offline ones
+    assert t.get_cache_key('fp', None, 1000, 10, None) != \
+        t.get_cache_key('fp', None, 1000, 10, None, chunked=True)
+    # With steady state detection both are integrated in the same chunks
+    assert t.get_cache_key('fp', None, 1000, 10, None, 1e-6) == \
+        t.get_cache_key('fp', None, 1000, 10, None, 1e-6, chunked=True)
+
+
+def test_kappa_runtime_pool():
+    from bioagents.tra.kappa_client import KappaRuntimePool
+    code = tra.pysb_to_kappa(_get_gk_model())
+    pool = KappaRuntimePool(max_uses=2)
+    kappa = pool.acquire(code)
+    kappa.start_sim(plot_period=10, pause_condition='[T] > 100', seed=1)
+    pool.release(kappa)
+    assert len(pool) == 1
+    # The runtime with the model already compiled is reused
+    kappa2 = pool.acquire(code)
+    assert kappa2 is kappa
+    assert not kappa2.load_model(code)
+    kappa2.start_sim(plot_period=10, pause_condition='[T] > 100', seed=2)
+    pool.release(kappa2)
+    # The runtime is restarted after max_uses simulations
+    assert kappa.model_key is None
+    assert kappa.num_uses == 0
+
+
+def test_kappa_runtime_pool_projects():
+    from bioagents.tra.kappa_client import KappaRuntimePool
+    pool = KappaRuntimePool('test_pool')
+    # Runtimes in use at the same time have projects of their own
+    kappa1 = pool.acquire()
+    kappa2 = pool.acquire()
+    assert kappa1.project_name != kappa2.project_name
+    pool.release(kappa1)
+    pool.release(kappa2)
+    assert {pool.acquire().project_name, pool.acquire().project_name} == \
+        {kappa1.project_name, kappa2.project_name}
+
+
+@raises(tra.SimulatorError)
+def test_kappa_sim_timeout():
+    model = _get_gk_model()
+    tra.get_create_observable(model, Agent('MAPK1'))
+    t = tra.TRA(sim_timeout=0.0001)
+    t.simulate_kappa(model, 2000000, 10)
+
+
+def test_get_sim_result():
+    plot = {'legend': ['[T]', 'A', 'B'],
+            'series': [[20.0, 1, 2], [0.0, 0, 50], [10.0, 40, 6]]}
+    tspan, yobs = tra.get_sim_result(plot)
+    assert list(tspan) == [0.0, 10.0, 20.0]
+    assert list(yobs['A']) == [0, 40, 1]
+    assert list(yobs['B']) == [50, 6, 2]
+    t = tra.TRA(use_kappa=False)
+    disc, thresh = t.discretize_obs(None, yobs, 'A')
+    assert thresh == 30
+    assert list(disc['A']) == [0, 1, 0]
+    # The trajectory itself is left unchanged
+    assert list(yobs['A']) == [0, 40, 1]
+
+
+def test_plot_results_background():
+    import os
+    model = _get_gk_model()
+    obs = tra.get_create_observable(model, Agent('MAPK1'))
+    t = tra.TRA(use_kappa=False)
+    results = t.run_simulations(model, None, 1, 0, 1000, 10)
+    fig_path = t.plot_results(results, Agent('MAPK1'), obs.name)
+    ready = []
+    t.renderer.when_ready(fig_path, ready.append)
+    assert t.renderer.wait(fig_path) == fig_path
+    assert os.path.exists(fig_path)
+    t.renderer.executor.shutdown(wait=True)
+    assert ready == [fig_path]
+
+
+def test_renderer_failed_figure():
+    from bioagents.tra.figure_renderer import FigureRenderer
+
+    def draw_fail(ax):
+        raise ValueError('Cannot draw')
+
+    renderer = FigureRenderer()
+    future = renderer.render('failed.png', draw_fail)
+    ready = []
+    renderer.when_ready('failed.png', ready.append)
+    assert future.exception() is not None
+    # Also once the failed render is done
+    renderer.when_ready('failed.png', ready.append)
+    renderer.executor.shutdown(wait=True)
+    assert ready == []
+
+
+def test_trajectory_ensemble():
+    model = _get_gk_model()
+    obs = tra.get_create_observable(model, Agent('MAPK1'))
+    t = tra.TRA(use_kappa=False)
+    results = t.run_simulations(model, None, 1, 0, 1000, 10)
+    # A run that was stopped early
+    results.append((results[0][0][:40], results[0][1][:40]))
+    ens = tra.TrajectoryEnsemble.from_results(results, [obs.name])
+    assert len(ens) == 2
+    assert ens.values.dtype == numpy.float32
+    assert ens.get(obs.name).shape == (2, len(results[0][0]))
+    assert ens.lengths.tolist() == [len(results[0][0]), 40]
+    assert numpy.allclose(ens.get_run(1, obs.name),
+                          results[0][1][obs.name][:40])
+    assert numpy.isnan(ens.get(obs.name)[1, 40:]).all()
+
+
+def test_sweep_conditions():
+    model = _get_gk_model()
+    target = Agent('MAPK1', mods=[ModCondition('phosphorylation')])
+    t = tra.TRA(use_kappa=False)
+    sweep = t.sweep_conditions(model, [Agent('MAP2K1'), Agent('DUSP6')],
+                               target, [[0, 1, 10], [0.5, 2]],
+                               max_time=1000, num_times=11)
+    assert sweep.values.shape == (6, 1, 11)
+    assert sweep.grid.tolist()[1] == [0.0, 2.0]
+    # Without MAP2K1 there is no phosphorylation
+    assert sweep.final_mean[0] == 0
+    # More MAP2K1 leads to more phosphorylation
+    assert sweep.final_mean[4] > sweep.final_mean[2] > 0
+    assert len(sweep.get_stats()) == 6
+
+
+def test_steady_state_detection():
+    model = _get_gk_model()
+    obs = tra.get_create_observable(model, Agent('MAPK1'))
+    t = tra.TRA(use_kappa=False)
+    ts, yobs = t.simulate_odes(model, 200000, 2000)
+    ts_ss, yobs_ss = t.simulate_odes(model, 200000, 2000,
+                                     steady_state_tol=1e-6)
+    # The trajectory is padded to the full time span
+    assert len(ts_ss) == len(ts) == 101
+    assert numpy.allclose(ts_ss, ts)
+    assert yobs_ss[obs.name][-1] == yobs_ss[obs.name][-2]
+    assert numpy.allclose(yobs_ss[obs.name], yobs[obs.name], atol=0.1)
+
+
+def test_steady_state_detection_same_integrator():
+    model = _get_gk_model()
+    obs = tra.get_create_observable(
+        model, Agent('MAPK1', mods=[ModCondition('phosphorylation')]))
+    t = tra.TRA(use_kappa=False)
+    ts, yobs = t.simulate_odes(model, 20000, 100)
+    # Without reaching a steady state, integrating in chunks only differs
+    # from integrating at once within the tolerance of the integrator
+    ts_ch, yobs_ch = t.simulate_odes(model, 20000, 100,
+                                     steady_state_tol=1e-12)
+    assert numpy.allclose(ts_ch, ts)
+    assert yobs_ch[obs.name][-1] != yobs_ch[obs.name][-2]
+    assert numpy.allclose(yobs_ch[obs.name], yobs[obs.name], rtol=1e-3,
+                          atol=0.05)
+
+
+def test_online_model_checker():
+    from bioagents.tra import model_checker as mc
+    from bioagents.tra.model_checker import ModelChecker, OnlineModelChecker
+    states = numpy.zeros(47, dtype=[('x', int)])
+    states['x'][20:30] = 1
+    for fstr in [mc.transient_formula('x'), mc.sustained_formula('x'),
+                 mc.sometime_formula('x', 1), mc.always_formula('x', 0)]:
+        omc = OnlineModelChecker(fstr)
+        for i in range(0, len(states), 7):
+            omc.add_states(states[i:i+7])
+        assert omc.finish() == ModelChecker(fstr, states).truth
+
+
+def test_check_property_online():
+    model = _get_gk_model()
+    entity = Agent('MAPK1', mods=[ModCondition('phosphorylation')])
+    quant = tra.MolecularQuantity('qualitative', 'high')
+    pattern = tra.TemporalPattern('sometime_value', [entity], None,
+                                  value=quant)
+    t = tra.TRA(use_kappa=False)
+    res = t.check_property(model, pattern, max_time=20000, num_times=100,
+                           num_sim=1, online=True)
+    # The simulation is paused once the pattern is satisfied
+    assert len(t.sim_cache) == 0
+    assert res[0] == 1.0
+    res_offline = t.check_property(model, pattern, max_time=20000,
+                                   num_times=100, num_sim=1)
+    assert res_offline[:4] == res[:4]
+
 # Module level TRA tests
 
 def test_module():
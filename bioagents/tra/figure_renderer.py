@@ -0,0 +1,97 @@
+"""Render TRA figures in the background using the object-oriented Agg API.
+
+Figures are created, drawn and saved by a single job on a worker thread
+without going through the pyplot state machine, so they are never
+registered globally and are freed as soon as they have been written.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+logger = logging.getLogger('figure_renderer')
+
+
+class FigureRenderer(object):
+    """Render and save figures on a single background worker thread.
+
+    Matplotlib is not thread-safe, so all figures are rendered by the same
+    worker, one after the other, in the order in which they were submitted.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def render(self, fig_path, draw_func, *args, **kwargs):
+        """Submit a figure to be drawn and saved to a given path.
+
+        Parameters
+        ----------
+        fig_path : str
+            The path at which the figure is saved.
+        draw_func : function
+            A function that draws the figure given a matplotlib Axes as
+            its first argument, followed by args and kwargs.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            A Future whose result is fig_path once the figure is saved.
+        """
+        with self._lock:
+            future = self.executor.submit(self._render, fig_path, draw_func,
+                                          args, kwargs)
+            self._futures[fig_path] = future
+        future.add_done_callback(
+            lambda f: self._forget(fig_path, f))
+        return future
+
+    def when_ready(self, fig_path, callback):
+        """Call a function with the path once the figure has been saved.
+
+        If the figure is already saved (or was never submitted), the
+        function is called right away. If rendering the figure failed, the
+        function isn't called and the error is logged.
+        """
+        with self._lock:
+            future = self._futures.get(fig_path)
+        if future is None:
+            callback(fig_path)
+            return
+
+        def _callback(f):
+            if f.exception() is not None:
+                logger.error('Could not render figure %s' % fig_path,
+                             exc_info=f.exception())
+                return
+            callback(fig_path)
+        future.add_done_callback(_callback)
+
+    def wait(self, fig_path):
+        """Block until the figure at the given path has been saved."""
+        with self._lock:
+            future = self._futures.get(fig_path)
+        if future is not None:
+            future.result()
+        return fig_path
+
+    def _forget(self, fig_path, future):
+        # Failed renders are kept until the figure is submitted again so
+        # that callbacks registered later aren't called with a missing file
+        if future.exception() is not None:
+            return
+        with self._lock:
+            if self._futures.get(fig_path) is future:
+                self._futures.pop(fig_path)
+
+    @staticmethod
+    def _render(fig_path, draw_func, args, kwargs):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        draw_func(fig.add_subplot(1, 1, 1), *args, **kwargs)
+        fig.savefig(fig_path)
+        return fig_path
@@ -1,12 +1,17 @@
 """Web API client for a Kappa simulator."""
 
 import kappy
+import time
+import hashlib
+import threading
+from concurrent.futures import Future, TimeoutError
 from logging import getLogger, DEBUG
 
 logger = getLogger('kappa_client')
 
 
 KAPPA_URL = 'https://api.executableknowledge.org/kappa'
+MODEL_FILE_ID = 'model.ka'
 
 
 class KappaRuntime(object):
@@ -22,6 +27,15 @@ class KappaRuntime(object):
             self.kappa_instance = kappy.KappaStd()
         self.use_rest = use_rest
         self.project_name = project_name
+        # The key of the model loaded with load_model, if any
+        self.model_key = None
+        # The number of simulations run since the runtime was (re)started
+        self.num_uses = 0
+        self.has_sim = False
+        # The initial interval between status requests when waiting for a
+        # simulation, each request to a remote service is costly.
+        self.min_poll_interval = 0.1 if use_rest else 0.002
+        self.max_poll_interval = 1.0 if use_rest else 0.2
         return
 
     def add_code(self, code_str, name=None):
@@ -48,6 +62,39 @@ class KappaRuntime(object):
         content = self.kappa_instance.project_parse()
         return content
 
+    def load_model(self, code_str):
+        """Compile a model unless it is the one that is already compiled.
+
+        Unlike `compile`, this replaces any model previously loaded with this
+        function so that a runtime can be reused for different models.
+
+        Parameters
+        ----------
+        code_str : str
+            The Kappa code of the model.
+
+        Returns
+        -------
+        compiled : bool
+            True if the model was compiled, False if it was already loaded.
+        """
+        model_key = get_model_key(code_str)
+        if model_key == self.model_key:
+            return False
+        try:
+            if self.model_key is not None:
+                self.model_key = None
+                self.kappa_instance.file_delete(MODEL_FILE_ID)
+            self.kappa_instance.add_model_string(code_str,
+                                                 file_id=MODEL_FILE_ID)
+            self.kappa_instance.project_parse()
+        except Exception:
+            # Start from a clean project next time
+            self.reset_project()
+            raise
+        self.model_key = model_key
+        return True
+
     def start_sim(self, **parameters):
         """Start a simulation with given parameters.
 
@@ -76,23 +123,108 @@ class KappaRuntime(object):
         complete_params.update(parameters)
         sim_params = kappy.SimulationParameter(**complete_params)
         self.kappa_instance.simulation_start(sim_params)
+        self.num_uses += 1
+        self.has_sim = True
 
     def pause_sim(self):
         """Pause a given simulation."""
         self.kappa_instance.simulation_pause()
 
-    def continue_sim(self):
-        """Continue the pause simulation."""
-        self.kappa_instance.simulation_continue()
+    def continue_sim(self, pause_condition='[false]'):
+        """Continue the paused simulation.
+
+        Parameters
+        ----------
+        pause_condition : string
+            A Kappa Boolean expression defining the next pause condition for
+            the simulation. Default: [false], i.e., run without pausing.
+        """
+        self.kappa_instance.simulation_continue(pause_condition)
 
     def sim_status(self):
         """Return status of running simulation."""
         return self.kappa_instance.simulation_info()
 
+    def is_sim_running(self):
+        """Return True if the simulation is running, False if it stopped."""
+        status = self.sim_status()['simulation_info_progress']
+        percentage = status.get('simulation_progress_time_percentage')
+        if percentage is not None:
+            logger.debug('Sim time percentage: %d' % percentage)
+        return bool(status.get('simulation_progress_is_running'))
+
+    def watch_sim(self, timeout=None, cancel_event=None):
+        """Return a Future that is resolved once the simulation stops.
+
+        The status of the simulation is polled in a background thread with
+        an interval that starts short and grows exponentially, so that short
+        simulations are noticed to be done almost immediately while long
+        ones do not cause a flood of status requests.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            The number of seconds after which the simulation is paused and
+            the Future fails with a TimeoutError. Default: None
+        cancel_event : Optional[threading.Event]
+            An event which, if set, pauses the simulation and cancels the
+            Future. The Future can also be cancelled directly.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            A Future whose result is the run time of the simulation in
+            seconds once it has stopped (e.g., due to its pause condition).
+        """
+        future = Future()
+        thread = threading.Thread(target=self._poll_sim,
+                                  args=(future, timeout, cancel_event),
+                                  daemon=True)
+        thread.start()
+        return future
+
+    def wait_sim(self, timeout=None, cancel_event=None):
+        """Block until the simulation stops, see `watch_sim`."""
+        return self.watch_sim(timeout, cancel_event).result()
+
+    def _poll_sim(self, future, timeout, cancel_event):
+        start = time.time()
+        interval = self.min_poll_interval
+        try:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    future.cancel()
+                if future.cancelled():
+                    self.pause_sim()
+                    return
+                if not self.is_sim_running():
+                    break
+                elapsed = time.time() - start
+                if timeout is not None and elapsed >= timeout:
+                    self.pause_sim()
+                    future.set_exception(
+                        TimeoutError('Simulation did not finish in %.1fs.' %
+                                     timeout))
+                    return
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+            return
+        if future.set_running_or_notify_cancel():
+            future.set_result(time.time() - start)
+
     def sim_plot(self):
         """Get the data from the simulation."""
         return self.kappa_instance.simulation_plot()
 
+    def clear_sim(self):
+        """Delete the current simulation but keep the compiled model."""
+        if self.has_sim:
+            self.kappa_instance.simulation_delete()
+            self.has_sim = False
+
     def reset_project(self):
         if self.use_rest:
             self.kappa_instance = kappy.KappaRest(KAPPA_URL,
@@ -100,3 +232,105 @@ class KappaRuntime(object):
             self.kappa_instance.get_info()
         else:
             self.kappa_instance = kappy.KappaStd()
+        self.model_key = None
+        self.num_uses = 0
+        self.has_sim = False
+
+
+class KappaRuntimePool(object):
+    """A pool of warm Kappa runtimes that can be reused across simulations.
+
+    Runtimes are kept alive between simulations along with the model
+    compiled in them. When a runtime is requested for a given model, an idle
+    runtime that already has the model compiled is preferred, so that
+    repeated simulations of a model (e.g., with different seeds) neither
+    start a new simulator nor parse the model again. Runtimes are recycled,
+    i.e., restarted, after a given number of simulations or if they cannot
+    be cleared after a simulation.
+
+    Parameters
+    ----------
+    project_name : Optional[str]
+        The prefix of the project names of the runtimes. Each runtime gets
+        a project of its own so that runtimes used at the same time don't
+        replace each other's models and simulations through a shared
+        project of the REST API.
+    use_rest : Optional[bool]
+        If True, the runtimes use the Kappa REST API, otherwise a local
+        Kappa simulator. Default: False
+    max_idle : Optional[int]
+        The maximum number of idle runtimes kept in the pool. Default: 8
+    max_uses : Optional[int]
+        The number of simulations after which a runtime is restarted.
+        Default: 100
+    """
+    def __init__(self, project_name=None, use_rest=False, max_idle=8,
+                 max_uses=100):
+        self.project_name = project_name
+        self.use_rest = use_rest
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self._idle = []
+        self._num_started = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, code_str=None):
+        """Return a runtime for the exclusive use of the caller.
+
+        Parameters
+        ----------
+        code_str : Optional[str]
+            The Kappa code of a model to load into the runtime.
+
+        Returns
+        -------
+        runtime : KappaRuntime
+            A runtime with the given model compiled. It has to be given back
+            with `release` once it is not needed anymore.
+        """
+        model_key = get_model_key(code_str) if code_str is not None else None
+        runtime = None
+        with self._lock:
+            for idx, idle in enumerate(self._idle):
+                if idle.model_key == model_key:
+                    runtime = self._idle.pop(idx)
+                    break
+            else:
+                if self._idle:
+                    runtime = self._idle.pop()
+            if runtime is None:
+                self._num_started += 1
+                runtime_idx = self._num_started
+        if runtime is None:
+            logger.info('Starting new Kappa runtime.')
+            # Without a name, a unique project is made for each runtime
+            project_name = '%s_%d' % (self.project_name, runtime_idx) \
+                if self.project_name else None
+            runtime = KappaRuntime(project_name, use_rest=self.use_rest)
+        if code_str is not None:
+            runtime.load_model(code_str)
+        return runtime
+
+    def release(self, runtime):
+        """Give a runtime back to the pool for reuse."""
+        recycle = runtime.num_uses >= self.max_uses
+        if not recycle:
+            try:
+                runtime.clear_sim()
+            except Exception as e:
+                logger.warning('Could not clear Kappa simulation: %s' % e)
+                recycle = True
+        if recycle:
+            logger.info('Recycling Kappa runtime.')
+            runtime.reset_project()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(runtime)
+
+
+def get_model_key(code_str):
+    """Return a key identifying a Kappa model by its code."""
+    return hashlib.sha256(code_str.encode('utf-8')).hexdigest()
@@ -1,3 +1,4 @@
+import math
 import numpy
 from .ltl_nodes import build_tree
 
@@ -33,6 +34,48 @@ class ModelChecker(object):
         return self.truth
 
 
+class OnlineModelChecker(object):
+    """Check a formula on states as they are produced by a simulation.
+
+    States are downsampled and checked exactly as by ModelChecker, except
+    that they can be added in chunks. Since the last state of a trajectory
+    is treated specially, the most recent downsampled state is held back
+    until either a further state arrives or `finish` is called. The truth
+    value obtained is therefore always the same as that of ModelChecker on
+    the full trajectory.
+
+    Parameters
+    ----------
+    formula_str : str
+        The LTL formula to check.
+    """
+    def __init__(self, formula_str):
+        self.mc = ModelChecker(formula_str)
+        self.num_states = 0
+        self.pending = None
+        self.truth = None
+
+    def add_states(self, states):
+        """Add a chunk of states and return the truth value if decided."""
+        for s in states:
+            if self.truth is not None:
+                break
+            # Downsample the same way as ModelChecker does
+            if self.num_states % 5 == 0:
+                if self.pending is not None:
+                    self.truth = self.mc.update(self.pending, False)
+                self.pending = s
+            self.num_states += 1
+        return self.truth
+
+    def finish(self):
+        """Check the last state held back and return the truth value."""
+        if self.truth is None and self.pending is not None:
+            self.truth = self.mc.update(self.pending, True)
+        self.pending = None
+        return self.truth
+
+
 class HypothesisTester(object):
     """Test a hypothesis about a property based on random samples.
 
@@ -62,6 +105,18 @@ class HypothesisTester(object):
         self.delta = delta
         self.logA = numpy.log((1 - self.beta) / self.alpha)
         self.logB = numpy.log(self.beta / (1 - self.alpha))
+        # The change in the test ratio contributed by a single positive
+        # and a single negative sample, respectively
+        self.pos_step = numpy.log(self.prob - self.delta) - \
+            numpy.log(self.prob + self.delta)
+        self.neg_step = numpy.log(1 - (self.prob - self.delta)) - \
+            numpy.log(1 - (self.prob + self.delta))
+        self.reset()
+
+    def reset(self):
+        """Reset the sample counts used by incremental testing."""
+        self.num_pos = 0
+        self.num_neg = 0
 
     def get_logq(self, samples):
         """Return the logarithm of the test ratio given a set of samples.
@@ -83,6 +138,9 @@ class HypothesisTester(object):
         """
         ps = len([s for s in samples if s])
         ns = len(samples) - ps
+        return self._get_logq_from_counts(ps, ns)
+
+    def _get_logq_from_counts(self, ps, ns):
         term1 = ps * numpy.log(self.prob - self.delta)
         term2 = ns * numpy.log(1 - (self.prob - self.delta))
         term3 = ps * numpy.log(self.prob + self.delta)
@@ -108,6 +166,80 @@ class HypothesisTester(object):
             None is returned.
         """
         logq = self.get_logq(samples)
+        return self._test_logq(logq)
+
+    def update(self, sample):
+        """Add a single sample and return the result of the test so far.
+
+        Unlike `test`, which takes the full list of samples, this function
+        keeps track of the number of positive and negative samples seen since
+        the last call to `reset` so that the test statistic is updated in
+        constant time.
+
+        Parameters
+        ----------
+        sample : bool
+            Whether the property was satisfied in the given sample.
+
+        Returns
+        -------
+        result : 0, 1 or None
+            The result of the hypothesis test, see `test`.
+        """
+        if sample:
+            self.num_pos += 1
+        else:
+            self.num_neg += 1
+        logq = self._get_logq_from_counts(self.num_pos, self.num_neg)
+        return self._test_logq(logq)
+
+    def get_min_samples_to_decide(self):
+        """Return the smallest number of further samples that could decide.
+
+        This is based on the margin between the current test ratio and the
+        two decision boundaries, and is the number of samples that would be
+        needed if all further samples were positive (or all negative),
+        whichever is smaller. It is therefore a natural size for the next
+        batch of samples to be generated in parallel.
+
+        Returns
+        -------
+        num_samples : int
+            The minimal number of further samples needed to reach a decision,
+            at least 1.
+        """
+        logq = self._get_logq_from_counts(self.num_pos, self.num_neg)
+        to_b = math.ceil((logq - self.logB) / -self.pos_step)
+        to_a = math.ceil((self.logA - logq) / self.neg_step)
+        return max(1, min(to_a, to_b))
+
+    def get_expected_samples_to_decide(self):
+        """Return the expected number of further samples needed to decide.
+
+        The expectation is based on the empirical satisfaction rate of the
+        samples seen so far (or `prob` if no samples were seen yet), and the
+        margin between the current test ratio and the decision boundary
+        that the test ratio is drifting towards.
+
+        Returns
+        -------
+        num_samples : float
+            The expected number of further samples, at least 1. This can be
+            infinite if the test ratio is not expected to drift.
+        """
+        num_samples = self.num_pos + self.num_neg
+        rate = (self.num_pos / num_samples) if num_samples else self.prob
+        drift = rate * self.pos_step + (1 - rate) * self.neg_step
+        logq = self._get_logq_from_counts(self.num_pos, self.num_neg)
+        if drift < 0:
+            expected = (logq - self.logB) / -drift
+        elif drift > 0:
+            expected = (self.logA - logq) / drift
+        else:
+            return float('inf')
+        return max(1, math.ceil(expected))
+
+    def _test_logq(self, logq):
         if logq <= self.logB:
             return 0
         elif logq >= self.logA:
@@ -0,0 +1,173 @@
+"""A content-addressed cache of TRA simulation trajectories.
+
+Trajectories are keyed by a canonical fingerprint of the PySB model, the
+molecular conditions applied to it, the time settings of the simulation and
+the random seed (if any). The cache has an in-memory LRU tier and an optional
+on-disk tier in which trajectories are stored as compressed NumPy archives.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy
+
+
+logger = logging.getLogger('sim_cache')
+
+
+class SimulationCache(object):
+    """Cache simulation results by a content-addressed key.
+
+    Parameters
+    ----------
+    max_size : Optional[int]
+        The maximum number of trajectories kept in memory. When exceeded,
+        the least recently used trajectory is evicted from memory (but is
+        kept on disk if a cache directory is given). Default: 128
+    cache_dir : Optional[str]
+        A directory in which trajectories are stored as compressed NumPy
+        archives. If None, only the in-memory tier is used. Default: None
+    """
+    def __init__(self, max_size=128, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._mem = OrderedDict()
+        # Simulations are run and cached from worker threads, the memory
+        # tier and the writing of archives are guarded separately so that
+        # memory hits don't wait for archives to be written.
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._mem)
+
+    def __contains__(self, key):
+        return key in self._mem or \
+            (self.cache_dir is not None and os.path.exists(self._path(key)))
+
+    def get(self, key):
+        """Return a (tspan, yobs) tuple for the given key or None if missing.
+
+        The returned arrays are shared with the cache and are therefore
+        read-only, callers that need to modify them have to make a copy.
+        """
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                logger.info('Simulation cache hit (memory) for %s' % key)
+                return self._mem[key]
+        if self.cache_dir is None:
+            return None
+        fname = self._path(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            with numpy.load(fname) as npz:
+                tspan, yobs = npz['tspan'], npz['yobs']
+        except Exception as e:
+            logger.warning('Could not load cached simulation from %s' % fname)
+            logger.exception(e)
+            return None
+        logger.info('Simulation cache hit (disk) for %s' % key)
+        return self._put_mem(key, tspan, yobs)
+
+    def put(self, key, tspan, yobs):
+        """Store the (tspan, yobs) trajectory under the given key."""
+        tspan = numpy.array(tspan, dtype=float)
+        yobs = numpy.array(yobs)
+        self._put_mem(key, tspan, yobs)
+        if self.cache_dir is not None:
+            fname = self._path(key)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partially written archive.
+            tmp_fname = fname + '.tmp.npz'
+            with self._disk_lock:
+                try:
+                    numpy.savez_compressed(tmp_fname, tspan=tspan,
+                                           yobs=yobs)
+                    os.replace(tmp_fname, fname)
+                except Exception as e:
+                    logger.warning('Could not write simulation to %s' %
+                                   fname)
+                    logger.exception(e)
+
+    def clear(self):
+        """Remove all trajectories from the in-memory tier."""
+        with self._lock:
+            self._mem.clear()
+
+    def _put_mem(self, key, tspan, yobs):
+        tspan.flags.writeable = False
+        yobs.flags.writeable = False
+        with self._lock:
+            self._mem[key] = (tspan, yobs)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_size:
+                self._mem.popitem(last=False)
+        return tspan, yobs
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+
+def get_model_fingerprint(model):
+    """Return a canonical hash of a PySB model's content.
+
+    The fingerprint only depends on the components of the model (and the
+    values of its parameters), not on the order in which they were added.
+    """
+    parts = []
+    for component_type in ('monomers', 'compartments', 'parameters',
+                           'expressions', 'rules', 'observables'):
+        components = getattr(model, component_type)
+        parts.append(sorted(repr(c) for c in components))
+    parts.append(sorted(repr(ic) for ic in model.initials))
+    return _hash_json(parts)
+
+
+def get_condition_key(condition):
+    """Return a JSON-serializable key for a MolecularCondition."""
+    value = condition.value
+    # Exact conditions carry a MolecularQuantity as value
+    if hasattr(value, 'quant_type'):
+        value = [value.quant_type, str(value.value)]
+    return [condition.condition_type, condition.quantity.quant_type,
+            condition.quantity.entity.matches_key(), value]
+
+
+def make_cache_key(model_fingerprint, conditions, max_time, plot_period,
+                   seed=None, **kwargs):
+    """Return a cache key for a single simulation run.
+
+    Parameters
+    ----------
+    model_fingerprint : str
+        The fingerprint of the (unconditioned) model, as returned by
+        get_model_fingerprint.
+    conditions : list[bioagents.tra.tra.MolecularCondition] or None
+        The molecular conditions applied to the model before simulation.
+    max_time : float
+        The time limit of the simulation.
+    plot_period : float
+        The period at which the output is sampled.
+    seed : Optional[int]
+        The random seed of a stochastic simulation, None for deterministic
+        simulations.
+    **kwargs
+        Any further settings that influence the simulation result.
+    """
+    cond_keys = [get_condition_key(c) for c in conditions] \
+        if conditions else []
+    parts = [model_fingerprint, cond_keys, float(max_time),
+             float(plot_period), seed, sorted(kwargs.items())]
+    return _hash_json(parts)
+
+
+def _hash_json(obj):
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
@@ -6,36 +6,67 @@ __all__ = ['TRA', 'get_ltl_from_pattern', 'apply_condition',
            'MolecularCondition', 'MolecularQuantity',
            'MolecularQuantityReference', 'InvalidMolecularConditionError',
            'InvalidMolecularQuantityError',
-           'InvalidMolecularQuantityRefError', 'SimulatorError']
+           'InvalidMolecularQuantityRefError', 'SimulatorError',
+           'SimulationCancelledError', 'TrajectoryEnsemble']
 import os
 import numpy
 import logging
-from time import sleep
+import threading
+import functools
+import itertools
 from typing import List
 from copy import deepcopy
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, CancelledError, \
+    TimeoutError
 import sympy.physics.units as units
 import indra.statements as ist
 import indra.assemblers.pysb.assembler as pa
 from indra.assemblers.english import assembler as english_assembler
 from pysb import Observable
-from pysb.integrate import Solver
+from pysb.simulator import ScipyOdeSimulator
 from pysb.export.kappa import KappaExporter
 from pysb.core import ComponentDuplicateNameError
 import bioagents.tra.model_checker as mc
 import matplotlib
+import matplotlib.patches
 from bioagents import BioagentException, get_img_path
+from bioagents.model_cache import get_writable
 from .model_checker import HypothesisTester
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from .sim_cache import SimulationCache, get_model_fingerprint, make_cache_key
+from .figure_renderer import FigureRenderer
 
 
 logger = logging.getLogger('TRA')
 
 
+# The number of plot periods that are simulated at a time when a simulation
+# is streamed, or when an ODE simulation may stop at a steady state
+CHUNK_SIZE = 10
+
+
 class TRA(object):
-    def __init__(self, use_kappa=True, use_kappa_rest=False):
+    def __init__(self, use_kappa=True, use_kappa_rest=False,
+                 sim_cache_dir=None, num_workers=4, sim_timeout=None,
+                 trajectory_dtype=numpy.float32):
+        self.use_kappa_rest = use_kappa_rest
+        # The type in which trajectories of simulation ensembles are kept
+        self.trajectory_dtype = trajectory_dtype
+        # The time limit (in seconds) for a single Kappa simulation
+        self.sim_timeout = sim_timeout
+        self.sol = None
+        # Simulations can be run in parallel using a pool of workers
+        self.num_workers = num_workers
+        self.executor = None
+        # Kappa runtimes are kept warm and reused across simulations
+        self.kappa_pool = kappa_client.KappaRuntimePool(
+            'TRA_simulations', use_rest=use_kappa_rest,
+            max_idle=max(num_workers, 1))
+        # Simulation results are cached by model content and run settings
+        # so that identical simulations are never repeated.
+        self.sim_cache = SimulationCache(cache_dir=sim_cache_dir)
+        # Figures are rendered in the background
+        self.renderer = FigureRenderer()
         kappa_mode_label = 'rest' if use_kappa_rest else 'standard'
         if not use_kappa:
             self.ode_mode = True
@@ -45,6 +76,7 @@ class TRA(object):
             try:
                 self.kappa = kappa_client.KappaRuntime('TRA_simulations',
                                                        use_rest=use_kappa_rest)
+                self.kappa_pool.release(self.kappa)
                 logger.info('Using kappa %s.' % kappa_mode_label)
             except Exception as e:
                 logger.error('Could not use kappa %s.' % kappa_mode_label)
@@ -58,13 +90,19 @@ class TRA(object):
                        max_time: float = None,
                        num_times: int = None,
                        num_sim: int = 2,
-                       hypothesis_tester: HypothesisTester = None):
+                       hypothesis_tester: HypothesisTester = None,
+                       seed: int = None,
+                       max_batch_size: int = 1,
+                       online: bool = False,
+                       steady_state_tol: float = None):
         # TODO: handle multiple entities (observables) in pattern
         # TODO: set max_time based on some model property if not given
         # NOTE: pattern.time_limit.ub takes precedence over max_time
-        # Make an observable for the simulations
+        # Make an observable for the simulations, the model may be shared
+        # through the model cache so we make sure not to modify it in place
         logger.info('Trying to make an observable for: %s',
                     pattern.entities[0])
+        model = get_writable(model)
         obs = get_create_observable(model, pattern.entities[0])
 
         # Make pattern
@@ -91,68 +129,58 @@ class TRA(object):
         # passed in, then we do adaptive sample size model checking to
         # determine if the given property is satisfied.
         if given_pattern and hypothesis_tester:
-            # We have to create these lists since they are required
-            # downstream for plotting and reporting.
-            yobs_list = []
-            results = []
-            thresholds = []
-            truths = []
             # We simulate and run model checking until the hypothesis
-            # tester tells us to stop.
-            while True:
-                # This runs a single simulation
-                result = self.run_simulations(model, conditions, 1,
-                                               min_time_idx, max_time, plot_period)[0]
-                results.append(result)
-                yobs = deepcopy(result[1])
-                threshold = self.discretize_obs(model, yobs, obs.name)
-                MC = mc.ModelChecker(fstr, yobs)
-                logger.info('Main property %s' % MC.truth)
-                truths.append(MC.truth)
-                thresholds.append(threshold)
-                yobs_list.append(yobs)
-                # We run the hypothesis tester here on the list of true/false
-                # values collected so far and if we get 1 or -1, we can stop.
-                ht_result = hypothesis_tester.test(truths)
-                if ht_result is not None:
-                    break
-            # We now calculate some statistics needed below
-            num_sim = len(results)
-            results_copy = deepcopy(results)
-            sat_rate = numpy.count_nonzero(truths) / (1.0 * num_sim)
+            # tester tells us to stop. We have to keep the results
+            # since they are required downstream for plotting and reporting.
+            samples = \
+                self.run_sequential_test(model, conditions, fstr, obs.name,
+                                         hypothesis_tester, min_time_idx,
+                                         max_time, plot_period,
+                                         max_batch_size=max_batch_size,
+                                         seed=seed, online=online,
+                                         steady_state_tol=steady_state_tol)
+        # In this case, we run simulation with a fixed num_sim and don't
+        # use hypothesis testing.
+        else:
+            samples = []
+            for i in range(num_sim):
+                sim_seed = (seed + i) if seed is not None else None
+                samples.append(
+                    self.simulate_and_check(model, conditions, fstr,
+                                            obs.name, min_time_idx, max_time,
+                                            plot_period, seed=sim_seed,
+                                            online=online,
+                                            steady_state_tol=steady_state_tol))
+        results, yobs_list, thresholds, truths, streams = \
+            [list(x) for x in zip(*samples)]
+        num_sim = len(results)
+        # We check for the given pattern
+        if given_pattern:
+            sat_rate = numpy.count_nonzero(truths) / (1.0*num_sim)
             make_suggestion = (sat_rate < 0.3)
             if make_suggestion:
                 logger.info('MAKING SUGGESTION with sat rate %.2f.' % sat_rate)
-        # In this case, we run simulation with a fixed num_sim and don't
-        # use hypothesis testing.
         else:
-            results = self.run_simulations(model, conditions, num_sim,
-                                           min_time_idx, max_time,
-                                           plot_period)
-
-            results_copy = deepcopy(results)
-            yobs_list = [yobs for _, yobs in results]
-
-            # Discretize observations
-            # WARNING: yobs is changed by discretize_obs in place
-            thresholds = [self.discretize_obs(model, yobs, obs.name)
-                          for yobs in yobs_list]
-            # We check for the given pattern
-            if given_pattern:
-                truths = []
-                for yobs in yobs_list:
-                    # Run model checker on the given pattern
-                    MC = mc.ModelChecker(fstr, yobs)
-                    logger.info('Main property %s' % MC.truth)
-                    truths.append(MC.truth)
-                sat_rate = numpy.count_nonzero(truths) / (1.0*num_sim)
-                make_suggestion = (sat_rate < 0.3)
-                if make_suggestion:
-                    logger.info('MAKING SUGGESTION with sat rate %.2f.' % sat_rate)
+            make_suggestion = True
+
+        # Simulations that were paused by online model checking are resumed
+        # if their full trajectories are needed to make a suggestion.
+        for idx, stream in enumerate(streams):
+            if stream is None:
+                continue
+            if make_suggestion:
+                stream.finish()
+                results[idx] = stream.get_trajectory(min_time_idx)
+                yobs_list[idx], thresholds[idx] = \
+                    self.discretize_obs(model, results[idx][1], obs.name)
             else:
-                make_suggestion = True
+                stream.close()
 
-        fig_path = self.plot_results(results_copy, pattern.entities[0],
+        # Only the observable of interest is kept from the trajectories
+        ensemble = TrajectoryEnsemble.from_results(
+            results, [obs.name], dtype=self.trajectory_dtype)
+        del samples, results
+        fig_path = self.plot_results(ensemble, pattern.entities[0],
                                      obs.name, thresholds[0])
 
         # If no suggestion is to be made, we return
@@ -175,27 +203,199 @@ class TRA(object):
                 else:
                     return sat_rate, num_sim, kpat, pat_obj, fig_path
 
+    def simulate_and_check(self, model, conditions, fstr, obs_name,
+                           min_time_idx, max_time, plot_period, seed=None,
+                           online=False, cancel_event=None,
+                           steady_state_tol=None):
+        """Run a single simulation and check the given formula on it.
+
+        Returns
+        -------
+        result : tuple
+            The (tspan, yobs) result of the simulation starting from
+            min_time_idx. If the simulation was paused by online model
+            checking, this only covers the trajectory simulated so far.
+        yobs : numpy.ndarray
+            The discretized observables of the simulation.
+        threshold : float
+            The discretization threshold of the simulation.
+        truth : bool or None
+            Whether the formula was satisfied in the simulation, None if
+            no formula was given.
+        stream : SimulationStream or None
+            The stream of a simulation paused by online model checking,
+            None if the simulation was run to max_time.
+        """
+        truth = None
+        stream = None
+        if online and fstr is not None:
+            stream, truth = \
+                self.run_online_simulation(model, conditions, fstr, obs_name,
+                                           min_time_idx, max_time,
+                                           plot_period, seed=seed,
+                                           cancel_event=cancel_event,
+                                           steady_state_tol=steady_state_tol)
+            result = stream.get_trajectory(min_time_idx)
+            if stream.done:
+                stream = None
+        else:
+            result = self.run_simulations(model, conditions, 1, min_time_idx,
+                                          max_time, plot_period, seed=seed,
+                                          cancel_event=cancel_event,
+                                          steady_state_tol=steady_state_tol)[0]
+        yobs, threshold = self.discretize_obs(model, result[1], obs_name)
+        if fstr is not None and truth is None:
+            # Run model checker on the given pattern
+            truth = mc.ModelChecker(fstr, yobs).truth
+        if fstr is not None:
+            logger.info('Main property %s' % truth)
+        return result, yobs, threshold, truth, stream
+
+    def run_online_simulation(self, model, conditions, fstr, obs_name,
+                              min_time_idx, max_time, plot_period, seed=None,
+                              cancel_event=None, steady_state_tol=None):
+        """Run a simulation while checking a formula on its trajectory.
+
+        The trajectory is produced in chunks that are fed to an
+        OnlineModelChecker as soon as they are available, and the simulation
+        is paused once the truth value of the formula is fixed. This is only
+        possible if the discretization threshold of the observable follows
+        from its value at the start of the trajectory, otherwise the
+        simulation runs to max_time.
+
+        Returns
+        -------
+        stream : SimulationStream
+            The stream of the simulation. If the formula was decided early,
+            the stream is paused and can be resumed with `finish` or released
+            with `close`.
+        truth : bool or None
+            The truth value of the formula if it was decided before the end
+            of the simulation, None otherwise.
+        """
+        sim_seed = None if self.ode_mode else seed
+        cache_key = self.get_cache_key(get_model_fingerprint(model),
+                                       conditions, max_time, plot_period,
+                                       sim_seed, steady_state_tol,
+                                       chunked=True)
+        cached = self.sim_cache.get(cache_key) \
+            if cache_key is not None else None
+        if cached is not None:
+            logger.info('Using cached result for simulation')
+            stream = SimulationStream(iter([cached]))
+        else:
+            chunks = self.stream_simulation(model, conditions, max_time,
+                                            plot_period, seed=sim_seed,
+                                            cancel_event=cancel_event,
+                                            steady_state_tol=steady_state_tol)
+            stream = SimulationStream(chunks, self.sim_cache, cache_key)
+        checker = None
+        num_points = 0
+        for tspan, yobs in stream:
+            # We only check the part of the trajectory after min_time_idx
+            yobs = yobs[max(min_time_idx - num_points, 0):]
+            num_points += len(tspan)
+            if not len(yobs):
+                continue
+            if checker is None:
+                thresh = self.get_start_threshold(yobs[obs_name][0])
+                if thresh is None:
+                    logger.info('Cannot check %s online, the threshold '
+                                'depends on the full trajectory.' % fstr)
+                    checker = False
+                else:
+                    checker = mc.OnlineModelChecker(fstr)
+            if checker:
+                states = threshold_obs(yobs[obs_name], obs_name, thresh)
+                if checker.add_states(states) is not None:
+                    logger.info('Property decided at time %.1f, pausing '
+                                'simulation.' % tspan[-1])
+                    return stream, checker.truth
+        return stream, None
+
+    def run_sequential_test(self, model, conditions, fstr, obs_name,
+                            hypothesis_tester, min_time_idx, max_time,
+                            plot_period, max_batch_size=1, seed=None,
+                            online=False, steady_state_tol=None):
+        """Run simulations until the hypothesis tester reaches a decision.
+
+        If max_batch_size is larger than 1, simulations are launched in
+        batches whose size is estimated from the current margin of the test
+        ratio to the decision boundaries. Simulations in a batch run in
+        parallel (in Kappa mode) and their results are fed to the tester in
+        the order in which they were launched, so that the outcome is that of
+        the sequential test. Once the test is decided, simulations still in
+        flight are cancelled.
+
+        Returns
+        -------
+        samples : list[tuple]
+            The results of the simulations used by the test, each as returned
+            by `simulate_and_check`.
+        """
+        samples = []
+        hypothesis_tester.reset()
+        ht_result = None
+        while ht_result is None:
+            batch_size = min(
+                max_batch_size,
+                max(hypothesis_tester.get_min_samples_to_decide(),
+                    hypothesis_tester.get_expected_samples_to_decide()))
+            logger.info('Running batch of %d simulations' % batch_size)
+            cancel_events = [threading.Event() for _ in range(batch_size)]
+            jobs = []
+            for i, cancel_event in enumerate(cancel_events, len(samples)):
+                sim_seed = (seed + i) if seed is not None else None
+                jobs.append(functools.partial(
+                    self.simulate_and_check, model, conditions, fstr,
+                    obs_name, min_time_idx, max_time, plot_period,
+                    seed=sim_seed, online=online, cancel_event=cancel_event,
+                    steady_state_tol=steady_state_tol))
+            # ODE simulations are deterministic and cached so we run them
+            # one by one, only as needed.
+            if self.ode_mode or batch_size == 1:
+                getters = jobs
+                futures = []
+            else:
+                futures = [self.get_executor().submit(job) for job in jobs]
+                getters = [future.result for future in futures]
+            num_used = 0
+            for getter in getters:
+                sample = getter()
+                samples.append(sample)
+                num_used += 1
+                # We update the hypothesis tester with the new sample and if
+                # we get 0 or 1, we can stop.
+                ht_result = hypothesis_tester.update(sample[3])
+                if ht_result is not None:
+                    break
+            # Cancel any simulations that are no longer needed and release
+            # the ones that were paused by online checking but not used.
+            for cancel_event in cancel_events[num_used:]:
+                cancel_event.set()
+            for future in futures[num_used:]:
+                future.cancel()
+                future.add_done_callback(_close_sample_stream)
+        return samples
+
+    def get_executor(self):
+        """Return the thread pool used to run simulations in parallel."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        return self.executor
+
     def compare_conditions(self, model, condition_agent, target_agent, up_dn,
-                           max_time=None, num_times=101):
-        if not max_time:
-            max_time = 20000
-        if not num_times:
-            num_times = 101
-        obs = get_create_observable(model, target_agent)
-        cond_quant = MolecularQuantityReference('total', condition_agent)
-        all_results = []
-        plot_period = max_time / (num_times - 1)
-        ts = numpy.linspace(0, max_time, num_times)
-        mults = [0.0, 100.0]
-        for mult in mults:
-            condition = MolecularCondition('multiple', cond_quant, mult)
-            results = self.run_simulations(model, [condition], 1, 0,
-                                           max_time, plot_period)
-            obs_values = results[0][1][obs.name]
-            all_results.append(obs_values)
+                           max_time=None, num_times=101, seed=None,
+                           steady_state_tol=None):
+        sweep = self.sweep_conditions(model, [condition_agent], target_agent,
+                                      [[0.0, 100.0]], max_time=max_time,
+                                      num_times=num_times, seed=seed,
+                                      steady_state_tol=steady_state_tol)
+        ts = sweep.ts
+        all_results = list(sweep.values[:, 0, :])
         # Plotting
         fig_path = self.plot_compare_conditions(ts, all_results, target_agent,
-                                                obs.name)
+                                                sweep.obs_name)
         diff = numpy.sum(all_results[-1][:len(ts)] -
                          all_results[0][:len(ts)]) / len(ts)
         logger.info('TRA condition difference: %.2f' % diff)
@@ -209,104 +409,260 @@ class TRA(object):
 
         return res, fig_path
 
+    def sweep_conditions(self, model, condition_agents, target_agent,
+                         multipliers, max_time=None, num_times=101,
+                         num_sim=1, seed=None, steady_state_tol=None):
+        """Simulate a model over a grid of condition multipliers.
+
+        The grid is the product of the multipliers given for each condition
+        agent, e.g., two agents with multipliers [0, 1] and [1, 10] result
+        in four grid points. Each grid point is simulated num_sim times,
+        and all simulations of the sweep are submitted as a single batch of
+        jobs that run in parallel (in Kappa mode).
+
+        Parameters
+        ----------
+        model : pysb.Model
+            The model to simulate.
+        condition_agents : list[indra.statements.Agent]
+            The agents whose total amount is varied.
+        target_agent : indra.statements.Agent
+            The agent whose amount is observed.
+        multipliers : list[list[float]]
+            For each condition agent, the multipliers of its initial amount.
+        max_time : Optional[float]
+            The time limit of the simulations. Default: 20000
+        num_times : Optional[int]
+            The number of time points at which the target is observed.
+            Default: 101
+        num_sim : Optional[int]
+            The number of simulations per grid point. Default: 1
+        seed : Optional[int]
+            A random seed for stochastic simulations.
+        steady_state_tol : Optional[float]
+            If given, ODE simulations are ended once a steady state is
+            reached, see `stream_odes`.
+
+        Returns
+        -------
+        sweep : ConditionSweep
+            The results of the sweep.
+        """
+        if not max_time:
+            max_time = 20000
+        if not num_times:
+            num_times = 101
+        if len(multipliers) != len(condition_agents):
+            msg = 'Need one list of multipliers per condition agent.'
+            raise InvalidMolecularConditionError(msg)
+        model = get_writable(model)
+        obs = get_create_observable(model, target_agent)
+        plot_period = max_time / (num_times - 1)
+        ts = numpy.linspace(0, max_time, num_times)
+        cond_quants = [MolecularQuantityReference('total', agent)
+                       for agent in condition_agents]
+        grid = list(itertools.product(*multipliers))
+        jobs = []
+        for mults in grid:
+            conditions = [MolecularCondition('multiple', cond_quant, mult)
+                          for cond_quant, mult in zip(cond_quants, mults)]
+            jobs.append(functools.partial(self.run_simulations, model,
+                                          conditions, num_sim, 0, max_time,
+                                          plot_period, seed=seed,
+                                          steady_state_tol=steady_state_tol))
+        if self.ode_mode:
+            results = [job() for job in jobs]
+        else:
+            futures = [self.get_executor().submit(job) for job in jobs]
+            results = [future.result() for future in futures]
+        values = numpy.empty((len(grid), num_sim, num_times))
+        for grid_idx, grid_results in enumerate(results):
+            for sim_idx, (_, yobs) in enumerate(grid_results):
+                values[grid_idx, sim_idx] = \
+                    _fit_to_length(yobs[obs.name], num_times)
+        return ConditionSweep(condition_agents, obs.name,
+                              numpy.array(grid, dtype=float), ts, values)
+
     def plot_compare_conditions(self, ts, results, agent, obs_name):
-        max_val_lim = max((numpy.max(results[0]) + 0.25*numpy.max(results[0])),
-                          (numpy.max(results[1]) + 0.25*numpy.max(results[1])),
-                          101.0)
-        plt.figure()
-        plt.ion()
-        plt.plot(ts, results[0][:len(ts)], label='Without condition')
-        plt.plot(ts, results[-1][:len(ts)], label='With condition')
-        plt.ylim(-5, max_val_lim)
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
+        """Render the comparison of conditions in the background.
+
+        The path of the figure is returned right away, the figure is saved
+        there once rendered, see FigureRenderer.
+        """
         agent_str = english_assembler._assemble_agent_str(agent).agent_str
-        plt.title('Simulation results for %s' % agent_str)
-        plt.legend()
         fig_path = get_img_path(obs_name + '.png')
-        plt.savefig(fig_path)
+        self.renderer.render(fig_path, draw_compare_conditions, ts, results,
+                             agent_str)
+        return fig_path
+
+    def plot_sweep(self, sweep, target_agent):
+        """Render the mean trajectories of a condition sweep."""
+        agent_strs = [english_assembler._assemble_agent_str(agent).agent_str
+                      for agent in sweep.agents]
+        target_str = \
+            english_assembler._assemble_agent_str(target_agent).agent_str
+        fig_path = get_img_path(sweep.obs_name + '_sweep.png')
+        self.renderer.render(fig_path, draw_sweep, sweep, agent_strs,
+                             target_str)
         return fig_path
 
     def plot_results(self, results, agent, obs_name, thresh=50):
-        plt.figure()
-        plt.ion()
-        max_val_lim = max(max((numpy.max(results[0][1][obs_name]) + 0.25*numpy.max(results[0][1][obs_name])), 101.0),
-                          thresh)
-        max_time = max([result[0][-1] for result in results])
-        lr = matplotlib.patches.Rectangle((0, 0), max_time, thresh, color='red',
-                                          alpha=0.1)
-        hr = matplotlib.patches.Rectangle((0, thresh), max_time,
-                                          max_val_lim-thresh,
-                                          color='green', alpha=0.1)
-        ax = plt.gca()
-        ax.add_patch(lr)
-        ax.add_patch(hr)
-        if thresh + 0.05*max_val_lim < max_val_lim:
-            plt.text(10, thresh + 0.05*max_val_lim, 'High', fontsize=10)
-        plt.text(10, thresh - 0.05*max_val_lim, 'Low')
-        for tspan, yobs in results:
-            plt.plot(tspan, yobs[obs_name])
-        plt.ylim(-5, max_val_lim)
-        plt.xlim(-max_time/100, max_time+max_time/100)
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
+        """Render the simulation results in the background.
+
+        The results are either a TrajectoryEnsemble or a list of
+        (tspan, yobs) results. The path of the figure is returned right
+        away, the figure is saved there once rendered, see FigureRenderer.
+        """
+        if not isinstance(results, TrajectoryEnsemble):
+            results = TrajectoryEnsemble.from_results(
+                results, [obs_name], dtype=self.trajectory_dtype)
         agent_str = english_assembler._assemble_agent_str(agent).agent_str
-        plt.title('Simulation results for %s' % agent_str)
         fig_path = get_img_path(obs_name + '.png')
-        plt.savefig(fig_path)
+        self.renderer.render(fig_path, draw_results, results, obs_name,
+                             agent_str, thresh)
         return fig_path
 
     def run_simulations(self, model, conditions, num_sim, min_time_idx,
-                        max_time, plot_period):
+                        max_time, plot_period, seed=None,
+                        cancel_event=None, steady_state_tol=None):
         logger.info('Running %d simulations with time limit of %d and plot '
                     'period of %d.' % (num_sim, max_time, plot_period))
         self.sol = None
         results = []
+        model_fingerprint = get_model_fingerprint(model)
         for i in range(num_sim):
-            # Apply molecular condition to model
-            try:
-                model_sim = self.condition_model(model, conditions)
-            except MissingMonomerError as e:
-                raise e
-            except Exception as e:
-                logger.exception(e)
-                msg = 'Applying molecular condition failed.'
-                raise InvalidMolecularConditionError(msg)
-            # Run a simulation
-            logger.info('Starting simulation %d' % (i+1))
-            if not self.ode_mode:
-                try:
-                    tspan, yobs = self.simulate_kappa(model_sim, max_time,
-                                                      plot_period)
-                except Exception as e:
-                    logger.exception(e)
-                    raise SimulatorError('Kappa simulation failed.')
+            # ODE simulations are deterministic so the seed is irrelevant,
+            # stochastic simulations can only be cached if they are seeded.
+            if self.ode_mode:
+                sim_seed = None
+            else:
+                sim_seed = (seed + i) if seed is not None else None
+            cache_key = self.get_cache_key(model_fingerprint, conditions,
+                                           max_time, plot_period, sim_seed,
+                                           steady_state_tol)
+            cached = self.sim_cache.get(cache_key) \
+                if cache_key is not None else None
+            if cached is not None:
+                logger.info('Using cached result for simulation %d' % (i+1))
+                tspan, yobs = cached
             else:
-                tspan, yobs = self.simulate_odes(model_sim, max_time,
-                                                 plot_period)
-            # Get and plot observable
+                tspan, yobs = self._run_simulation(model, conditions,
+                                                   max_time, plot_period,
+                                                   sim_seed, i, cancel_event,
+                                                   steady_state_tol)
+                if cache_key is not None:
+                    self.sim_cache.put(cache_key, tspan, yobs)
+            # The trajectory from min_time_idx on is a view that shares
+            # memory with the (cached) full trajectory
             start_idx = min(min_time_idx, len(yobs))
             yobs_from_min = yobs[start_idx:]
             tspan = tspan[start_idx:]
             results.append((tspan, yobs_from_min))
         return results
 
-    def discretize_obs(self, model, yobs, obs_name):
+    def get_cache_key(self, model_fingerprint, conditions, max_time,
+                      plot_period, seed, steady_state_tol=None,
+                      chunked=False):
+        """Return the cache key of a simulation or None if not cacheable.
+
+        ODE simulations that are integrated in chunks (when they are
+        streamed or may stop at a steady state) restart the integrator at
+        each chunk, so they are kept apart from those integrated at once,
+        which are only the same within the tolerance of the integrator.
+        """
+        # ODE simulations are deterministic, stochastic simulations can only
+        # be cached if they are seeded.
+        if not self.ode_mode and seed is None:
+            return None
+        kwargs = {'ode_mode': self.ode_mode}
+        # Steady state detection and chunking only apply to ODE simulations
+        if self.ode_mode and steady_state_tol is not None:
+            kwargs['steady_state_tol'] = steady_state_tol
+        if self.ode_mode and (chunked or steady_state_tol is not None):
+            kwargs['chunk_size'] = CHUNK_SIZE
+        return make_cache_key(model_fingerprint, conditions, max_time,
+                              plot_period, seed=seed, **kwargs)
+
+    def _run_simulation(self, model, conditions, max_time, plot_period,
+                        seed, sim_idx, cancel_event=None,
+                        steady_state_tol=None):
+        model_sim = self._get_conditioned_model(model, conditions)
+        # Run a simulation
+        logger.info('Starting simulation %d' % (sim_idx+1))
+        if not self.ode_mode:
+            try:
+                tspan, yobs = self.simulate_kappa(model_sim, max_time,
+                                                  plot_period, seed=seed,
+                                                  cancel_event=cancel_event)
+            except SimulationCancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+                raise SimulatorError('Kappa simulation failed.')
+        else:
+            tspan, yobs = self.simulate_odes(model_sim, max_time,
+                                             plot_period, steady_state_tol)
+        return tspan, yobs
+
+    def _get_conditioned_model(self, model, conditions):
+        # Apply molecular condition to model
+        try:
+            return self.condition_model(model, conditions)
+        except MissingMonomerError as e:
+            raise e
+        except Exception as e:
+            logger.exception(e)
+            msg = 'Applying molecular condition failed.'
+            raise InvalidMolecularConditionError(msg)
+
+    def stream_simulation(self, model, conditions, max_time, plot_period,
+                          seed=None, cancel_event=None,
+                          chunk_size=CHUNK_SIZE, steady_state_tol=None):
+        """Return a generator of the chunks of a simulation's trajectory.
+
+        Each chunk is a (tspan, yobs) tuple of at most chunk_size plot
+        points (the first chunk also contains the initial point). The
+        simulation only proceeds when the next chunk is requested so that it
+        is paused in between, and it is stopped when the generator is
+        closed.
+        """
+        model_sim = self._get_conditioned_model(model, conditions)
+        if self.ode_mode:
+            return self.stream_odes(model_sim, max_time, plot_period,
+                                    chunk_size, steady_state_tol)
+        return self.stream_kappa(model_sim, max_time, plot_period, chunk_size,
+                                 seed=seed, cancel_event=cancel_event)
+
+    def get_start_threshold(self, start_val):
+        """Return the discretization threshold implied by a start value.
+
+        If the threshold also depends on the rest of the trajectory, None is
+        returned.
+        """
         # TODO: This needs to be done in a model/observable-dependent way
         default_total_val = 100
-        start_val = yobs[obs_name][0]
-        max_val = numpy.max(yobs[obs_name])
-        min_val = numpy.min(yobs[obs_name])
         # If starts low, discretize wrt total value
         if start_val < 1e-5:
-            thresh = 0.3 * default_total_val
+            return 0.3 * default_total_val
+        return None
+
+    def discretize_obs(self, model, yobs, obs_name):
+        """Return the discretized values of an observable and the threshold.
+
+        The trajectory itself is not changed, the discretized values are
+        returned in a new structured array with a single obs_name field.
+        """
+        # TODO: This needs to be done in a model/observable-dependent way
+        default_total_val = 100
+        values = yobs[obs_name]
+        start_val = values[0]
+        thresh = self.get_start_threshold(start_val)
         # If starts high, discretize wrt range with a certain minimum
-        else:
-            thresh = start_val + max(0.5*(max_val - min_val),
+        if thresh is None:
+            thresh = start_val + max(0.5*(numpy.max(values) -
+                                          numpy.min(values)),
                                      default_total_val * 0.10)
-        for i, v in enumerate(yobs[obs_name]):
-            yobs[obs_name][i] = 1 if v > thresh else 0
-        return thresh
+        return threshold_obs(values, obs_name, thresh), thresh
 
     def condition_model(self, model, conditions):
         # Set up simulation conditions
@@ -318,35 +674,194 @@ class TRA(object):
             model_sim = model
         return model_sim
 
-    def simulate_kappa(self, model_sim, max_time, plot_period):
+    def simulate_kappa(self, model_sim, max_time, plot_period, seed=None,
+                       cancel_event=None):
         # Export kappa model
         kappa_model = pysb_to_kappa(model_sim)
-        # Start simulation
-        self.kappa.compile(code_list=[kappa_model])
-        self.kappa.start_sim(plot_period=plot_period,
-                         pause_condition="[T] > %d" % max_time)
-        while True:
-            sleep(0.2)
-            status_json = self.kappa.sim_status()['simulation_info_progress']
-            is_running = status_json.get('simulation_progress_is_running')
-            if not is_running:
-                break
-            else:
-                if status_json.get('time_percentage') is not None:
-                    logger.info(
-                        'Sim time percentage: %d' %
-                        status_json.get('simulation_progress_time_percentage')
-                        )
-        tspan, yobs = get_sim_result(self.kappa.sim_plot())
-        self.kappa.reset_project()
+        # Get a runtime with the model compiled
+        kappa = self.kappa_pool.acquire(kappa_model)
+        try:
+            # Start simulation
+            kappa.start_sim(plot_period=plot_period,
+                            pause_condition="[T] > %d" % max_time,
+                            seed=seed)
+            self._wait_for_kappa(kappa, cancel_event)
+            tspan, yobs = get_sim_result(kappa.sim_plot())
+        finally:
+            self.kappa_pool.release(kappa)
         return tspan, yobs
 
-    def simulate_odes(self, model_sim, max_time, plot_period):
+    def stream_kappa(self, model_sim, max_time, plot_period, chunk_size,
+                     seed=None, cancel_event=None):
+        """Generate the trajectory of a Kappa simulation in chunks.
+
+        The simulation is paused after every chunk_size plot periods and
+        only continued when the next chunk is requested.
+        """
+        kappa = self.kappa_pool.acquire(pysb_to_kappa(model_sim))
+        try:
+            chunk_time = chunk_size * plot_period
+            pause_time = min(chunk_time, max_time)
+            kappa.start_sim(plot_period=plot_period,
+                            pause_condition="[T] > %d" % pause_time,
+                            seed=seed)
+            num_points = 0
+            while True:
+                self._wait_for_kappa(kappa, cancel_event)
+                tspan, yobs = get_sim_result(kappa.sim_plot())
+                yield tspan[num_points:], yobs[num_points:]
+                num_points = len(tspan)
+                if pause_time >= max_time:
+                    break
+                pause_time = min(pause_time + chunk_time, max_time)
+                kappa.continue_sim("[T] > %d" % pause_time)
+        finally:
+            self.kappa_pool.release(kappa)
+
+    def _wait_for_kappa(self, kappa, cancel_event=None):
+        future = kappa.watch_sim(timeout=self.sim_timeout,
+                                 cancel_event=cancel_event)
+        try:
+            run_time = future.result()
+        except CancelledError:
+            logger.info('Simulation cancelled.')
+            raise SimulationCancelledError('Simulation cancelled.')
+        except TimeoutError as e:
+            raise SimulatorError(str(e))
+        logger.info('Kappa simulation ran for %.2fs.' % run_time)
+
+    def simulate_odes(self, model_sim, max_time, plot_period,
+                      steady_state_tol=None):
+        """Return the trajectory of an ODE simulation.
+
+        All ODE simulations are integrated by ScipyOdeSimulator with its
+        default settings. With steady state detection, the integration is
+        done in chunks by `stream_odes` so that it can stop early. Each
+        chunk restarts the integrator from the state at the end of the
+        previous one, so until the steady state is reached the trajectory
+        only differs from that of a single integration within the
+        tolerance of the integrator.
+        """
+        if steady_state_tol is not None:
+            chunks = list(self.stream_odes(model_sim, max_time, plot_period,
+                                           CHUNK_SIZE, steady_state_tol))
+            return (numpy.concatenate([tspan for tspan, _ in chunks]),
+                    numpy.concatenate([yobs for _, yobs in chunks]))
         ts = numpy.linspace(0, max_time, int(1.0*max_time/plot_period) + 1)
         if self.sol is None:
-            self.sol = Solver(model_sim, ts)
-        self.sol.run()
-        return ts, self.sol.yobs
+            self.sol = ScipyOdeSimulator(model_sim, tspan=ts)
+        return ts, self.sol.run().observables
+
+    def stream_odes(self, model_sim, max_time, plot_period, chunk_size,
+                    steady_state_tol=None):
+        """Generate the trajectory of an ODE simulation in chunks.
+
+        The integration of each chunk starts from the species amounts at
+        the end of the previous one. If steady_state_tol is given, the
+        integration ends once the rate of change of each species, both over
+        the last plot period and over the last chunk, is below
+        steady_state_tol times its amount (plus one). The remaining time
+        points are then filled with the steady state values so that the
+        trajectory still covers the full time span.
+        """
+        ts = numpy.linspace(0, max_time, int(1.0*max_time/plot_period) + 1)
+        sim = ScipyOdeSimulator(model_sim, tspan=ts)
+        y0 = None
+        start = 0
+        while start < len(ts) - 1:
+            end = min(start + chunk_size, len(ts) - 1)
+            chunk_ts = ts[start:end+1]
+            res = sim.run(tspan=chunk_ts, initials=y0)
+            y0 = res.species[-1]
+            # The initial point of each chunk is the last point of the
+            # previous one so we only return it for the first chunk
+            first = 0 if start == 0 else 1
+            yield chunk_ts[first:], res.observables[first:]
+            start = end
+            if steady_state_tol is not None and end < len(ts) - 1 and \
+                    is_steady_state(res.species, chunk_ts, steady_state_tol):
+                logger.info('Steady state reached at time %.1f' % ts[end])
+                yield ts[end+1:], numpy.repeat(res.observables[-1:],
+                                               len(ts) - end - 1)
+                return
+
+
+def is_steady_state(species, tspan, tol):
+    """Return True if species amounts have settled within a tolerance.
+
+    Parameters
+    ----------
+    species : numpy.ndarray
+        The amounts of species at the given time points, with shape
+        (num_times, num_species).
+    tspan : numpy.ndarray
+        The time points, at least two.
+    tol : float
+        The maximal rate of change of each species relative to its amount
+        (plus one, to allow for species that go to zero).
+    """
+    scale = tol * (numpy.abs(species[-1]) + 1.0)
+    last_rate = numpy.abs(species[-1] - species[-2]) / (tspan[-1] - tspan[-2])
+    total_rate = numpy.abs(species[-1] - species[0]) / (tspan[-1] - tspan[0])
+    return bool(numpy.all(last_rate <= scale) and
+                numpy.all(total_rate <= scale))
+
+
+def _fit_to_length(values, length):
+    # Kappa simulations can have a different number of output points than
+    # requested so we truncate or pad them with the last value
+    if len(values) >= length:
+        return values[:length]
+    return numpy.concatenate([values,
+                              numpy.repeat(values[-1:], length-len(values))])
+
+
+def draw_compare_conditions(ax, ts, results, agent_str):
+    max_val_lim = max((numpy.max(results[0]) + 0.25*numpy.max(results[0])),
+                      (numpy.max(results[1]) + 0.25*numpy.max(results[1])),
+                      101.0)
+    ax.plot(ts, results[0][:len(ts)], label='Without condition')
+    ax.plot(ts, results[-1][:len(ts)], label='With condition')
+    ax.set_ylim(-5, max_val_lim)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+    ax.legend()
+
+
+def draw_sweep(ax, sweep, agent_strs, target_str):
+    for mults, mean in zip(sweep.grid, sweep.mean):
+        label = ', '.join('%s x%g' % (agent_str, mult)
+                          for agent_str, mult in zip(agent_strs, mults))
+        ax.plot(sweep.ts, mean, label=label)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % target_str)
+    ax.legend()
+
+
+def draw_results(ax, ensemble, obs_name, agent_str, thresh=50):
+    values = ensemble.get(obs_name)
+    first_max = numpy.max(ensemble.get_run(0, obs_name))
+    max_val_lim = max(max((first_max + 0.25*first_max), 101.0), thresh)
+    max_time = ensemble.ts[-1]
+    lr = matplotlib.patches.Rectangle((0, 0), max_time, thresh, color='red',
+                                      alpha=0.1)
+    hr = matplotlib.patches.Rectangle((0, thresh), max_time,
+                                      max_val_lim-thresh,
+                                      color='green', alpha=0.1)
+    ax.add_patch(lr)
+    ax.add_patch(hr)
+    if thresh + 0.05*max_val_lim < max_val_lim:
+        ax.text(10, thresh + 0.05*max_val_lim, 'High', fontsize=10)
+    ax.text(10, thresh - 0.05*max_val_lim, 'Low')
+    # Each run is a column, NaN padding is not drawn
+    ax.plot(ensemble.ts, values.T)
+    ax.set_ylim(-5, max_val_lim)
+    ax.set_xlim(-max_time/100, max_time+max_time/100)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
 
 
 def get_ltl_from_pattern(pattern, obs):
@@ -468,24 +983,27 @@ def pysb_to_kappa(model):
 
 
 def get_sim_result(kappa_plot):
-    values = kappa_plot['series']
-    i_t = kappa_plot['legend'].index('[T]')
-    values.sort(key=lambda x: x[i_t])
-    nt = len(values)
-    obs_dict = {
-        j: key for j, key in enumerate(kappa_plot['legend'])
-        if key != '[T]'
-        }
-    yobs = numpy.ndarray(
-        nt, list(zip(obs_dict.values(), [float]*len(obs_dict))))
-    tspan = []
-    for i, value in enumerate(values):
-        tspan.append(value[i_t])
-        for j, obs in obs_dict.items():
-            yobs[obs][i] = value[j]
+    legend = kappa_plot['legend']
+    values = numpy.array(kappa_plot['series'], dtype=float)
+    values = values.reshape(len(values), len(legend))
+    i_t = legend.index('[T]')
+    values = values[numpy.argsort(values[:, i_t], kind='stable')]
+    obs_idx = [j for j, key in enumerate(legend) if key != '[T]']
+    yobs = numpy.empty(len(values),
+                       dtype=[(legend[j], float) for j in obs_idx])
+    for j in obs_idx:
+        yobs[legend[j]] = values[:, j]
+    tspan = values[:, i_t]
     return (tspan, yobs)
 
 
+def threshold_obs(values, obs_name, thresh):
+    """Return a structured array of 0/1 values above a threshold."""
+    states = numpy.empty(len(values), dtype=[(obs_name, float)])
+    states[obs_name] = values > thresh
+    return states
+
+
 def get_all_patterns(obs_name):
     patterns = []
 
@@ -741,3 +1259,198 @@ class MissingMonomerSiteError(BioagentException):
 
 class SimulatorError(BioagentException):
     pass
+
+
+class SimulationCancelledError(SimulatorError):
+    pass
+
+
+class ConditionSweep(object):
+    """The results of simulating a model over a grid of conditions.
+
+    Parameters
+    ----------
+    agents : list[indra.statements.Agent]
+        The agents whose total amount was varied.
+    obs_name : str
+        The name of the observable of the target agent.
+    grid : numpy.ndarray
+        The multipliers of each grid point, with shape
+        (num_grid_points, num_agents).
+    ts : numpy.ndarray
+        The time points at which the observable was sampled.
+    values : numpy.ndarray
+        The values of the observable with shape
+        (num_grid_points, num_sim, num_times).
+    """
+    def __init__(self, agents, obs_name, grid, ts, values):
+        self.agents = agents
+        self.obs_name = obs_name
+        self.grid = grid
+        self.ts = ts
+        self.values = values
+
+    @property
+    def mean(self):
+        """The mean trajectory at each grid point."""
+        return self.values.mean(axis=1)
+
+    @property
+    def std(self):
+        """The standard deviation of trajectories at each grid point."""
+        return self.values.std(axis=1)
+
+    @property
+    def final_mean(self):
+        """The mean final value of the observable at each grid point."""
+        return self.values[:, :, -1].mean(axis=1)
+
+    @property
+    def max_mean(self):
+        """The mean maximal value of the observable at each grid point."""
+        return self.values.max(axis=2).mean(axis=1)
+
+    @property
+    def time_average(self):
+        """The mean time-averaged value of the observable at each point."""
+        return self.values.mean(axis=(1, 2))
+
+    def get_stats(self):
+        """Return a list of summary statistics for each grid point."""
+        stats = []
+        for idx, mults in enumerate(self.grid):
+            stats.append({'multipliers': list(mults),
+                          'final_mean': self.final_mean[idx],
+                          'max_mean': self.max_mean[idx],
+                          'time_average': self.time_average[idx]})
+        return stats
+
+
+class TrajectoryEnsemble(object):
+    """The trajectories of selected observables across simulation runs.
+
+    The values are kept in a single contiguous array with a time axis shared
+    by all runs, and only for the observables that are needed, rather than
+    as one structured array of all observables (in float64) per run.
+    Trajectories shorter than the time axis (e.g., of simulations paused by
+    online model checking) are padded with NaN.
+
+    Parameters
+    ----------
+    obs_names : list[str]
+        The names of the observables.
+    ts : numpy.ndarray
+        The time points shared by all runs.
+    values : numpy.ndarray
+        The values of the observables with shape
+        (num_runs, num_obs, num_times).
+    lengths : numpy.ndarray
+        The number of time points actually simulated in each run.
+    """
+    def __init__(self, obs_names, ts, values, lengths):
+        self.obs_names = list(obs_names)
+        self.ts = ts
+        self.values = values
+        self.lengths = lengths
+
+    @classmethod
+    def from_results(cls, results, obs_names, dtype=numpy.float32):
+        """Return an ensemble from a list of (tspan, yobs) results.
+
+        Parameters
+        ----------
+        results : list[tuple]
+            The (tspan, yobs) results of the runs, as returned by
+            `TRA.run_simulations`.
+        obs_names : list[str]
+            The names of the observables to keep.
+        dtype : Optional[numpy.dtype]
+            The type in which values are stored. Default: numpy.float32
+        """
+        lengths = numpy.array([len(tspan) for tspan, _ in results],
+                              dtype=int)
+        if len(results):
+            # The longest run defines the time axis
+            num_times = lengths.max()
+            ts = numpy.array(results[lengths.argmax()][0], dtype=float)
+        else:
+            num_times = 0
+            ts = numpy.empty(0)
+        values = numpy.full((len(results), len(obs_names), num_times),
+                            numpy.nan, dtype=dtype)
+        for run_idx, (_, yobs) in enumerate(results):
+            for obs_idx, obs_name in enumerate(obs_names):
+                values[run_idx, obs_idx, :len(yobs)] = yobs[obs_name]
+        return cls(obs_names, ts, values, lengths)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def get(self, obs_name):
+        """Return a (num_runs, num_times) view of an observable's values."""
+        return self.values[:, self.obs_names.index(obs_name), :]
+
+    def get_run(self, run_idx, obs_name):
+        """Return the values of an observable in a single run."""
+        return self.get(obs_name)[run_idx, :self.lengths[run_idx]]
+
+
+class SimulationStream(object):
+    """Collect the chunks of a simulation trajectory as they are produced.
+
+    Iterating over the stream yields the chunks of the underlying
+    generator, while also keeping them so that the trajectory produced so
+    far can be obtained at any point.
+
+    Parameters
+    ----------
+    chunks : iterator
+        An iterator of (tspan, yobs) chunks of the trajectory.
+    sim_cache : Optional[SimulationCache]
+        A cache in which the full trajectory is stored once complete.
+    cache_key : Optional[str]
+        The key under which the full trajectory is cached.
+    """
+    def __init__(self, chunks, sim_cache=None, cache_key=None):
+        self.chunks = chunks
+        self.sim_cache = sim_cache
+        self.cache_key = cache_key
+        self.tspans = []
+        self.yobs_chunks = []
+        self.done = False
+
+    def __iter__(self):
+        for tspan, yobs in self.chunks:
+            self.tspans.append(tspan)
+            self.yobs_chunks.append(yobs)
+            yield tspan, yobs
+        self.done = True
+        if self.sim_cache is not None and self.cache_key is not None:
+            self.sim_cache.put(self.cache_key, *self.get_trajectory())
+
+    def finish(self):
+        """Run the simulation to the end."""
+        for _ in self:
+            pass
+
+    def close(self):
+        """Stop the simulation and release its resources."""
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+    def get_trajectory(self, min_time_idx=0):
+        """Return the (tspan, yobs) trajectory produced so far."""
+        tspan = numpy.concatenate(self.tspans)
+        yobs = numpy.concatenate(self.yobs_chunks)
+        start_idx = min(min_time_idx, len(yobs))
+        return tspan[start_idx:], yobs[start_idx:]
+
+
+def _close_sample_stream(future):
+    # Release a simulation paused by online model checking whose result
+    # ended up not being used
+    if future.cancelled() or future.exception() is not None:
+        return
+    stream = future.result()[4]
+    if stream is not None:
+        stream.close()
@@ -1,6 +1,7 @@
 import sys
 import json
 import logging
+import threading
 from kqml import KQMLList, KQMLPerformative
 from indra.assemblers.pysb import assembler as pysb_assembler
 from indra.assemblers.pysb import PysbAssembler
@@ -9,6 +10,7 @@ from indra.statements import stmts_from_json, Activation, Inhibition, \
 from indra.sources.trips import processor as trips_processor
 from bioagents.tra import tra
 from bioagents import Bioagent, BioagentException
+from bioagents.model_cache import model_cache
 
 # This version of logging is coming from tra...
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -29,7 +31,8 @@ def get_bool_arg(arg_name, kwargs, default=True):
 
 class TRA_Module(Bioagent):
     name = "TRA"
-    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS']
+    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS',
+             'MODEL-SWEEP-CONDITIONS']
 
     def __init__(self, **kwargs):
         use_kappa = get_bool_arg('use_kappa', kwargs, default=False)
@@ -40,6 +43,9 @@ class TRA_Module(Bioagent):
             logger.warning('You have chosen to not use Kappa.')
 
         self.tra = tra.TRA(use_kappa, use_kappa_rest)
+        # Figures to be displayed once the reply to a request has been sent
+        self.pending_figures = []
+        self._send_lock = threading.Lock()
         super(TRA_Module, self).__init__(**kwargs)
         return
 
@@ -107,7 +113,7 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('INVALID_PATTERN')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.pending_figures.append(fig_path)
 
         reply = KQMLList('SUCCESS')
         content = KQMLList()
@@ -161,12 +167,89 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('KAPPA_FAILURE')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.pending_figures.append(fig_path)
 
         reply = KQMLList('SUCCESS')
         reply.set('result', result)
         return reply
 
+    def respond_model_sweep_conditions(self, content):
+        """Return response content to a model-sweep-conditions request."""
+        condition_agent_clj = content.get('agent')
+        target_agent_clj = content.get('affected')
+        model_indra_clj = content.get('model')
+        multipliers_lst = content.get('multipliers')
+        num_sim = content.get('num-sim')
+        try:
+            stmts = decode_indra_stmts(model_indra_clj)
+            model = assemble_model(stmts)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_MODEL')
+            return reply_content
+        try:
+            condition_agents = self.get_agent(condition_agent_clj)
+            if not isinstance(condition_agents, list):
+                condition_agents = [condition_agents]
+            target_agent = self.get_agent(target_agent_clj)
+            multipliers = get_multipliers(multipliers_lst)
+            num_sim = 1 if num_sim is None else int(num_sim.to_string())
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_CONDITIONS')
+            return reply_content
+        try:
+            sweep = self.tra.sweep_conditions(model, condition_agents,
+                                              target_agent, multipliers,
+                                              num_sim=num_sim)
+        except tra.MissingMonomerError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER')
+            if e.monomer:
+                reply_content.set('entity', self.make_cljson(e.monomer))
+            return reply_content
+        except tra.MissingMonomerSiteError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER_SITE')
+            return reply_content
+        except tra.InvalidMolecularConditionError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_CONDITIONS')
+            return reply_content
+        except tra.SimulatorError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('KAPPA_FAILURE')
+            return reply_content
+
+        fig_path = self.tra.plot_sweep(sweep, target_agent)
+        self.pending_figures.append(fig_path)
+
+        results = KQMLList()
+        for stats in sweep.get_stats():
+            result = KQMLList()
+            result.set('multipliers',
+                       KQMLList(['%g' % m for m in stats['multipliers']]))
+            result.set('final-value', '%.2f' % stats['final_mean'])
+            result.set('max-value', '%.2f' % stats['max_mean'])
+            result.set('time-average', '%.2f' % stats['time_average'])
+            results.append(result)
+        reply = KQMLList('SUCCESS')
+        reply.set('result', results)
+        return reply
+
+    def reply_with_content(self, msg, reply_content):
+        """Send the reply, then display figures once they are rendered."""
+        super(TRA_Module, self).reply_with_content(msg, reply_content)
+        fig_paths, self.pending_figures = self.pending_figures, []
+        for fig_path in fig_paths:
+            self.tra.renderer.when_ready(fig_path, self.send_display_figure)
+
+    def send(self, msg):
+        # Figures are displayed from the rendering thread so sending has to
+        # be serialized
+        with self._send_lock:
+            super(TRA_Module, self).send(msg)
+
     def send_display_figure(self, path):
         msg = KQMLPerformative('tell')
         content = KQMLList('display-image')
@@ -176,11 +259,27 @@ class TRA_Module(Bioagent):
         self.send(msg)
 
 
+def get_multipliers(lst: KQMLList):
+    """Return lists of multipliers per agent from a (nested) KQMLList."""
+    if all(isinstance(elem, KQMLList) for elem in lst):
+        return [[float(m.to_string()) for m in sublst] for sublst in lst]
+    return [[float(m.to_string()) for m in lst]]
+
+
 def decode_indra_stmts(stmts_clj):
     return TRA_Module.get_statement(stmts_clj)
 
 
 def assemble_model(stmts):
+    """Return the model assembled from the statements, cached by content.
+
+    The model is shared through the model cache and must not be modified,
+    see bioagents.model_cache.get_writable.
+    """
+    return model_cache.get_model(stmts, _assemble_model)
+
+
+def _assemble_model(stmts):
     pa = PysbAssembler()
     pa.add_statements(stmts)
     model = pa.make_model(policies='one_step')
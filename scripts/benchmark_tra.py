@@ -0,0 +1,219 @@
+"""Benchmark the TRA on synthetic models of increasing size.
+
+Synthetic models are phosphorylation cascades of a given length assembled
+from INDRA Statements. For each model, `check_property` and
+`compare_conditions` are run in ODE mode, and the time spent in model
+assembly, compilation (generating and compiling the ODEs), simulation,
+discretization and model checking is measured separately. The results are
+written as JSON so that they can be compared across releases, e.g.:
+
+    python scripts/benchmark_tra.py --sizes 2 4 8 16 --output bench.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import functools
+from contextlib import contextmanager
+from collections import defaultdict
+from datetime import datetime
+import numpy
+import pysb
+import indra
+from indra.statements import Agent, ModCondition, Phosphorylation, \
+    Dephosphorylation
+from bioagents.tra import tra
+from bioagents.tra import tra_module
+
+
+PHASES = ['assembly', 'compilation', 'simulation', 'discretization',
+          'model_checking']
+
+
+def make_cascade_stmts(size):
+    """Return the Statements of a phosphorylation cascade of a given size.
+
+    An upstream kinase phosphorylates the first kinase of the cascade, and
+    each phosphorylated kinase phosphorylates the next one. A phosphatase
+    dephosphorylates every kinase of the cascade.
+    """
+    kinases = ['K%d' % i for i in range(size)]
+    phos = ModCondition('phosphorylation')
+    stmts = [Phosphorylation(Agent('UPSTREAM'), Agent(kinases[0]))]
+    for upstream, downstream in zip(kinases[:-1], kinases[1:]):
+        stmts.append(Phosphorylation(Agent(upstream, mods=[phos]),
+                                     Agent(downstream)))
+    for kinase in kinases:
+        stmts.append(Dephosphorylation(Agent('PPASE'), Agent(kinase)))
+    return stmts
+
+
+def get_target(size):
+    """Return the phosphorylated last kinase of a cascade."""
+    return Agent('K%d' % (size - 1),
+                 mods=[ModCondition('phosphorylation')])
+
+
+class PhaseTimer(object):
+    """Accumulate the time spent in each phase of a TRA run."""
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+            self.counts[name] += 1
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def get_phases(self):
+        """Return the time of each phase, simulation without compilation."""
+        phases = {name: self.times[name] for name in PHASES}
+        phases['simulation'] = max(0.0, self.times['run_simulation'] -
+                                   self.times['compilation'])
+        return phases
+
+
+@contextmanager
+def instrument(timer):
+    """Time the phases of the TRA by wrapping the functions involved."""
+    patches = [(tra, 'Solver', 'compilation'),
+               (tra, 'ScipyOdeSimulator', 'compilation'),
+               (tra.TRA, '_run_simulation', 'run_simulation'),
+               (tra.TRA, 'discretize_obs', 'discretization'),
+               (tra.mc, 'ModelChecker', 'model_checking')]
+    originals = [(obj, attr, getattr(obj, attr)) for obj, attr, _ in patches]
+    try:
+        for obj, attr, name in patches:
+            setattr(obj, attr, timer.wrap(name, getattr(obj, attr)))
+        yield timer
+    finally:
+        for obj, attr, func in originals:
+            setattr(obj, attr, func)
+
+
+def run_check_property(size, num_sim, max_time, num_times):
+    """Return the phase times of checking a property of a cascade."""
+    timer = PhaseTimer()
+    stmts = make_cascade_stmts(size)
+    with timer.phase('assembly'):
+        model = tra_module._assemble_model(stmts)
+    pattern = tra.TemporalPattern(
+        'sometime_value', [get_target(size)], None,
+        value=tra.MolecularQuantity('qualitative', 'high'))
+    t = tra.TRA(use_kappa=False)
+    with instrument(timer):
+        start = time.perf_counter()
+        sat_rate = t.check_property(model, pattern, max_time=max_time,
+                                    num_times=num_times,
+                                    num_sim=num_sim)[0]
+        total = time.perf_counter() - start
+    t.renderer.executor.shutdown(wait=True)
+    return {'phases': timer.get_phases(), 'total': total,
+            'sat_rate': sat_rate}
+
+
+def run_compare_conditions(size, max_time, num_times):
+    """Return the phase times of comparing conditions on a cascade."""
+    timer = PhaseTimer()
+    stmts = make_cascade_stmts(size)
+    with timer.phase('assembly'):
+        model = tra_module._assemble_model(stmts)
+    t = tra.TRA(use_kappa=False)
+    with instrument(timer):
+        start = time.perf_counter()
+        res = t.compare_conditions(model, Agent('UPSTREAM'),
+                                   get_target(size), 'up',
+                                   max_time=max_time, num_times=num_times)[0]
+        total = time.perf_counter() - start
+    t.renderer.executor.shutdown(wait=True)
+    return {'phases': timer.get_phases(), 'total': total, 'result': res}
+
+
+def summarize(runs):
+    """Return the median and minimum of each phase over repeated runs."""
+    summary = {}
+    for key in PHASES + ['total']:
+        values = [run['phases'][key] if key != 'total' else run['total']
+                  for run in runs]
+        summary[key] = {'median': float(numpy.median(values)),
+                        'min': float(numpy.min(values))}
+    return summary
+
+
+def run_benchmarks(sizes, repeats=3, num_sim=2, max_time=20000,
+                   num_times=100):
+    """Run all benchmarks and return the results as a dict."""
+    results = {'metadata': get_metadata(),
+               'settings': {'sizes': sizes, 'repeats': repeats,
+                            'num_sim': num_sim, 'max_time': max_time,
+                            'num_times': num_times},
+               'benchmarks': []}
+    for size in sizes:
+        model = tra_module._assemble_model(make_cascade_stmts(size))
+        model_size = {'monomers': len(model.monomers),
+                      'rules': len(model.rules)}
+        scenarios = [
+            ('check_property',
+             lambda: run_check_property(size, num_sim, max_time, num_times)),
+            ('compare_conditions',
+             lambda: run_compare_conditions(size, max_time, num_times))]
+        for name, func in scenarios:
+            runs = [func() for _ in range(repeats)]
+            summary = summarize(runs)
+            results['benchmarks'].append(
+                {'scenario': name, 'size': size, 'model': model_size,
+                 'summary': summary, 'runs': runs})
+            print('%s size=%d total=%.3fs' %
+                  (name, size, summary['total']['median']), file=sys.stderr)
+    return results
+
+
+def get_metadata():
+    return {'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': numpy.__version__,
+            'pysb': pysb.__version__,
+            'indra': indra.__version__}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 4, 8],
+                        help='The lengths of the synthetic cascades.')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='The number of times each benchmark is run.')
+    parser.add_argument('--num-sim', type=int, default=2,
+                        help='The number of simulations per property check.')
+    parser.add_argument('--max-time', type=float, default=20000,
+                        help='The time limit of the simulations.')
+    parser.add_argument('--num-times', type=int, default=100,
+                        help='The number of time points of the simulations.')
+    parser.add_argument('--output', default=None,
+                        help='The JSON file to write, stdout by default.')
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, repeats=args.repeats,
+                             num_sim=args.num_sim, max_time=args.max_time,
+                             num_times=args.num_times)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+
+
+if __name__ == '__main__':
+    main()